@@ -1,18 +1,66 @@
+import asyncio
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Header, Query, WebSocket, WebSocketDisconnect
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import HTTPConnection
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
-from reservas_models import CreateUserRequest, UserResponse, ChatRequest
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse, JSONResponse
+from reservas_models import (
+    CreateUserRequest, UserResponse, ChatRequest, AppointmentCancelRequest, AppointmentRescheduleRequest,
+)
+import reservas_config as config
+from reservas_config import ADMIN_TOKEN, DEBUG, TRACING_ENABLED
 import reservas_database as database
+import reservas_flow as appointment_flow
+import reservas_specialties as specialties
+import reservas_tracing as tracing
+import reservas_metrics as metrics
+from reservas_ratelimit import build_rate_limiter
 from reservas_llm import ChatbotService
+from reservas_session import ChatSession
+import reservas_streams as streams
+import reservas_warmup as warmup
+import reservas_shutdown as shutdown
+import reservas_outbox as outbox
+import reservas_reminders as reminders
+import reservas_waitlist as waitlist
+from reservas_router import router as ROUTER
+from reservas_cancel import CancelToken
 import os
+import hmac
 import json
+import math
+from datetime import datetime
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     database.ensure_data()
+    streams.recover_checkpoints()
+    # Las retenciones de las ofertas de la lista de espera vivían en memoria
+    waitlist.matcher.recover_offers()
+    shutdown.load_last_shutdown()
+    shutdown.register_hook("profiles", tracing.profiler.flush)
+    if ROUTER.log is not None:
+        shutdown.register_hook("router_log", ROUTER.log.close)
+    if config.OUTBOX_ENABLED:
+        # Los avisos que quedaron pendientes antes de reiniciar salen ahora
+        outbox.dispatcher.start()
+        shutdown.register_hook("outbox", outbox.dispatcher.stop)
+    if config.REMINDERS_ENABLED:
+        # Reconstruye desde appointments.db los recordatorios de la próxima ventana
+        reminders.scheduler.start()
+        shutdown.register_hook("reminders", reminders.scheduler.stop)
+    if config.SHUTDOWN_HOOK_SIGNALS:
+        shutdown.install_signal_handlers()
+    if config.WARMUP_BLOCKING:
+        await run_in_threadpool(warmup.run)
+    else:
+        # El servidor acepta conexiones mientras calienta; /readyz indica cuándo terminó
+        app.state.warmup_task = asyncio.create_task(run_in_threadpool(warmup.run))
     yield
+    await run_in_threadpool(shutdown.run)
 
 
 app = FastAPI(title="Reservas Médicas - Chatbot", version="0.1", lifespan=lifespan)
@@ -22,11 +70,104 @@ static_dir = os.path.join(os.path.dirname(__file__), "static")
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
 
+class TracingMiddleware:
+    """Traza por request (ASGI puro).
+
+    No usa @app.middleware("http"): BaseHTTPMiddleware reenvía el body por un
+    canal interno y la desconexión del cliente tarda segundos en llegar a
+    /chat/stream, que la necesita para cancelar la llamada a Gemini.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracing.tracing_active():
+            await self.app(scope, receive, send)
+            return
+        trace = tracing.start_trace(Headers(scope=scope).get("X-Trace-Id"))
+
+        async def send_traced(message):
+            if message["type"] == "http.response.start" and TRACING_ENABLED:
+                headers = MutableHeaders(scope=message)
+                headers["X-Trace-Id"] = trace.trace_id
+                headers["Server-Timing"] = trace.server_timing()
+            await send(message)
+
+        # La traza se cierra cuando termina el body (incluye respuestas SSE)
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            tracing.finish_trace(trace, f"{scope['method']} {scope['path']}")
+
+
+app.add_middleware(TracingMiddleware)
+
+
+rate_limiter = build_rate_limiter(
+    config.RATE_LIMIT_BACKEND,
+    config.RATE_LIMIT_USER_RATE, config.RATE_LIMIT_USER_BURST,
+    config.RATE_LIMIT_IP_RATE, config.RATE_LIMIT_IP_BURST,
+    config.RATE_LIMIT_IDLE_SECONDS,
+    config.RATE_LIMIT_SHARED_PATH, config.RATE_LIMIT_SHARED_SLOTS,
+) if config.RATE_LIMIT_ENABLED else None
+
+
+def _client_ip(conn: HTTPConnection) -> str:
+    if config.RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = conn.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return conn.client.host if conn.client else ""
+
+
+def _check_rate_limit(request: Request, user_id: str):
+    """Rechaza con 429 antes de tocar el almacenamiento o el LLM."""
+    if rate_limiter is None:
+        return
+    allowed, retry_after = rate_limiter.check(user_id, _client_ip(request))
+    if not allowed:
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiados mensajes, espera un momento",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+def _reject_if_draining():
+    if shutdown.draining():
+        raise HTTPException(status_code=503, detail="Servidor reiniciando, intenta de nuevo",
+                            headers={"Retry-After": "5"})
+
+
+def _require_admin(token: str, patient_data: bool = False):
+    """Sin ADMIN_TOKEN, DEBUG solo habilita lo que no expone datos de pacientes (p. ej. perfiles)."""
+    if ADMIN_TOKEN:
+        if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+            raise HTTPException(status_code=403, detail="Token de administrador inválido")
+    elif patient_data or not DEBUG:
+        raise HTTPException(status_code=403, detail="Endpoints de administración deshabilitados (falta ADMIN_TOKEN)")
+
+
 @app.get("/")
 def root():
     return FileResponse(os.path.join(static_dir, "index.html"))
 
 
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    state = warmup.readiness.snapshot()
+    state["draining"] = shutdown.draining()
+    if not state["ready"] or state["draining"]:
+        return JSONResponse(state, status_code=503)
+    return state
+
+
 @app.post("/users", response_model=UserResponse)
 def create_user(req: CreateUserRequest):
     try:
@@ -37,44 +178,229 @@ def create_user(req: CreateUserRequest):
 
 
 @app.post("/chat")
-def chat(req: ChatRequest):
+def chat(req: ChatRequest, request: Request):
+    _reject_if_draining()
+    _check_rate_limit(request, req.user_id)
     if not database.user_exists(req.user_id):
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
-    chatbot = ChatbotService()
-    resp = chatbot.handle_chat(req.user_id, req.message)
+    with tracing.profile_block():
+        chatbot = ChatbotService()
+        resp = chatbot.handle_chat(req.user_id, req.message)
     return resp
 
 
 @app.post("/chat/stream")
-def chat_stream(req: ChatRequest):
+def chat_stream(req: ChatRequest, request: Request):
     """Endpoint con streaming para respuestas en tiempo real."""
+    _reject_if_draining()
+    _check_rate_limit(request, req.user_id)
     if not database.user_exists(req.user_id):
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
     chatbot = ChatbotService()
-    
-    def generate():
-        for chunk in chatbot.handle_chat_stream(req.user_id, req.message):
-            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-        yield "data: [DONE]\n\n"
-    
+    # La respuesta se genera en segundo plano; si el cliente se desconecta
+    # puede reanudarla con GET /chat/stream/{stream_id} y Last-Event-ID.
+    stream = streams.registry.start(
+        req.user_id, req.message,
+        lambda cancel: chatbot.handle_chat_stream(req.user_id, req.message, cancel),
+    )
+    return _sse_response(stream, 0)
+
+
+@app.get("/chat/stream/{stream_id}")
+def resume_chat_stream(stream_id: str, user_id: str, last_event_id: str = Header(default="")):
+    """Reanuda un stream: reenvía los eventos posteriores a Last-Event-ID."""
+    stream = streams.registry.get(stream_id)
+    if stream is None or stream.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Stream no encontrado o expirado")
+    metrics.inc("streams.resumed")
+    return _sse_response(stream, streams.parse_last_event_id(last_event_id, stream_id))
+
+
+def _sse_response(stream, after_seq: int) -> StreamingResponse:
+    async def body():
+        # detach() corre también cuando Starlette corta el body por desconexión
+        closed = stream.attach()
+        try:
+            async for frame in iterate_in_threadpool(stream.frames_after(after_seq, closed)):
+                yield frame
+        finally:
+            stream.detach(closed)
+
     return StreamingResponse(
-        generate(),
+        body(),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
+            "X-Accel-Buffering": "no",
+            "X-Stream-Id": stream.stream_id,
         }
     )
 
 
+@app.websocket("/ws/chat")
+async def ws_chat(websocket: WebSocket, user_id: str):
+    """Chat por WebSocket: el usuario, su estado y la memoria reciente se cargan una vez por conexión.
+
+    Cliente -> servidor: {"message": "..."}
+    Servidor -> cliente: los mismos eventos que /chat/stream y {"type": "end"} al cerrar cada turno.
+    """
+    user = await run_in_threadpool(database.get_user, user_id)
+    if not user:
+        await websocket.close(code=1008, reason="Usuario no encontrado")
+        return
+    await websocket.accept()
+    session = await run_in_threadpool(ChatSession.load, user_id, user)
+    chatbot = await run_in_threadpool(ChatbotService, session)
+
+    turn = None
+    cancel = None
+    try:
+        while True:
+            data = await websocket.receive_json()
+            message = str(data.get("message", "")).strip() if isinstance(data, dict) else ""
+            if not message:
+                await websocket.send_json({"type": "error", "detail": "Mensaje vacío"})
+                continue
+            if shutdown.draining():
+                await websocket.send_json({"type": "error", "status": 503, "detail": "Servidor reiniciando"})
+                await websocket.close(code=1012)
+                return
+            if rate_limiter is not None:
+                allowed, retry_after = rate_limiter.check(user_id, _client_ip(websocket))
+                if not allowed:
+                    await websocket.send_json({"type": "error", "status": 429, "retry_after": math.ceil(retry_after)})
+                    continue
+            cancel = CancelToken()
+            turn = chatbot.handle_chat_stream(user_id, message, cancel)
+            async for chunk in iterate_in_threadpool(turn):
+                await websocket.send_json(chunk)
+            await websocket.send_json({"type": "end"})
+            turn = cancel = None
+    except WebSocketDisconnect:
+        if cancel is not None:
+            # Aborta la llamada al LLM y libera el cupo del LLM de inmediato
+            cancel.cancel("websocket cerrado")
+            await run_in_threadpool(turn.close)
+
+
+def _appointment_filters(date_from: str, date_to: str, specialty: str, status: str) -> dict:
+    for value in (date_from, date_to):
+        if value is not None:
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Fecha inválida: {value} (usa YYYY-MM-DD)")
+    if specialty is not None:
+        specialty = specialties.resolver.find(specialty) or specialty
+    return {"date_from": date_from, "date_to": date_to, "specialty": specialty, "status": status}
+
+
+def _appointments_page(limit: int, cursor: str, **filters) -> dict:
+    try:
+        appts, next_cursor = database.appointments_page(cursor, limit, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"appointments": appts, "next_cursor": next_cursor}
+
+
 @app.get("/appointments/{user_id}")
-def get_appointments(user_id: str):
+def get_appointments(user_id: str, date_from: str = None, date_to: str = None, specialty: str = None,
+                     status: str = None, cursor: str = None,
+                     limit: int = Query(default=config.APPOINTMENTS_PAGE_SIZE, ge=1, le=config.APPOINTMENTS_MAX_PAGE_SIZE)):
+    """Citas del usuario por fecha y hora, paginadas con `next_cursor`."""
     if not database.user_exists(user_id):
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
-    appts = database.get_user_appointments(user_id)
-    return {"user_id": user_id, "appointments": appts}
+    filters = _appointment_filters(date_from, date_to, specialty, status)
+    return {"user_id": user_id, **_appointments_page(limit, cursor, user_id=user_id, **filters)}
+
+
+def _appointment_error(e: ValueError):
+    if isinstance(e, database.AppointmentNotFoundError):
+        raise HTTPException(status_code=404, detail="Cita no encontrada")
+    if isinstance(e, database.SlotTakenError):
+        raise HTTPException(status_code=409, detail="El horario ya está ocupado")
+    raise HTTPException(status_code=409, detail=f"La cita no se puede modificar: {e}")
+
+
+# Cancelar, reprogramar e historial por ID: integraciones (recepción, call
+# center) con el token de administración. El user_id del llamador no basta
+# para autenticar; el paciente gestiona sus citas desde el chat.
+@app.get("/appointments/{appointment_id}/history")
+def get_appointment_history(appointment_id: str, user_id: str, x_admin_token: str = Header(default="")):
+    _require_admin(x_admin_token, patient_data=True)
+    appt = database.get_appointment(appointment_id)
+    if appt is None or appt["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Cita no encontrada")
+    return {"appointment": appt, "history": database.get_appointment_history(appointment_id)}
+
+
+@app.post("/appointments/{appointment_id}/cancel")
+def cancel_appointment(appointment_id: str, req: AppointmentCancelRequest, x_admin_token: str = Header(default="")):
+    _require_admin(x_admin_token, patient_data=True)
+    try:
+        appt = database.cancel_appointment(appointment_id, req.user_id, note=req.reason or "api")
+    except ValueError as e:
+        _appointment_error(e)
+    return {"appointment": appt, "message": "Cita cancelada"}
+
+
+@app.post("/appointments/{appointment_id}/reschedule")
+def reschedule_appointment(appointment_id: str, req: AppointmentRescheduleRequest,
+                           x_admin_token: str = Header(default="")):
+    _require_admin(x_admin_token, patient_data=True)
+    try:
+        date, time = appointment_flow.parse_slot(req.date, req.time)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        appt = database.reschedule_appointment(appointment_id, date, time, req.user_id, note="api")
+    except ValueError as e:
+        _appointment_error(e)
+    return {"appointment": appt, "message": "Cita reprogramada"}
+
+
+@app.get("/metrics")
+def get_metrics():
+    return metrics.snapshot()
+
+
+@app.get("/admin/appointments")
+def admin_appointments(date_from: str = None, date_to: str = None, specialty: str = None, status: str = None,
+                       cursor: str = None, x_admin_token: str = Header(default=""),
+                       limit: int = Query(default=config.APPOINTMENTS_PAGE_SIZE, ge=1, le=config.APPOINTMENTS_MAX_PAGE_SIZE)):
+    """Citas de toda la clínica (p. ej. la agenda del día con date_from=date_to), paginadas."""
+    _require_admin(x_admin_token, patient_data=True)
+    filters = _appointment_filters(date_from, date_to, specialty, status)
+    return _appointments_page(limit, cursor, **filters)
+
+
+@app.get("/admin/appointments/stream")
+def admin_appointments_stream(date_from: str = None, date_to: str = None, specialty: str = None,
+                              status: str = None, x_admin_token: str = Header(default="")):
+    """Exporta las citas filtradas como NDJSON (una cita por línea), leídas por lotes."""
+    _require_admin(x_admin_token, patient_data=True)
+    filters = _appointment_filters(date_from, date_to, specialty, status)
+
+    def lines():
+        for batch in database.iter_appointments(config.APPOINTMENTS_STREAM_BATCH, **filters):
+            yield "".join(json.dumps(appt, ensure_ascii=False) + "\n" for appt in batch)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/admin/profile/latest")
+def latest_profile(x_admin_token: str = Header(default="")):
+    """Devuelve el último perfil agregado en formato folded (flame graph)."""
+    _require_admin(x_admin_token)
+    tracing.profiler.flush()
+    path = tracing.profiler.latest_profile()
+    if not path:
+        raise HTTPException(status_code=404, detail="No hay perfiles guardados")
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    return PlainTextResponse(content, headers={"X-Profile-File": os.path.basename(path)})
 
 
 if __name__ == "__main__":
@@ -6,6 +6,16 @@ def notify_patient(appointment: Dict) -> Dict:
     return {"success": True, "message": message}
 
 
+def remind_patient(appointment: Dict) -> Dict:
+    message = f"Recordatorio enviado para cita {appointment.get('appointment_id')} el {appointment.get('date')} a las {appointment.get('time')}"
+    return {"success": True, "message": message}
+
+
+def offer_slot(offer: Dict) -> Dict:
+    message = f"Horario liberado ofrecido a {offer.get('user_id')}: {offer.get('specialty')} el {offer.get('date')} a las {offer.get('time')} (responde 'acepto' para reservarlo)"
+    return {"success": True, "message": message}
+
+
 def execute_action(action_data: Dict) -> Dict:
     if not action_data:
         return {"success": False, "message": "No action provided"}
@@ -13,4 +23,8 @@ def execute_action(action_data: Dict) -> Dict:
     if cmd == "notify":
         appt = action_data.get("data", {})
         return notify_patient(appt)
+    if cmd == "remind":
+        return remind_patient(action_data.get("data", {}))
+    if cmd == "offer_slot":
+        return offer_slot(action_data.get("data", {}))
     return {"success": False, "message": "Unknown action"}
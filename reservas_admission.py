@@ -0,0 +1,111 @@
+"""
+Control de admisión para llamadas costosas (LLM).
+
+Limita la concurrencia con una cola de espera acotada y ordenada por
+prioridad. Si la cola está llena o se vence el plazo de espera se lanza
+LoadShedError para que el llamador degrade a una respuesta barata (FAQ).
+"""
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+import reservas_metrics as metrics
+
+PRIORITY_HIGH = 0    # usuarios con un flujo de reserva activo
+PRIORITY_NORMAL = 1
+
+
+class LoadShedError(RuntimeError):
+    """La llamada fue descartada por sobrecarga."""
+
+
+class _Waiter:
+    __slots__ = ("event", "granted", "cancelled")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+        self.cancelled = False
+
+
+class AdmissionController:
+    def __init__(self, name: str, max_concurrent: int = 8, max_queue: int = 16, queue_timeout: float = 2.0):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._queued = 0
+        self._heap = []  # (priority, seq, waiter)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._shed = 0
+        self._admitted = 0
+        self._max_wait = 0.0
+        metrics.register_collector(f"admission.{name}", self.snapshot)
+
+    def acquire(self, priority: int = PRIORITY_NORMAL, timeout: float = None) -> bool:
+        """Reserva un cupo; devuelve False si la solicitud debe descartarse."""
+        timeout = self.queue_timeout if timeout is None else timeout
+        with self._lock:
+            if self._active < self.max_concurrent and not self._queued:
+                self._active += 1
+                self._admitted += 1
+                return True
+            if self._queued >= self.max_queue:
+                self._shed += 1
+                return False
+            waiter = _Waiter()
+            heapq.heappush(self._heap, (priority, next(self._seq), waiter))
+            self._queued += 1
+
+        start = time.monotonic()
+        waiter.event.wait(timeout)
+        with self._lock:
+            waited = time.monotonic() - start
+            self._max_wait = max(self._max_wait, waited)
+            if waiter.granted:
+                self._admitted += 1
+                return True
+            # Vencido en la cola: se elimina de forma perezosa
+            waiter.cancelled = True
+            self._queued -= 1
+            self._shed += 1
+            return False
+
+    def release(self):
+        with self._lock:
+            while self._heap:
+                _, _, waiter = heapq.heappop(self._heap)
+                if waiter.cancelled:
+                    continue
+                # El cupo pasa directamente al siguiente en la cola
+                waiter.granted = True
+                self._queued -= 1
+                waiter.event.set()
+                return
+            self._active -= 1
+
+    @contextmanager
+    def slot(self, priority: int = PRIORITY_NORMAL, timeout: float = None):
+        if not self.acquire(priority, timeout):
+            raise LoadShedError(f"Sin cupo en {self.name} (activos={self._active}, en cola={self._queued})")
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "active": self._active,
+                "queued": self._queued,
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "admitted": self._admitted,
+                "shed": self._shed,
+                "max_wait_seconds": round(self._max_wait, 3),
+            }
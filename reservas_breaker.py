@@ -0,0 +1,168 @@
+"""
+Circuit breaker con ventanas móviles y timeouts adaptativos para el LLM.
+
+Estados:
+- closed: las llamadas pasan y se registran en la ventana.
+- open: las llamadas se rechazan hasta que pase `open_seconds`.
+- half_open: se dejan pasar `half_open_probes` llamadas de prueba; si todas
+  salen bien se cierra, si alguna falla vuelve a abrirse.
+"""
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+import reservas_metrics as metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(RuntimeError):
+    """El breaker está abierto y la llamada no se intentó."""
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, window_seconds: float = 60, min_calls: int = 10,
+                 error_rate: float = 0.5, slow_call_seconds: float = 20, slow_rate: float = 0.8,
+                 open_seconds: float = 30, half_open_probes: int = 2,
+                 timeout_default: float = 30, timeout_min: float = 3, timeout_max: float = 120,
+                 timeout_factor: float = 1.5, max_samples: int = 500):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.timeout_default = timeout_default
+        self.timeout_min = timeout_min
+        self.timeout_max = timeout_max
+        self.timeout_factor = timeout_factor
+
+        self._calls = deque(maxlen=max_samples)  # (timestamp, ok, latency)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+        metrics.register_collector(f"breaker.{name}", self.snapshot)
+
+    # --- estado ---
+    def _set_state(self, state: str):
+        if state != self._state:
+            print(f"[breaker {self.name}] {self._state} -> {state}")
+            metrics.inc(f"breaker.{self.name}.transitions.{state}")
+        self._state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state != HALF_OPEN:
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+
+    def _maybe_half_open(self, now: float):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._set_state(HALF_OPEN)
+
+    def _trim(self, now: float):
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            return self._state
+
+    def is_available(self) -> bool:
+        """Indica si una llamada sería aceptada, sin consumir un probe."""
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN:
+                return self._probes_in_flight < self.half_open_probes
+            return False
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                return True
+        metrics.inc(f"breaker.{self.name}.rejected")
+        return False
+
+    # --- resultados ---
+    def record_success(self, latency: float):
+        self._record(True, latency)
+
+    def record_failure(self, latency: float):
+        self._record(False, latency)
+
+    def record_cancelled(self):
+        """La llamada se abandonó sin resultado: libera el probe si lo había."""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes_in_flight > 0:
+                self._probes_in_flight -= 1
+
+    def _record(self, ok: bool, latency: float):
+        now = time.monotonic()
+        with self._lock:
+            self._calls.append((now, ok, latency))
+            self._trim(now)
+            if self._state == HALF_OPEN:
+                if not ok:
+                    self._set_state(OPEN)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_probes:
+                    self._calls.clear()
+                    self._set_state(CLOSED)
+                return
+            if self._state == CLOSED and len(self._calls) >= self.min_calls:
+                failures = sum(1 for _, call_ok, _ in self._calls if not call_ok)
+                slow = sum(1 for _, _, lat in self._calls if lat >= self.slow_call_seconds)
+                total = len(self._calls)
+                if failures / total >= self.error_rate or slow / total >= self.slow_rate:
+                    self._set_state(OPEN)
+
+    # --- timeouts ---
+    def _p99(self) -> float:
+        latencies = sorted(lat for _, ok, lat in self._calls if ok)
+        if len(latencies) < self.min_calls:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+    def timeout(self) -> float:
+        """Deadline por llamada derivado del p99 observado en la ventana."""
+        with self._lock:
+            self._trim(time.monotonic())
+            p99 = self._p99()
+        if not p99:
+            return self.timeout_default
+        return max(self.timeout_min, min(self.timeout_max, p99 * self.timeout_factor))
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            now = time.monotonic()
+            self._maybe_half_open(now)
+            self._trim(now)
+            total = len(self._calls)
+            failures = sum(1 for _, ok, _ in self._calls if not ok)
+            p99 = self._p99()
+            state = self._state
+        return {
+            "state": state,
+            "state_code": _STATE_CODES[state],
+            "calls_in_window": total,
+            "error_rate": round(failures / total, 3) if total else 0.0,
+            "p99_seconds": round(p99, 3),
+            "timeout_seconds": round(self.timeout(), 3),
+        }
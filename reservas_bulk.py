@@ -0,0 +1,282 @@
+"""
+Importación y exportación masiva de citas (migración desde otros sistemas).
+
+La importación lee CSV o NDJSON en streaming, valida cada fila (paciente
+registrado en users.json, especialidad conocida, fecha y hora válidas, estado) y las inserta en
+appointments.db en lotes de IMPORT_BATCH_SIZE, una transacción por lote.
+Los duplicados se detectan con los índices únicos de la base: una cita
+confirmada en un horario ya ocupado (por la base o por una fila anterior
+del archivo) o un appointment_id ya importado se rechaza, así reimportar el
+mismo archivo no duplica nada (las filas sin ID reciben uno derivado de
+paciente, especialidad, horario y estado, estable entre corridas). Las
+filas rechazadas pueden guardarse en NDJSON con el motivo. No se encolan
+avisos a pacientes.
+
+La exportación recorre las citas filtradas por lotes (orden fecha, hora) y
+escribe CSV o NDJSON con las mismas columnas que acepta la importación.
+
+El progreso (filas, rechazos, filas/s) se informa por stderr en cada lote.
+
+Uso:
+    python reservas_bulk.py import agenda_legacy.csv --rejects rechazos.ndjson
+    python reservas_bulk.py import - --format ndjson < citas.ndjson
+    python reservas_bulk.py export citas.csv --date-from 2025-01-01 --status confirmada
+"""
+import argparse
+import csv
+import hashlib
+import json
+import re
+import sys
+import time
+from datetime import date, datetime
+from typing import Dict, Iterator, List, Optional, Set, TextIO, Tuple
+
+import reservas_config as config
+import reservas_database as database
+from reservas_specialties import resolver
+
+STATUSES = (database.STATUS_CONFIRMED, database.STATUS_CANCELLED, database.STATUS_CONFLICT)
+_TIME = re.compile(r"^(\d{1,2}):(\d{2})$")
+
+
+def detect_format(path: str, fmt: Optional[str]) -> str:
+    if fmt:
+        return fmt
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+
+def _open(path: str, mode: str) -> TextIO:
+    if path == "-":
+        return sys.stdin if mode == "r" else sys.stdout
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def iter_rows(f: TextIO, fmt: str) -> Iterator[Tuple[int, Dict]]:
+    """(número de línea, fila) del archivo; una línea NDJSON inválida llega como None."""
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_num, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_num, row if isinstance(row, dict) else None
+
+
+def _parse_date(text: str) -> Optional[str]:
+    try:
+        return date.fromisoformat(text).isoformat()
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(text, "%d/%m/%Y").date().isoformat()
+    except ValueError:
+        return None
+
+
+def _parse_time(text: str) -> Optional[str]:
+    match = _TIME.match(text)
+    if not match:
+        return None
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if hour > 23 or minute > 59:
+        return None
+    return f"{hour:02d}:{minute:02d}"
+
+
+def import_id(record: Dict) -> str:
+    """ID estable para una fila sin appointment_id, con el formato de los generados."""
+    key = "|".join(record[k] for k in ("user_id", "specialty", "date", "time", "status"))
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=5).hexdigest().upper()
+    return f"APPT-{record['date'].replace('-', '')}{record['time'].replace(':', '')}00-{digest}"
+
+
+class RowValidator:
+    """Normaliza una fila al formato de appointments.db o explica por qué no sirve."""
+
+    def __init__(self, users: Set[str]):
+        self._users = users  # una cita de un paciente que no existe quedaría huérfana
+        self._specialties: Dict[str, Optional[str]] = {}  # pocas distintas: se resuelve una vez cada una
+
+    def _specialty(self, text: str) -> Optional[str]:
+        if text not in self._specialties:
+            self._specialties[text] = resolver.find(text)
+        return self._specialties[text]
+
+    def validate(self, row: Optional[Dict]) -> Tuple[Optional[Dict], Optional[str]]:
+        if row is None:
+            return None, "fila ilegible"
+        values = {k: str(v).strip() for k, v in row.items() if k and v is not None}
+        for field in ("user_id", "specialty", "date", "time"):
+            if not values.get(field):
+                return None, f"falta {field}"
+        if values["user_id"] not in self._users:
+            return None, f"usuario desconocido: {values['user_id']}"
+        specialty = self._specialty(values["specialty"])
+        if specialty is None:
+            return None, f"especialidad desconocida: {values['specialty']}"
+        appt_date = _parse_date(values["date"])
+        if appt_date is None:
+            return None, f"fecha inválida: {values['date']}"
+        appt_time = _parse_time(values["time"])
+        if appt_time is None:
+            return None, f"hora inválida: {values['time']}"
+        status = values.get("status") or database.STATUS_CONFIRMED
+        if status not in STATUSES:
+            return None, f"estado inválido: {status}"
+        record = {
+            "user_id": values["user_id"],
+            "patient_name": values.get("patient_name", ""),
+            "specialty": specialty,
+            "date": appt_date,
+            "time": appt_time,
+            "status": status,
+            "created_at": values.get("created_at") or None,
+        }
+        record["appointment_id"] = values.get("appointment_id") or import_id(record)
+        return record, None
+
+
+class Progress:
+    def __init__(self, label: str, out: TextIO = sys.stderr):
+        self.label = label
+        self.out = out
+        self.start = time.perf_counter()
+
+    def rate(self, rows: int) -> float:
+        elapsed = time.perf_counter() - self.start
+        return rows / elapsed if elapsed else 0.0
+
+    def report(self, rows: int, rejected: Optional[int] = None, final: bool = False):
+        elapsed = time.perf_counter() - self.start
+        line = f"{self.label}: {rows} filas"
+        if rejected is not None:
+            line += f", {rejected} rechazadas"
+        line += f", {elapsed:.1f} s, {self.rate(rows):.0f} filas/s"
+        print(line if final else line + "\r", end="\n" if final else "", file=self.out, flush=True)
+
+
+def import_file(path: str, fmt: Optional[str] = None, batch_size: int = None,
+                rejects_path: Optional[str] = None, progress: bool = True) -> Dict:
+    """Importa un archivo de citas; devuelve el resumen (leídas, importadas, rechazadas, filas/s)."""
+    fmt = detect_format(path, fmt)
+    batch_size = batch_size or config.IMPORT_BATCH_SIZE
+    validator = RowValidator(set(database.load_json(database.USERS_FILE)))
+    meter = Progress("importación")
+    stats = {"read": 0, "imported": 0, "rejected": 0, "reasons": {}}
+    rejects = open(rejects_path, "w", encoding="utf-8") if rejects_path else None
+
+    def reject(line_num: int, row: Optional[Dict], reason: str):
+        stats["rejected"] += 1
+        key = reason.split(":")[0]
+        stats["reasons"][key] = stats["reasons"].get(key, 0) + 1
+        if rejects:
+            rejects.write(json.dumps({"line": line_num, "reason": reason, "row": row}, ensure_ascii=False) + "\n")
+
+    def flush(batch: List[Tuple[int, Dict, Dict]]):
+        failed = database.import_appointments([record for _, _, record in batch])
+        for i, reason in failed:
+            line_num, row, _ = batch[i]
+            reject(line_num, row, reason)
+        stats["imported"] += len(batch) - len(failed)
+        if progress:
+            meter.report(stats["read"], stats["rejected"])
+
+    src = _open(path, "r")
+    try:
+        batch = []
+        for line_num, row in iter_rows(src, fmt):
+            stats["read"] += 1
+            record, reason = validator.validate(row)
+            if record is None:
+                reject(line_num, row, reason)
+                continue
+            batch.append((line_num, row, record))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if rejects:
+            rejects.close()
+    stats["rows_per_second"] = round(meter.rate(stats["read"]))
+    if progress:
+        meter.report(stats["read"], stats["rejected"], final=True)
+    return stats
+
+
+def export_file(path: str, fmt: Optional[str] = None, batch_size: int = None,
+                progress: bool = True, **filters) -> Dict:
+    """Exporta las citas filtradas (user_id, date_from, date_to, specialty, status)."""
+    fmt = detect_format(path, fmt)
+    batch_size = batch_size or config.IMPORT_BATCH_SIZE
+    meter = Progress("exportación")
+    exported = 0
+    dst = _open(path, "w")
+    try:
+        writer = None
+        if fmt == "csv":
+            writer = csv.DictWriter(dst, fieldnames=database.APPOINTMENT_COLUMNS, lineterminator="\n")
+            writer.writeheader()
+        for rows in database.iter_appointments(batch_size=batch_size, **filters):
+            if writer:
+                writer.writerows(rows)
+            else:
+                dst.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+            exported += len(rows)
+            if progress:
+                meter.report(exported)
+    finally:
+        if dst is sys.stdout:
+            dst.flush()
+        else:
+            dst.close()
+    if progress:
+        meter.report(exported, final=True)
+    return {"exported": exported, "rows_per_second": round(meter.rate(exported))}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Importación y exportación masiva de citas")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    imp = sub.add_parser("import", help="carga citas desde CSV o NDJSON")
+    imp.add_argument("path", help="archivo de entrada ('-' para stdin)")
+    imp.add_argument("--rejects", help="guarda las filas rechazadas (NDJSON con el motivo)")
+
+    exp = sub.add_parser("export", help="vuelca citas a CSV o NDJSON")
+    exp.add_argument("path", help="archivo de salida ('-' para stdout)")
+    exp.add_argument("--user-id")
+    exp.add_argument("--date-from", help="YYYY-MM-DD")
+    exp.add_argument("--date-to", help="YYYY-MM-DD")
+    exp.add_argument("--specialty")
+    exp.add_argument("--status", choices=STATUSES)
+
+    for p in (imp, exp):
+        p.add_argument("--format", choices=("csv", "ndjson"), help="por defecto según la extensión")
+        p.add_argument("--batch-size", type=int, default=config.IMPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        stats = import_file(args.path, args.format, args.batch_size, args.rejects)
+        if stats["reasons"]:
+            print("Rechazos por motivo: " + ", ".join(f"{k}={v}" for k, v in sorted(stats["reasons"].items())),
+                  file=sys.stderr)
+        return stats
+    filters = {"user_id": args.user_id, "date_from": args.date_from, "date_to": args.date_to,
+               "specialty": args.specialty, "status": args.status}
+    return export_file(args.path, args.format, args.batch_size, **filters)
+
+
+if __name__ == "__main__":
+    main()
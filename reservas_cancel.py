@@ -0,0 +1,49 @@
+"""
+Token de cancelación compartido entre hilos.
+
+Quien produce trabajo cancelable (ej: la lectura del stream de Gemini)
+registra un callback que aborta la operación bloqueante; quien consume
+llama a cancel() cuando ya no necesita el resultado.
+"""
+import threading
+from typing import Callable, List
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self.reason = ""
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = ""):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception as e:
+                print(f"Error en callback de cancelación: {e}")
+
+    def add_callback(self, cb: Callable[[], None]):
+        """Registra cb; si ya estaba cancelado se ejecuta de inmediato."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(cb)
+                return
+        cb()
+
+    def remove_callback(self, cb: Callable[[], None]):
+        with self._lock:
+            if cb in self._callbacks:
+                self._callbacks.remove(cb)
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._event.wait(timeout)
@@ -6,3 +6,145 @@ load_dotenv()
 APP_NAME = os.getenv("APP_NAME", "ReservasMedicas")
 DEBUG = os.getenv("DEBUG", "true").lower() in ("1", "true", "yes")
 DATA_DIR = os.getenv("DATA_DIR", os.path.join(os.path.dirname(__file__), "data"))
+
+# Endpoints /admin: los que devuelven datos de pacientes (agenda, export) exigen
+# siempre el token; sin token, DEBUG solo habilita el resto (perfiles)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Trazas y profiling (opt-in)
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_FLUSH_EVERY = int(os.getenv("PROFILE_FLUSH_EVERY", "10"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(DATA_DIR, "profiles"))
+
+# Circuit breaker y timeouts adaptativos del LLM
+LLM_BREAKER_WINDOW_SECONDS = float(os.getenv("LLM_BREAKER_WINDOW_SECONDS", "60"))
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "10"))
+LLM_BREAKER_ERROR_RATE = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5"))
+LLM_BREAKER_SLOW_SECONDS = float(os.getenv("LLM_BREAKER_SLOW_SECONDS", "20"))
+LLM_BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+LLM_BREAKER_HALF_OPEN_PROBES = int(os.getenv("LLM_BREAKER_HALF_OPEN_PROBES", "2"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_TIMEOUT_DEFAULT = float(os.getenv("LLM_TIMEOUT_DEFAULT", "30"))
+LLM_TIMEOUT_MIN = float(os.getenv("LLM_TIMEOUT_MIN", "3"))
+LLM_TIMEOUT_MAX = float(os.getenv("LLM_TIMEOUT_MAX", "120"))
+
+# Control de admisión de llamadas al LLM
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "16"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "2"))
+# Umbral FAQ relajado cuando se descarta una llamada al LLM por sobrecarga
+LLM_SHED_FAQ_THRESHOLD = float(os.getenv("LLM_SHED_FAQ_THRESHOLD", "0.35"))
+
+# Especialidades y alias (JSON) para el resolver tolerante a typos
+SPECIALTIES_FILE = os.getenv("SPECIALTIES_FILE", os.path.join(os.path.dirname(__file__), "specialties.json"))
+
+# Proveedores de LLM candidatos (gemini, openai, offline); se usa el más rápido disponible
+LLM_PROVIDERS = os.getenv("LLM_PROVIDERS", "gemini")
+# Latencia simulada por fragmento del proveedor offline
+OFFLINE_LLM_TOKEN_DELAY_MS = float(os.getenv("OFFLINE_LLM_TOKEN_DELAY_MS", "0"))
+
+# Rate limiting de /chat (token bucket por usuario y por IP)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # memory | shared
+RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", "1"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "10"))
+RATE_LIMIT_IP_RATE = float(os.getenv("RATE_LIMIT_IP_RATE", "5"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "30"))
+RATE_LIMIT_IDLE_SECONDS = float(os.getenv("RATE_LIMIT_IDLE_SECONDS", "600"))
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() in ("1", "true", "yes")
+RATE_LIMIT_SHARED_PATH = os.getenv(
+    "RATE_LIMIT_SHARED_PATH",
+    "/dev/shm/reservas_ratelimit.bin" if os.path.isdir("/dev/shm") else os.path.join(DATA_DIR, "ratelimit.bin"),
+)
+RATE_LIMIT_SHARED_SLOTS = int(os.getenv("RATE_LIMIT_SHARED_SLOTS", "65536"))
+
+# Streams SSE reanudables
+STREAM_BUFFER_EVENTS = int(os.getenv("STREAM_BUFFER_EVENTS", "1024"))
+STREAM_TTL_SECONDS = float(os.getenv("STREAM_TTL_SECONDS", "120"))
+STREAM_MAX_PRODUCERS = int(os.getenv("STREAM_MAX_PRODUCERS", "32"))
+STREAM_CHECKPOINT_CHARS = int(os.getenv("STREAM_CHECKPOINT_CHARS", "200"))
+STREAM_CHECKPOINT_SECONDS = float(os.getenv("STREAM_CHECKPOINT_SECONDS", "1"))
+# Tiempo que se espera una reconexión antes de cancelar la llamada a Gemini
+STREAM_RESUME_GRACE_SECONDS = float(os.getenv("STREAM_RESUME_GRACE_SECONDS", "10"))
+# Agrupación de fragmentos del stream: se emite al llegar a N caracteres o tras el retardo máximo
+STREAM_COALESCE_CHARS = int(os.getenv("STREAM_COALESCE_CHARS", "64"))
+STREAM_COALESCE_MAX_DELAY_MS = float(os.getenv("STREAM_COALESCE_MAX_DELAY_MS", "40"))
+
+# Router FAQ / flow / Gemini: se elige la ruta adecuada (confianza >= mínimo) más barata,
+# con score = costo + peso_latencia * latencia esperada (s)
+ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.6"))
+ROUTER_LATENCY_WEIGHT = float(os.getenv("ROUTER_LATENCY_WEIGHT", "0.5"))
+ROUTER_LLM_COST = float(os.getenv("ROUTER_LLM_COST", "1"))
+ROUTER_LLM_INFO_CONFIDENCE = float(os.getenv("ROUTER_LLM_INFO_CONFIDENCE", "0.85"))
+ROUTER_LLM_GENERAL_CONFIDENCE = float(os.getenv("ROUTER_LLM_GENERAL_CONFIDENCE", "0.75"))
+ROUTER_FALLBACK_CONFIDENCE = float(os.getenv("ROUTER_FALLBACK_CONFIDENCE", "0.3"))
+ROUTER_LLM_LATENCY_PRIOR = float(os.getenv("ROUTER_LLM_LATENCY_PRIOR", "1.5"))
+# Registro de decisiones del router (para ajustar offline): apagado por defecto,
+# se escribe en segundo plano, con muestreo y rotación por tamaño
+ROUTER_LOG_ENABLED = os.getenv("ROUTER_LOG_ENABLED", "false").lower() in ("1", "true", "yes")
+ROUTER_LOG_PATH = os.getenv("ROUTER_LOG_PATH", os.path.join(DATA_DIR, "router_decisions.ndjson"))
+ROUTER_LOG_SAMPLE_RATE = float(os.getenv("ROUTER_LOG_SAMPLE_RATE", "1.0"))
+ROUTER_LOG_MAX_BYTES = int(os.getenv("ROUTER_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+ROUTER_LOG_BACKUPS = int(os.getenv("ROUTER_LOG_BACKUPS", "5"))
+# Modo especulativo: Gemini arranca en paralelo con el FAQ; un FAQ con similitud
+# >= ROUTER_SPECULATIVE_FAQ_CONFIDENT lo cancela, y si Gemini no responde dentro
+# del presupuesto del turno gana el FAQ (si hay respuesta)
+ROUTER_SPECULATIVE = os.getenv("ROUTER_SPECULATIVE", "false").lower() in ("1", "true", "yes")
+ROUTER_SPECULATIVE_FAQ_CONFIDENT = float(os.getenv("ROUTER_SPECULATIVE_FAQ_CONFIDENT", "0.85"))
+ROUTER_TURN_BUDGET_SECONDS = float(os.getenv("ROUTER_TURN_BUDGET_SECONDS", "2.5"))
+
+# Contexto del LLM: caché en memoria por usuario, recortada por tokens aproximados
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "400"))
+CONTEXT_WINDOW_MESSAGES = int(os.getenv("CONTEXT_WINDOW_MESSAGES", "32"))
+CONTEXT_CACHE_USERS = int(os.getenv("CONTEXT_CACHE_USERS", "10000"))
+
+# Warm-up al arrancar: en segundo plano (/readyz da 503 hasta terminar) o bloqueando el arranque
+WARMUP_BLOCKING = os.getenv("WARMUP_BLOCKING", "false").lower() in ("1", "true", "yes")
+# Abre una conexión con cada proveedor de LLM configurado durante el warm-up
+WARMUP_LLM_CONNECT = os.getenv("WARMUP_LLM_CONNECT", "true").lower() in ("1", "true", "yes")
+
+# Apagado ordenado: espera a los streams activos y luego los cancela guardando el turno parcial
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+SHUTDOWN_CANCEL_GRACE_SECONDS = float(os.getenv("SHUTDOWN_CANCEL_GRACE_SECONDS", "3"))
+# Empieza a drenar (readiness en 503) apenas llega SIGTERM/SIGINT
+SHUTDOWN_HOOK_SIGNALS = os.getenv("SHUTDOWN_HOOK_SIGNALS", "true").lower() in ("1", "true", "yes")
+
+# Retención temporal del horario elegido hasta confirmar, y vencimiento de flujos a medias
+SLOT_HOLD_SECONDS = float(os.getenv("SLOT_HOLD_SECONDS", "300"))
+SESSION_IDLE_SECONDS = float(os.getenv("SESSION_IDLE_SECONDS", "1800"))
+HOLD_WHEEL_TICK_SECONDS = float(os.getenv("HOLD_WHEEL_TICK_SECONDS", "1"))
+
+# Lista de espera: los horarios liberados se reasignan en lotes (ráfagas de cancelaciones)
+WAITLIST_BATCH_SIZE = int(os.getenv("WAITLIST_BATCH_SIZE", "200"))
+WAITLIST_BATCH_WAIT_MS = float(os.getenv("WAITLIST_BATCH_WAIT_MS", "50"))
+
+# Outbox de avisos a pacientes (confirmación, cancelación, reprogramación)
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "true").lower() in ("1", "true", "yes")
+# actions: reservas_actions.execute_action | fake: solo registra (pruebas locales)
+OUTBOX_SENDER = os.getenv("OUTBOX_SENDER", "actions")
+OUTBOX_FAKE_FAIL_RATE = float(os.getenv("OUTBOX_FAKE_FAIL_RATE", "0"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+# Un aviso tomado por un worker que muere vuelve a la cola tras este tiempo
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "30"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_BASE_SECONDS = float(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "2"))
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "300"))
+
+# Recordatorios de citas: se encolan en el outbox REMINDER_LEAD_HOURS antes de la cita
+REMINDERS_ENABLED = os.getenv("REMINDERS_ENABLED", "true").lower() in ("1", "true", "yes")
+REMINDER_LEAD_HOURS = float(os.getenv("REMINDER_LEAD_HOURS", "24"))
+# El heap en memoria solo guarda los recordatorios que vencen dentro de esta ventana
+REMINDER_WINDOW_HOURS = float(os.getenv("REMINDER_WINDOW_HOURS", "6"))
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "500"))
+
+# Consulta de citas: tamaño de página (cursor) y lote de lectura del export NDJSON
+APPOINTMENTS_PAGE_SIZE = int(os.getenv("APPOINTMENTS_PAGE_SIZE", "50"))
+APPOINTMENTS_MAX_PAGE_SIZE = int(os.getenv("APPOINTMENTS_MAX_PAGE_SIZE", "500"))
+APPOINTMENTS_STREAM_BATCH = int(os.getenv("APPOINTMENTS_STREAM_BATCH", "1000"))
+
+# Importación/exportación masiva (reservas_bulk.py): filas por transacción y por lectura
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
@@ -1,24 +1,34 @@
+import base64
 import json
 import os
+import sqlite3
+import threading
+import time as _time
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+from reservas_tracing import traced
 
 BASE_DIR = os.path.dirname(__file__)
 DATA_DIR = os.path.join(BASE_DIR, "data")
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
+# Formato anterior de las citas: se migra a appointments.db al abrirla
 APPTS_FILE = os.path.join(DATA_DIR, "appointments.json")
 CHATS_FILE = os.path.join(DATA_DIR, "chats.json")
 
 
+@traced("db.ensure_data")
 def ensure_data():
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
-    for p in [USERS_FILE, APPTS_FILE, CHATS_FILE]:
+    for p in [USERS_FILE, CHATS_FILE]:
         if not os.path.exists(p):
             with open(p, "w", encoding="utf-8") as f:
                 json.dump({}, f, ensure_ascii=False, indent=2)
 
 
+@traced("db.load_json")
 def load_json(path: str) -> Dict:
     ensure_data()
     try:
@@ -28,6 +38,7 @@ def load_json(path: str) -> Dict:
         return {}
 
 
+@traced("db.save_json")
 def save_json(path: str, data: Dict):
     ensure_data()
     with open(path, "w", encoding="utf-8") as f:
@@ -35,6 +46,7 @@ def save_json(path: str, data: Dict):
 
 
 # Users
+@traced("db.create_user")
 def create_user(user_id: str, name: str) -> Dict:
     users = load_json(USERS_FILE)
     if user_id in users:
@@ -45,25 +57,30 @@ def create_user(user_id: str, name: str) -> Dict:
     return user
 
 
+@traced("db.get_user")
 def get_user(user_id: str) -> Optional[Dict]:
     users = load_json(USERS_FILE)
     return users.get(user_id)
 
 
+@traced("db.user_exists")
 def user_exists(user_id: str) -> bool:
     return get_user(user_id) is not None
 
 
+@traced("db.set_user_state")
 def set_user_state(user_id: str, state: str, pending: Dict = None):
     users = load_json(USERS_FILE)
     if user_id not in users:
         raise ValueError("user not found")
     users[user_id]["state"] = state
     users[user_id]["pending"] = pending or {}
+    users[user_id]["updated_at"] = datetime.now().isoformat()
     save_json(USERS_FILE, users)
 
 
 # Chats helpers
+@traced("db.get_chat_messages")
 def get_chat_messages(user_id: str) -> List[Dict]:
     chats = load_json(CHATS_FILE)
     chat = chats.get(user_id)
@@ -72,6 +89,7 @@ def get_chat_messages(user_id: str) -> List[Dict]:
     return chat.get("messages", [])
 
 
+@traced("db.add_message_to_chat")
 def add_message_to_chat(user_id: str, role: str, content: str):
     chats = load_json(CHATS_FILE)
     if user_id not in chats:
@@ -82,17 +100,668 @@ def add_message_to_chat(user_id: str, role: str, content: str):
     save_json(CHATS_FILE, chats)
 
 
-# Appointments
-def save_appointment(appt: Dict) -> str:
-    appts = load_json(APPTS_FILE)
-    appt_id = f"APPT-{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    record = {"appointment_id": appt_id, "created_at": datetime.now().isoformat(), **appt}
-    appts[appt_id] = record
-    save_json(APPTS_FILE, appts)
-    return appt_id
+@traced("db.add_messages_to_chat")
+def add_messages_to_chat(user_id: str, messages: List[Dict]):
+    """Agrega varios mensajes ({role, content}) con una sola lectura/escritura."""
+    chats = load_json(CHATS_FILE)
+    if user_id not in chats:
+        chats[user_id] = {"user_id": user_id, "messages": []}
+
+    now = datetime.now().isoformat()
+    for m in messages:
+        chats[user_id]["messages"].append({"role": m["role"], "content": m["content"], "timestamp": now})
+    save_json(CHATS_FILE, chats)
+
+
+# Appointments (SQLite)
+# Las citas viven en appointments.db: búsqueda por ID e índice por usuario,
+# y el índice único parcial sobre (especialidad, fecha, hora) de las citas
+# confirmadas hace que reservar un horario ocupado falle dentro de la misma
+# transacción, y que cancelar lo libere al cambiar el estado.
+STATUS_CONFIRMED = "confirmada"
+STATUS_CANCELLED = "cancelada"
+# Cita migrada que chocaba con otra confirmada en el mismo horario
+STATUS_CONFLICT = "conflicto"
+WAITLIST_WAITING = "esperando"
+WAITLIST_OFFERED = "ofrecida"
+WAITLIST_ACCEPTED = "aceptada"
+# Oferta sin respuesta dentro de SLOT_HOLD_SECONDS: el horario pasa al siguiente
+WAITLIST_EXPIRED = "vencida"
+OUTBOX_PENDING = "pendiente"
+OUTBOX_SENT = "enviada"
+OUTBOX_FAILED = "fallida"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS appointments (
+    appointment_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    patient_name TEXT NOT NULL DEFAULT '',
+    specialty TEXT NOT NULL,
+    date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_appointments_user ON appointments(user_id, date, time);
+CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments(date, time);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_appointments_slot
+    ON appointments(specialty, date, time) WHERE status = 'confirmada';
+CREATE TABLE IF NOT EXISTS appointment_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    appointment_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    changed_at TEXT NOT NULL,
+    note TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_history_appointment ON appointment_history(appointment_id, id);
+CREATE TABLE IF NOT EXISTS waitlist (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    patient_name TEXT NOT NULL DEFAULT '',
+    specialty TEXT NOT NULL,
+    date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    offered_time TEXT NOT NULL DEFAULT '',
+    offered_at TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_waitlist_queue ON waitlist(specialty, date, status, id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_waitlist_user
+    ON waitlist(user_id, specialty, date) WHERE status = 'esperando';
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    event TEXT NOT NULL,
+    appointment_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    locked_until REAL NOT NULL DEFAULT 0,
+    sent_at REAL,
+    last_error TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at);
+"""
+APPOINTMENT_COLUMNS = ("appointment_id", "user_id", "patient_name", "specialty", "date", "time",
+                       "status", "created_at", "updated_at")
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = set()
+_slot_listeners: List[Callable[[str, str, str], None]] = []
+_outbox_listeners: List[Callable[[], None]] = []
+_write_listeners: List[Callable[[Dict], None]] = []
+
+
+class AppointmentNotFoundError(ValueError):
+    pass
+
+
+class SlotTakenError(ValueError):
+    """El horario (especialidad, fecha, hora) ya tiene una cita confirmada."""
+
+
+def _appts_db_path() -> str:
+    return os.path.join(DATA_DIR, "appointments.db")
+
+
+def _connect() -> sqlite3.Connection:
+    """Conexión por hilo (sqlite3 no comparte conexiones entre hilos)."""
+    path = _appts_db_path()
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.path == path:
+        return conn
+    ensure_data()
+    # Autocommit: las transacciones se abren explícitamente con appointments_tx()
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with _schema_lock:
+        if path not in _schema_ready:
+            conn.executescript(_SCHEMA)
+            _migrate_json_appointments(conn)
+            _schema_ready.add(path)
+    _local.conn, _local.path = conn, path
+    return conn
+
+
+def on_slot_freed(callback: Callable[[str, str, str], None]):
+    """callback(especialidad, fecha, hora) después de que una cancelación o
+    reprogramación libera un horario (ya confirmada la transacción)."""
+    _slot_listeners.append(callback)
+
+
+def on_appointment_written(callback: Callable[[Dict], None]):
+    """callback(cita) después de crear, cancelar o reprogramar una cita (ya confirmada la transacción)."""
+    _write_listeners.append(callback)
+
+
+def _appointment_written(appt: Dict):
+    for callback in _write_listeners:
+        try:
+            callback(appt)
+        except Exception as e:
+            print(f"Error notificando cambio de cita: {e}")
+
+
+def on_outbox_enqueued(callback: Callable[[], None]):
+    """callback() cuando se confirma una transacción que encoló avisos en el outbox."""
+    _outbox_listeners.append(callback)
+
+
+def _outbox_enqueued():
+    for callback in _outbox_listeners:
+        callback()
+
+
+def _slot_freed(specialty: str, date: str, time: str):
+    for callback in _slot_listeners:
+        try:
+            callback(specialty, date, time)
+        except Exception as e:
+            print(f"Error notificando horario liberado: {e}")
+
+
+@contextmanager
+def appointments_tx():
+    """Transacción de escritura (BEGIN IMMEDIATE) sobre appointments.db."""
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _migrate_json_appointments(conn: sqlite3.Connection):
+    """Importa una sola vez el appointments.json anterior y lo renombra."""
+    if not os.path.exists(APPTS_FILE):
+        return
+    legacy = load_json(APPTS_FILE)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for appt in legacy.values():
+            record = _new_record(appt, appt.get("appointment_id"), appt.get("created_at"))
+            try:
+                _insert(conn, record)
+            except sqlite3.IntegrityError:
+                # Dos citas confirmadas en el mismo horario: se conserva la segunda marcada
+                record["status"] = STATUS_CONFLICT
+                _insert(conn, record)
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    os.replace(APPTS_FILE, APPTS_FILE + ".migrated")
+    print(f"Migradas {len(legacy)} citas de appointments.json a SQLite")
+
+
+def _new_appointment_id() -> str:
+    return f"APPT-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:10].upper()}"
+
+
+def _new_record(appt: Dict, appt_id: str = None, created_at: str = None) -> Dict:
+    now = datetime.now().isoformat()
+    return {
+        "appointment_id": appt_id or _new_appointment_id(),
+        "user_id": appt.get("user_id", ""),
+        "patient_name": appt.get("patient_name") or "",
+        "specialty": appt.get("specialty", ""),
+        "date": appt.get("date", ""),
+        "time": appt.get("time", ""),
+        "status": appt.get("status") or STATUS_CONFIRMED,
+        "created_at": created_at or now,
+        "updated_at": now,
+    }
+
+
+def _insert(conn: sqlite3.Connection, record: Dict) -> int:
+    conn.execute("INSERT INTO appointments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 [record[c] for c in APPOINTMENT_COLUMNS])
+    return _add_history(conn, record["appointment_id"], record["status"], record["date"], record["time"], "creada")
+
+
+@traced("db.import_appointments")
+def import_appointments(records: List[Dict], note: str = "importada") -> List[Tuple[int, str]]:
+    """Inserta un lote de citas ya validadas en una sola transacción.
+
+    Devuelve (índice en el lote, motivo) de las rechazadas: ID ya existente
+    (reimportar el mismo archivo no duplica) u horario ocupado por otra cita
+    confirmada, de la base o de una fila anterior del mismo archivo. El ID
+    se comprueba antes que el horario: una fila reimportada se informa como
+    duplicada aunque su horario también choque. No encola avisos: una
+    migración no debe escribirle a los pacientes.
+    """
+    rejected = []
+    history = []
+    changed_at = datetime.now().isoformat()
+    with appointments_tx() as conn:
+        seen = _existing_ids(conn, [appt["appointment_id"] for appt in records if appt.get("appointment_id")])
+        for i, appt in enumerate(records):
+            record = _new_record(appt, appt.get("appointment_id"), appt.get("created_at"))
+            if record["appointment_id"] in seen:
+                rejected.append((i, "ID duplicado"))
+                continue
+            try:
+                conn.execute("INSERT INTO appointments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             [record[c] for c in APPOINTMENT_COLUMNS])
+            except sqlite3.IntegrityError as e:
+                rejected.append((i, "ID duplicado" if "appointment_id" in str(e) else "horario ocupado"))
+                continue
+            seen.add(record["appointment_id"])
+            history.append((record["appointment_id"], record["status"], record["date"], record["time"], changed_at, note))
+        conn.executemany(
+            "INSERT INTO appointment_history (appointment_id, status, date, time, changed_at, note) VALUES (?, ?, ?, ?, ?, ?)",
+            history,
+        )
+    return rejected
+
+
+# Listas IN (...) por tandas: SQLite limita los parámetros por consulta
+# (999 en versiones anteriores a 3.32)
+IN_CHUNK = 500
+
+
+def _chunks(ids: List[str], size: int = IN_CHUNK) -> Iterator[List[str]]:
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _existing_ids(conn: sqlite3.Connection, appt_ids: List[str]) -> Set[str]:
+    """IDs de `appt_ids` que ya están en appointments."""
+    found = set()
+    for ids in _chunks(appt_ids):
+        rows = conn.execute(
+            f"SELECT appointment_id FROM appointments WHERE appointment_id IN ({','.join('?' * len(ids))})", ids
+        ).fetchall()
+        found.update(row[0] for row in rows)
+    return found
+
+
+def _add_history(conn: sqlite3.Connection, appt_id: str, status: str, date: str, time: str, note: str = "") -> int:
+    cursor = conn.execute(
+        "INSERT INTO appointment_history (appointment_id, status, date, time, changed_at, note) VALUES (?, ?, ?, ?, ?, ?)",
+        (appt_id, status, date, time, datetime.now().isoformat(), note),
+    )
+    return cursor.lastrowid
+
+
+def _enqueue_notification(conn: sqlite3.Connection, event: str, appt: Dict, key: str) -> bool:
+    """Encola el aviso al paciente en la misma transacción que el cambio de la cita.
+
+    La clave de idempotencia identifica el cambio (p. ej. la fila del
+    historial): el envío puede reintentarse, o volver a encolarse, sin que
+    el paciente reciba el aviso dos veces. Devuelve False si ya existía.
+    """
+    now = _time.time()
+    payload = {c: appt.get(c) for c in APPOINTMENT_COLUMNS}
+    payload["event"] = event
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO outbox (idempotency_key, event, appointment_id, payload, status, created_at, next_attempt_at)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (key, event, appt["appointment_id"], json.dumps(payload, ensure_ascii=False), OUTBOX_PENDING, now, now),
+    )
+    return cursor.rowcount > 0
 
 
+def _row(row: Optional[sqlite3.Row]) -> Optional[Dict]:
+    return dict(row) if row is not None else None
+
+
+@traced("db.save_appointment")
+def save_appointment(appt: Dict, waitlist_id: int = None) -> str:
+    """Guarda la cita; si viene de una oferta de la lista de espera, la entrada pasa a aceptada en la misma transacción."""
+    record = _new_record(appt)
+    while True:
+        try:
+            with appointments_tx() as conn:
+                history_id = _insert(conn, record)
+                if waitlist_id is not None:
+                    conn.execute("UPDATE waitlist SET status = ? WHERE id = ? AND user_id = ? AND status = ?",
+                                 (WAITLIST_ACCEPTED, waitlist_id, record["user_id"], WAITLIST_OFFERED))
+                _enqueue_notification(conn, "confirmada", record, f"{record['appointment_id']}:{history_id}")
+            break
+        except sqlite3.IntegrityError as e:
+            if "appointment_id" not in str(e):
+                raise SlotTakenError("slot taken")
+            # Colisión de ID (muy improbable): se reintenta con otro
+            record["appointment_id"] = _new_appointment_id()
+    _outbox_enqueued()
+    _appointment_written(record)
+    return record["appointment_id"]
+
+
+@traced("db.get_appointment")
+def get_appointment(appt_id: str) -> Optional[Dict]:
+    row = _connect().execute("SELECT * FROM appointments WHERE appointment_id = ?", (appt_id,)).fetchone()
+    return _row(row)
+
+
+@traced("db.get_appointments")
+def get_appointments(appt_ids: List[str]) -> Dict[str, Dict]:
+    """Citas por ID (una consulta por tanda de IN_CHUNK), indexadas por appointment_id."""
+    conn = _connect()
+    found = {}
+    for ids in _chunks(list(appt_ids)):
+        rows = conn.execute(
+            f"SELECT * FROM appointments WHERE appointment_id IN ({','.join('?' * len(ids))})", ids
+        ).fetchall()
+        found.update((row["appointment_id"], dict(row)) for row in rows)
+    return found
+
+
+@traced("db.upcoming_appointments")
+def upcoming_appointments(start_date: str, end_date: str) -> List[Dict]:
+    """Citas confirmadas con fecha entre start_date y end_date (inclusive), por fecha y hora."""
+    rows = _connect().execute(
+        "SELECT * FROM appointments WHERE date BETWEEN ? AND ? AND status = ? ORDER BY date, time",
+        (start_date, end_date, STATUS_CONFIRMED),
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+@traced("db.get_user_appointments")
 def get_user_appointments(user_id: str) -> List[Dict]:
-    appts = load_json(APPTS_FILE)
-    result = [v for v in appts.values() if v.get("user_id") == user_id]
-    return result
+    rows = _connect().execute(
+        "SELECT * FROM appointments WHERE user_id = ? ORDER BY date, time", (user_id,)
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def encode_cursor(appt: Dict) -> str:
+    """Cursor opaco de paginación: posición (fecha, hora, ID) de la última cita devuelta."""
+    key = f"{appt['date']}|{appt['time']}|{appt['appointment_id']}"
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str, str]:
+    try:
+        key = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        date, time, appt_id = key.split("|")
+    except ValueError:
+        raise ValueError("cursor inválido")
+    return date, time, appt_id
+
+
+@traced("db.query_appointments")
+def query_appointments(user_id: str = None, date_from: str = None, date_to: str = None,
+                       specialty: str = None, status: str = None,
+                       after: Tuple[str, str, str] = None, limit: int = 50) -> List[Dict]:
+    """Citas filtradas en orden (fecha, hora, ID), desde la posición `after` (keyset).
+
+    Con user_id usa el índice por usuario; sin él, el índice (date, time), así
+    la agenda de un día se lee por rango sin recorrer la tabla.
+    """
+    where, params = [], []
+    for column, op, value in (("user_id", "=", user_id), ("date", ">=", date_from), ("date", "<=", date_to),
+                              ("specialty", "=", specialty), ("status", "=", status)):
+        if value is not None:
+            where.append(f"{column} {op} ?")
+            params.append(value)
+    if after is not None:
+        where.append("(date, time, appointment_id) > (?, ?, ?)")
+        params.extend(after)
+    sql = "SELECT * FROM appointments"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY date, time, appointment_id LIMIT ?"
+    rows = _connect().execute(sql, params + [limit]).fetchall()
+    return [dict(r) for r in rows]
+
+
+@traced("db.appointments_page")
+def appointments_page(cursor: str = None, limit: int = 50, **filters) -> Tuple[List[Dict], Optional[str]]:
+    """Una página de citas y el cursor de la siguiente (None si no hay más)."""
+    after = decode_cursor(cursor) if cursor else None
+    rows = query_appointments(after=after, limit=limit + 1, **filters)
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+@traced("db.iter_appointments")
+def iter_appointments(batch_size: int = 1000, **filters) -> Iterator[List[Dict]]:
+    """Recorre las citas filtradas en lotes, una consulta por lote (nunca todas en memoria).
+
+    Cada lote abre (o reutiliza) la conexión del hilo que lo pide, así el
+    generador puede consumirse desde distintos hilos (StreamingResponse).
+    """
+    after = None
+    while True:
+        rows = query_appointments(after=after, limit=batch_size, **filters)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        last = rows[-1]
+        after = (last["date"], last["time"], last["appointment_id"])
+
+
+@traced("db.is_slot_free")
+def is_slot_free(specialty: str, date: str, time: str) -> bool:
+    row = _connect().execute(
+        "SELECT 1 FROM appointments WHERE specialty = ? AND date = ? AND time = ? AND status = ?",
+        (specialty, date, time, STATUS_CONFIRMED),
+    ).fetchone()
+    return row is None
+
+
+def _get_for_update(conn: sqlite3.Connection, appt_id: str, user_id: str = None) -> Dict:
+    appt = _row(conn.execute("SELECT * FROM appointments WHERE appointment_id = ?", (appt_id,)).fetchone())
+    if appt is None or (user_id is not None and appt["user_id"] != user_id):
+        raise AppointmentNotFoundError("appointment not found")
+    if appt["status"] != STATUS_CONFIRMED:
+        raise ValueError(f"appointment is {appt['status']}")
+    return appt
+
+
+@traced("db.cancel_appointment")
+def cancel_appointment(appt_id: str, user_id: str = None, note: str = "") -> Dict:
+    """Cancela una cita confirmada; el horario queda libre en la misma transacción."""
+    with appointments_tx() as conn:
+        appt = _get_for_update(conn, appt_id, user_id)
+        now = datetime.now().isoformat()
+        conn.execute("UPDATE appointments SET status = ?, updated_at = ? WHERE appointment_id = ?",
+                     (STATUS_CANCELLED, now, appt_id))
+        history_id = _add_history(conn, appt_id, STATUS_CANCELLED, appt["date"], appt["time"], note)
+        appt.update(status=STATUS_CANCELLED, updated_at=now)
+        _enqueue_notification(conn, STATUS_CANCELLED, appt, f"{appt_id}:{history_id}")
+    _outbox_enqueued()
+    _appointment_written(appt)
+    _slot_freed(appt["specialty"], appt["date"], appt["time"])
+    return appt
+
+
+@traced("db.reschedule_appointment")
+def reschedule_appointment(appt_id: str, date: str, time: str, user_id: str = None, note: str = "") -> Dict:
+    """Mueve una cita confirmada a otra fecha/hora; falla con SlotTakenError si está ocupada."""
+    try:
+        with appointments_tx() as conn:
+            appt = _get_for_update(conn, appt_id, user_id)
+            now = datetime.now().isoformat()
+            conn.execute("UPDATE appointments SET date = ?, time = ?, updated_at = ? WHERE appointment_id = ?",
+                         (date, time, now, appt_id))
+            previous = f"{appt['date']} {appt['time']}"
+            history_id = _add_history(conn, appt_id, "reprogramada", date, time, note or f"antes: {previous}")
+            _enqueue_notification(conn, "reprogramada", dict(appt, date=date, time=time, updated_at=now),
+                                  f"{appt_id}:{history_id}")
+    except sqlite3.IntegrityError:
+        raise SlotTakenError("slot taken")
+    _outbox_enqueued()
+    _slot_freed(appt["specialty"], appt["date"], appt["time"])
+    appt.update(date=date, time=time, updated_at=now)
+    _appointment_written(appt)
+    return appt
+
+
+@traced("db.get_appointment_history")
+def get_appointment_history(appt_id: str) -> List[Dict]:
+    rows = _connect().execute(
+        "SELECT status, date, time, changed_at, note FROM appointment_history WHERE appointment_id = ? ORDER BY id",
+        (appt_id,),
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+# Lista de espera por (especialidad, fecha): cola FIFO sobre el índice
+# (specialty, date, status, id), así encolar y tomar los siguientes es O(log n).
+@traced("db.join_waitlist")
+def join_waitlist(user_id: str, patient_name: str, specialty: str, date: str) -> Dict:
+    """Anota al paciente (idempotente) y devuelve la entrada con su posición en la cola."""
+    with appointments_tx() as conn:
+        entry = _row(conn.execute(
+            "SELECT * FROM waitlist WHERE user_id = ? AND specialty = ? AND date = ? AND status = ?",
+            (user_id, specialty, date, WAITLIST_WAITING),
+        ).fetchone())
+        if entry is None:
+            cursor = conn.execute(
+                "INSERT INTO waitlist (user_id, patient_name, specialty, date, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, patient_name, specialty, date, WAITLIST_WAITING, datetime.now().isoformat()),
+            )
+            entry = _row(conn.execute("SELECT * FROM waitlist WHERE id = ?", (cursor.lastrowid,)).fetchone())
+        entry["position"] = conn.execute(
+            "SELECT COUNT(*) FROM waitlist WHERE specialty = ? AND date = ? AND status = ? AND id <= ?",
+            (specialty, date, WAITLIST_WAITING, entry["id"]),
+        ).fetchone()[0]
+    return entry
+
+
+@traced("db.take_waiting")
+def take_waiting(conn: sqlite3.Connection, specialty: str, date: str, times: List[str],
+                 skip_users: List[str] = ()) -> List[Dict]:
+    """Ofrece cada hora de `times` al siguiente paciente en espera (dentro de appointments_tx).
+
+    Los de `skip_users` (ya tienen una oferta abierta) conservan su lugar
+    en la cola para el próximo horario.
+    """
+    skip = f" AND user_id NOT IN ({','.join('?' * len(skip_users))})" if skip_users else ""
+    rows = conn.execute(
+        f"SELECT * FROM waitlist WHERE specialty = ? AND date = ? AND status = ?{skip} ORDER BY id LIMIT ?",
+        (specialty, date, WAITLIST_WAITING, *skip_users, len(times)),
+    ).fetchall()
+    now = datetime.now().isoformat()
+    offers = []
+    for row, time in zip(rows, times):
+        conn.execute("UPDATE waitlist SET status = ?, offered_time = ?, offered_at = ? WHERE id = ?",
+                     (WAITLIST_OFFERED, time, now, row["id"]))
+        offers.append(dict(row, status=WAITLIST_OFFERED, offered_time=time, offered_at=now))
+    return offers
+
+
+@traced("db.offer_waiting")
+def offer_waiting(specialty: str, date: str, times: List[str], skip_users: List[str],
+                  hold: Callable[[Dict], bool]) -> List[Dict]:
+    """Ofrece `times` a los siguientes en espera y encola el aviso de cada oferta, en una transacción.
+
+    `hold(entry)` retiene el horario a nombre del paciente; si no puede
+    (otro lo retuvo mientras tanto) la entrada vuelve a la cola sin aviso.
+    El aviso sale por el outbox, con reintentos y clave de idempotencia.
+    """
+    offers = []
+    with appointments_tx() as conn:
+        for entry in take_waiting(conn, specialty, date, times, skip_users):
+            if not hold(entry):
+                conn.execute("UPDATE waitlist SET status = ?, offered_time = '', offered_at = '' WHERE id = ?",
+                             (WAITLIST_WAITING, entry["id"]))
+                continue
+            offer = {"appointment_id": "", "user_id": entry["user_id"], "patient_name": entry["patient_name"],
+                     "specialty": specialty, "date": date, "time": entry["offered_time"], "status": WAITLIST_OFFERED}
+            _enqueue_notification(conn, "oferta", offer, f"oferta:{entry['id']}:{entry['offered_at']}")
+            offers.append(entry)
+    if offers:
+        _outbox_enqueued()
+    return offers
+
+
+@traced("db.open_offers")
+def open_offers() -> List[Dict]:
+    """Entradas con una oferta abierta (para reponer sus retenciones al arrancar)."""
+    rows = _connect().execute("SELECT * FROM waitlist WHERE status = ? ORDER BY id", (WAITLIST_OFFERED,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+@traced("db.expire_offer")
+def expire_offer(waitlist_id: int) -> bool:
+    """Marca vencida una oferta abierta; False si ya no estaba abierta (aceptada o vencida en otro proceso)."""
+    with appointments_tx() as conn:
+        cursor = conn.execute("UPDATE waitlist SET status = ? WHERE id = ? AND status = ?",
+                              (WAITLIST_EXPIRED, waitlist_id, WAITLIST_OFFERED))
+    return cursor.rowcount > 0
+
+
+# Outbox de avisos: lo llenan las escrituras de citas y lo vacía reservas_outbox
+@traced("db.claim_notifications")
+def claim_notifications(limit: int, lease_seconds: float) -> List[Dict]:
+    """Toma hasta `limit` avisos vencidos y los reserva `lease_seconds` para un worker.
+
+    Si el worker muere a mitad del envío, el aviso vuelve a estar disponible
+    al vencer la reserva (y la clave de idempotencia evita el duplicado).
+    """
+    now = _time.time()
+    with appointments_tx() as conn:
+        rows = conn.execute(
+            "SELECT * FROM outbox WHERE status = ? AND next_attempt_at <= ? AND locked_until <= ?"
+            " ORDER BY next_attempt_at LIMIT ?",
+            (OUTBOX_PENDING, now, now, limit),
+        ).fetchall()
+        conn.executemany("UPDATE outbox SET locked_until = ? WHERE id = ?",
+                         [(now + lease_seconds, row["id"]) for row in rows])
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        jobs.append(job)
+    return jobs
+
+
+@traced("db.finish_notifications")
+def finish_notifications(sent: List[int], retries: List[Dict], failed: List[Dict]):
+    """Registra el resultado de un lote: enviados, a reintentar ({id, error, next_attempt_at}) y descartados."""
+    now = _time.time()
+    with appointments_tx() as conn:
+        conn.executemany("UPDATE outbox SET status = ?, sent_at = ?, attempts = attempts + 1, locked_until = 0 WHERE id = ?",
+                         [(OUTBOX_SENT, now, job_id) for job_id in sent])
+        conn.executemany(
+            "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?, locked_until = 0 WHERE id = ?",
+            [(r["next_attempt_at"], r["error"], r["id"]) for r in retries],
+        )
+        conn.executemany("UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = ?, locked_until = 0 WHERE id = ?",
+                         [(OUTBOX_FAILED, r["error"], r["id"]) for r in failed])
+
+
+@traced("db.outbox_stats")
+def outbox_stats() -> Dict:
+    """Profundidad de la cola y antigüedad del aviso pendiente más viejo (s)."""
+    row = _connect().execute(
+        "SELECT COUNT(*), MIN(created_at), SUM(next_attempt_at <= ?) FROM outbox WHERE status = ?",
+        (_time.time(), OUTBOX_PENDING),
+    ).fetchone()
+    failed = _connect().execute("SELECT COUNT(*) FROM outbox WHERE status = ?", (OUTBOX_FAILED,)).fetchone()[0]
+    oldest = row[1]
+    return {
+        "depth": row[0],
+        "due": row[2] or 0,
+        "lag_seconds": round(_time.time() - oldest, 3) if oldest is not None else 0.0,
+        "failed": failed,
+    }
+
+
+@traced("db.enqueue_reminders")
+def enqueue_reminders(appts: List[Dict]) -> int:
+    """Encola el recordatorio de cada cita (una sola vez por cita y horario)."""
+    with appointments_tx() as conn:
+        queued = sum(
+            _enqueue_notification(conn, "recordatorio", appt, f"{appt['appointment_id']}:recordatorio:{appt['date']} {appt['time']}")
+            for appt in appts
+        )
+    if queued:
+        _outbox_enqueued()
+    return queued
@@ -1,9 +1,13 @@
 """
 Sistema FAQ para Reservas Médicas - Preguntas frecuentes del servicio.
+
+scikit-learn se importa al construir el primer FAQMatcher, no al importar
+el módulo. get_faq_matcher() devuelve un índice compartido por el proceso.
 """
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import numpy as np
+import threading
+import time
+
+import reservas_metrics as metrics
 
 FAQ_DATABASE = [
     # === HORARIOS Y ATENCIÓN ===
@@ -216,35 +220,75 @@ FAQ_DATABASE = [
 ]
 
 
+def _sklearn():
+    start = time.perf_counter()
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+    metrics.set_gauge("faq.sklearn_import_ms", round((time.perf_counter() - start) * 1000, 1))
+    return TfidfVectorizer, cosine_similarity
+
+
 class FAQMatcher:
-    def __init__(self, threshold=0.65):
+    def __init__(self, threshold=0.65, ngram_range=(1, 2), analyzer="word", faq_database=None):
+        TfidfVectorizer, self._cosine_similarity = _sklearn()
         self.threshold = threshold
-        self.faq_database = FAQ_DATABASE
-        self.vectorizer = TfidfVectorizer(ngram_range=(1, 2))
+        self.faq_database = FAQ_DATABASE if faq_database is None else faq_database
+        self.vectorizer = TfidfVectorizer(ngram_range=ngram_range, analyzer=analyzer)
 
         self.all_questions = []
         self.question_to_answer = {}
+        # Índice de la entrada del FAQ a la que pertenece cada pregunta/variación
+        self.question_entry = []
 
-        for faq in self.faq_database:
+        for i, faq in enumerate(self.faq_database):
             self.all_questions.append(faq['question'].lower())
             self.question_to_answer[faq['question'].lower()] = faq['answer']
+            self.question_entry.append(i)
             for variation in faq.get('variations', []):
                 self.all_questions.append(variation.lower())
                 self.question_to_answer[variation.lower()] = faq['answer']
+                self.question_entry.append(i)
 
         if self.all_questions:
             self.question_vectors = self.vectorizer.fit_transform(self.all_questions)
         else:
             self.question_vectors = None
 
-    def find_answer(self, user_question: str):
+    def find_answer(self, user_question: str, threshold: float = None):
         if self.question_vectors is None:
             return None, 0.0
+        if threshold is None:
+            threshold = self.threshold
         user_vector = self.vectorizer.transform([user_question.lower()])
-        similarities = cosine_similarity(user_vector, self.question_vectors)[0]
-        max_idx = np.argmax(similarities)
+        similarities = self._cosine_similarity(user_vector, self.question_vectors)[0]
+        max_idx = similarities.argmax()
         max_sim = similarities[max_idx]
-        if max_sim >= self.threshold:
+        if max_sim >= threshold:
             q = self.all_questions[max_idx]
             return self.question_to_answer[q], float(max_sim)
         return None, float(max_sim)
+
+    def best_matches(self, questions):
+        """Mejor entrada del FAQ (índice, similitud) para un lote de preguntas, sin umbral."""
+        if self.question_vectors is None or not questions:
+            return [(None, 0.0) for _ in questions]
+        vectors = self.vectorizer.transform([q.lower() for q in questions])
+        similarities = self._cosine_similarity(vectors, self.question_vectors)
+        best = similarities.argmax(axis=1)
+        return [(self.question_entry[idx], float(similarities[row, idx])) for row, idx in enumerate(best)]
+
+
+_shared_matcher = None
+_shared_lock = threading.Lock()
+
+
+def get_faq_matcher() -> FAQMatcher:
+    """FAQMatcher compartido (el índice TF-IDF se construye una vez por proceso)."""
+    global _shared_matcher
+    if _shared_matcher is None:
+        with _shared_lock:
+            if _shared_matcher is None:
+                start = time.perf_counter()
+                _shared_matcher = FAQMatcher(threshold=0.65)
+                metrics.set_gauge("faq.index_build_ms", round((time.perf_counter() - start) * 1000, 1))
+    return _shared_matcher
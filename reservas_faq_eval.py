@@ -0,0 +1,204 @@
+"""
+Evaluación offline y micro-benchmark del FAQMatcher.
+
+Lee un dataset NDJSON de preguntas etiquetadas ({"question": ..., "expected":
+pregunta canónica del FAQ o null si no debería responder el FAQ), lo pasa
+por lotes por cada configuración del matcher y reporta precisión, recall,
+curva por umbral y latencia por consulta.
+
+Uso:
+    python reservas_faq_eval.py
+    python reservas_faq_eval.py --config threshold=0.65,ngram=1-2 --config threshold=0.5,analyzer=char_wb,ngram=3-5
+    python reservas_faq_eval.py --faq otro_faq.json --json reporte.json
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from reservas_faq import FAQ_DATABASE, FAQMatcher
+
+DEFAULT_DATASET = os.path.join(os.path.dirname(__file__), "eval", "faq_eval.jsonl")
+DEFAULT_CONFIGS = [
+    "threshold=0.65,ngram=1-2",
+    "threshold=0.65,ngram=1-1",
+    "threshold=0.5,analyzer=char_wb,ngram=3-5",
+]
+CURVE_THRESHOLDS = [round(0.30 + 0.05 * i, 2) for i in range(14)]
+
+
+def parse_config(spec: str) -> Dict:
+    """'threshold=0.65,ngram=1-2,analyzer=word' -> kwargs de FAQMatcher."""
+    cfg = {"name": spec, "threshold": 0.65, "ngram_range": (1, 2), "analyzer": "word"}
+    for part in filter(None, spec.split(",")):
+        key, _, value = part.partition("=")
+        key = key.strip()
+        if key == "threshold":
+            cfg["threshold"] = float(value)
+        elif key == "ngram":
+            low, _, high = value.partition("-")
+            cfg["ngram_range"] = (int(low), int(high or low))
+        elif key == "analyzer":
+            cfg["analyzer"] = value
+        else:
+            raise ValueError(f"Parámetro de configuración desconocido: {key}")
+    return cfg
+
+
+def iter_dataset(path: str) -> Iterator[Tuple[str, Optional[str]]]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                row = json.loads(line)
+                yield row["question"], row.get("expected")
+
+
+def iter_batches(rows: Iterator, size: int) -> Iterator[List]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def _is_error(expected: Optional[str], predicted: Optional[str], sim: float, threshold: float) -> bool:
+    if sim < threshold:
+        return expected is not None
+    return predicted != expected
+
+
+def score(records: List[Tuple[Optional[str], Optional[str], float]], threshold: float) -> Dict:
+    """Métricas para un umbral. records: (esperada, mejor coincidencia, similitud)."""
+    answered = correct = in_scope = out_answered = out_scope = 0
+    for expected, predicted, sim in records:
+        hit = sim >= threshold
+        if expected is None:
+            out_scope += 1
+            out_answered += hit
+            continue
+        in_scope += 1
+        if hit:
+            answered += 1
+            correct += predicted == expected
+    # Respuestas fuera de alcance también cuentan como respondidas (y erróneas)
+    total_answered = answered + out_answered
+    precision = correct / total_answered if total_answered else 0.0
+    recall = correct / in_scope if in_scope else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {
+        "threshold": threshold,
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "f1": round(f1, 4),
+        "false_answer_rate": round(out_answered / out_scope, 4) if out_scope else 0.0,
+    }
+
+
+def evaluate(cfg: Dict, dataset: str, faq_database: List[Dict], batch_size: int, repeat: int) -> Dict:
+    start = time.perf_counter()
+    matcher = FAQMatcher(threshold=cfg["threshold"], ngram_range=cfg["ngram_range"],
+                         analyzer=cfg["analyzer"], faq_database=faq_database)
+    build_ms = (time.perf_counter() - start) * 1000
+    canonical = [faq["question"] for faq in matcher.faq_database]
+
+    records = []
+    questions = []
+    batch_seconds = 0.0
+    for batch in iter_batches(iter_dataset(dataset), batch_size):
+        texts = [q for q, _ in batch]
+        t = time.perf_counter()
+        matches = matcher.best_matches(texts)
+        batch_seconds += time.perf_counter() - t
+        for (_, expected), (entry, sim) in zip(batch, matches):
+            records.append((expected, canonical[entry] if entry is not None else None, sim))
+        questions.extend(texts)
+
+    # Latencia por consulta tal como la ve /chat (find_answer de a una)
+    matcher.find_answer(questions[0] if questions else "")
+    latencies = []
+    for _ in range(repeat):
+        for q in questions:
+            t = time.perf_counter()
+            matcher.find_answer(q)
+            latencies.append((time.perf_counter() - t) * 1000)
+    latencies.sort()
+
+    curve = [score(records, t) for t in CURVE_THRESHOLDS]
+    return {
+        "config": cfg["name"],
+        "queries": len(records),
+        "build_ms": round(build_ms, 2),
+        "at_threshold": score(records, cfg["threshold"]),
+        "best_f1": max(curve, key=lambda row: row["f1"]) if curve else None,
+        "curve": curve,
+        "latency_ms": {
+            "mean": round(statistics.fmean(latencies), 4) if latencies else 0.0,
+            "p50": round(_percentile(latencies, 50), 4),
+            "p95": round(_percentile(latencies, 95), 4),
+            "p99": round(_percentile(latencies, 99), 4),
+            "max": round(latencies[-1], 4) if latencies else 0.0,
+        },
+        "batch_qps": round(len(records) / batch_seconds) if batch_seconds else 0,
+        "errors": [
+            {"question": q, "expected": e, "predicted": p, "similarity": round(s, 4)}
+            for q, (e, p, s) in zip(questions, records)
+            if _is_error(e, p, s, cfg["threshold"])
+        ],
+    }
+
+
+def print_report(results: List[Dict]):
+    print(f"{'configuración':<42} {'P':>6} {'R':>6} {'F1':>6} {'FAR':>6} {'mejor umbral':>13} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'lote q/s':>9}")
+    for r in results:
+        at, best, lat = r["at_threshold"], r["best_f1"], r["latency_ms"]
+        print(f"{r['config']:<42} {at['precision']:>6.2f} {at['recall']:>6.2f} {at['f1']:>6.2f} "
+              f"{at['false_answer_rate']:>6.2f} {best['threshold']:>6.2f} ({best['f1']:.2f}) "
+              f"{lat['p50']:>8.3f} {lat['p95']:>8.3f} {lat['p99']:>8.3f} {r['batch_qps']:>9}")
+
+    print("\nCurva F1 por umbral")
+    print(f"{'umbral':>6} " + " ".join(f"{i + 1:>6}" for i in range(len(results))))
+    for i, threshold in enumerate(CURVE_THRESHOLDS):
+        print(f"{threshold:>6.2f} " + " ".join(f"{r['curve'][i]['f1']:>6.2f}" for r in results))
+    print("\n" + "\n".join(f"{i + 1}: {r['config']} ({len(r['errors'])} errores)" for i, r in enumerate(results)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluación offline del FAQMatcher")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="NDJSON con question/expected")
+    parser.add_argument("--config", action="append", help="threshold=..,ngram=a-b,analyzer=word|char_wb (repetible)")
+    parser.add_argument("--faq", help="JSON con una lista de entradas FAQ alternativa")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=5, help="pasadas para medir latencia por consulta")
+    parser.add_argument("--json", help="guarda el reporte completo (incluye errores) en este archivo")
+    args = parser.parse_args(argv)
+
+    faq_database = FAQ_DATABASE
+    if args.faq:
+        with open(args.faq, "r", encoding="utf-8") as f:
+            faq_database = json.load(f)
+
+    results = [evaluate(parse_config(spec), args.dataset, faq_database, args.batch_size, args.repeat)
+               for spec in (args.config or DEFAULT_CONFIGS)]
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,21 @@
 """
 Flujo conversacional para reservas de citas médicas.
+
+Los estados y transiciones se declaran en BOOKING_FLOW y se compilan en la
+máquina de reservas_fsm; otros flujos se agregan con register_flow().
 """
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 import re
 import random
 from datetime import datetime, timedelta
 import reservas_database as database
+import reservas_metrics as metrics
+from reservas_holds import holds
+import reservas_specialties as specialties
+import reservas_waitlist as waitlist
+from reservas_fsm import Flow, FlowContext, Keywords, StateMachine, Words, always
 
 
-# Especialidades disponibles
-SPECIALTIES = {
-    "general": "Medicina General",
-    "pediatria": "Pediatría", 
-    "pediatría": "Pediatría",
-    "cardiologia": "Cardiología",
-    "cardiología": "Cardiología",
-    "dermatologia": "Dermatología",
-    "dermatología": "Dermatología",
-    "ginecologia": "Ginecología",
-    "ginecología": "Ginecología",
-    "traumatologia": "Traumatología",
-    "traumatología": "Traumatología",
-    "oftalmologia": "Oftalmología",
-    "oftalmología": "Oftalmología",
-    "neurologia": "Neurología",
-    "neurología": "Neurología",
-    "psicologia": "Psicología",
-    "psicología": "Psicología",
-    "nutricion": "Nutrición",
-    "nutrición": "Nutrición",
-}
-
 # Horarios disponibles
 AVAILABLE_HOURS = [
     "08:00", "08:30", "09:00", "09:30", "10:00", "10:30",
@@ -96,19 +81,18 @@ MESSAGES = {
     ],
 }
 
+_TIME_SUFFIX = re.compile(r'(am|pm|hrs|h)$')
+
+
 def _get_message(key: str, **kwargs) -> str:
     """Obtiene un mensaje aleatorio de la lista."""
     msg = random.choice(MESSAGES.get(key, ["Mensaje no encontrado"]))
     return msg.format(**kwargs) if kwargs else msg
 
 
-def _normalize_specialty(text: str) -> str:
-    """Normaliza el nombre de la especialidad."""
-    text_lower = text.lower().strip()
-    for key, value in SPECIALTIES.items():
-        if key in text_lower or value.lower() in text_lower:
-            return value
-    return text.strip().title()
+def _find_specialty(text: str) -> Optional[str]:
+    """Especialidad mencionada en el texto (tolera tildes y typos), o None."""
+    return specialties.resolver.find(text)
 
 
 def _parse_date(text: str) -> str:
@@ -147,16 +131,9 @@ def _parse_time(text: str) -> str:
     text = text.lower().strip().replace(" ", "")
     
     # Remover "am", "pm", "hrs", "h"
-    text = re.sub(r'(am|pm|hrs|h)$', '', text)
-    
-    # Formato HH:MM
-    try:
-        datetime.strptime(text, "%H:%M")
-        return text
-    except:
-        pass
+    text = _TIME_SUFFIX.sub('', text)
     
-    # Formato H:MM
+    # Formato HH:MM o H:MM
     try:
         dt = datetime.strptime(text, "%H:%M")
         return dt.strftime("%H:%M")
@@ -184,9 +161,62 @@ def _is_valid_date(date_str: str) -> bool:
         return False
 
 
+# Fechas y horas dentro de una frase ("cardiología mañana a las 10").
+# "en la mañana" / "por la mañana" indica la franja, no el día siguiente.
+_DATE_IN_TEXT = re.compile(
+    r"(?<!la )\b(pasado ma[ñn]ana|ma[ñn]ana|hoy)\b"
+    r"|\b(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[/-]\d{1,2}[/-]\d{2,4})\b"
+)
+_TIME_IN_TEXT = re.compile(
+    r"\ba\s+las?\s+(\d{1,2}(?::\d{2})?\s*(?:am|pm|hrs|h)?)\b"
+    r"|\b(\d{1,2}:\d{2}\s*(?:am|pm|hrs|h)?)\b"
+    r"|\b(\d{1,2}\s*(?:am|pm|hrs|h))\b"
+)
+SLOT_NAMES = ("specialty", "date", "time")
+
+
+def _find_date(text: str) -> Optional[str]:
+    match = _DATE_IN_TEXT.search(text)
+    if not match:
+        return None
+    return _parse_date((match.group(1) or match.group(2)).replace("manana", "mañana"))
+
+
+def _find_time(text: str) -> Optional[str]:
+    match = _TIME_IN_TEXT.search(text)
+    if not match:
+        return None
+    return _parse_time(next(g for g in match.groups() if g))
+
+
+def extract_slots(text: str) -> Dict:
+    """Especialidad, fecha y hora válidas que aparecen en un mensaje (en minúsculas).
+
+    Solo incluye los datos que se podrían reservar tal cual: fecha de hoy en
+    adelante y hora dentro de AVAILABLE_HOURS.
+    """
+    slots = {}
+    specialty = _find_specialty(text)
+    if specialty:
+        slots["specialty"] = specialty
+    date = _find_date(text)
+    if date and _is_valid_date(date):
+        slots["date"] = date
+    time = _find_time(text)
+    if time in AVAILABLE_HOURS:
+        slots["time"] = time
+    return slots
+
+
+def booking_slots(text: str) -> Dict:
+    """Datos de reserva de un mensaje sin palabras de reserva: especialidad más fecha u hora."""
+    slots = extract_slots(text)
+    return slots if "specialty" in slots and len(slots) > 1 else {}
+
+
 def _format_specialties_list() -> str:
     """Formatea la lista de especialidades disponibles."""
-    unique_specs = sorted(set(SPECIALTIES.values()))
+    unique_specs = sorted(specialties.resolver.names)
     return "\n".join([f"• {spec}" for spec in unique_specs])
 
 
@@ -197,189 +227,386 @@ def _format_hours_list() -> str:
     return f"🌅 Mañana: {', '.join(morning)}\n🌆 Tarde: {', '.join(afternoon)}"
 
 
-def process_message(user_id: str, message: str) -> Dict:
-    """Procesa mensajes del usuario y maneja el flujo de reserva."""
-    user = database.get_user(user_id)
-    if not user:
-        return {"reply": "⚠️ Usuario no encontrado. Por favor, regístrate primero."}
+def warm_up():
+    """Ejercita los parsers de fecha/hora (strptime carga su módulo en el primer uso)."""
+    _parse_date("2030-01-15")
+    _parse_date("15/01/2030")
+    _parse_time("10:00am")
+    extract_slots("cardiología mañana a las 10")
+    specialties.resolver.find("cardiolgia")
+
+
+def _set_state(user_id: str, user: Dict, state: str, pending: Dict = None):
+    """Persiste el estado y lo refleja en el registro en memoria del usuario."""
+    database.set_user_state(user_id, state, pending)
+    user["state"] = state
+    user["pending"] = pending or {}
+    user["updated_at"] = datetime.now().isoformat()
+
 
-    state = user.get("state", "idle")
-    pending = user.get("pending", {}) or {}
-    text = message.lower().strip()
-
-    # === CANCELAR EN CUALQUIER MOMENTO ===
-    if any(word in text for word in ["cancelar", "cancel", "salir", "terminar", "no quiero"]):
-        database.set_user_state(user_id, "idle", {})
-        return {"reply": _get_message("cancelled") + "\n\nEscribe 'cita' para agendar una nueva consulta."}
-
-    # === VER CITAS ===
-    if any(word in text for word in ["mis citas", "ver citas", "consultar citas", "tengo citas"]):
-        appointments = database.get_user_appointments(user_id)
-        if appointments:
-            headers = [
-                "📋 **Tus citas programadas:**\n\n",
-                "📋 **Aquí están tus citas:**\n\n",
-                "📋 **Estas son tus reservas:**\n\n",
-            ]
-            reply = random.choice(headers)
-            for i, apt in enumerate(appointments, 1):
-                reply += f"{i}. **{apt.get('specialty', 'N/A')}**\n"
-                reply += f"   📅 {apt.get('date', 'N/A')} a las {apt.get('time', 'N/A')}\n"
-                reply += f"   Estado: {apt.get('status', 'N/A')}\n\n"
-            return {"reply": reply}
-        else:
-            return {"reply": _get_message("no_appointments")}
-
-    # === ESTADO: IDLE ===
+def _persist(ctx: FlowContext, state: str):
+    _set_state(ctx.user_id, ctx.user, state, ctx.pending)
+    # El horario queda retenido solo mientras se espera la confirmación
+    if state != "confirm":
+        holds.release(ctx.user_id)
     if state == "idle":
-        if any(k in text for k in BOOK_KEYWORDS):
-            database.set_user_state(user_id, "awaiting_specialty", {})
-            specialties_list = _format_specialties_list()
-            msg = _get_message("ask_specialty")
-            return {
-                "reply": f"{msg}\n\n{specialties_list}\n\n_Escribe el nombre de la especialidad o 'cancelar' para salir._"
-            }
-        else:
-            greetings = [
-                "🏥 ¡Hola! Soy tu asistente de reservas médicas.",
-                "🏥 ¡Bienvenido! Estoy aquí para ayudarte.",
-                "🏥 ¡Hola! ¿En qué puedo ayudarte hoy?",
-            ]
-            return {
-                "reply": f"{random.choice(greetings)}\n\nPuedo ayudarte a:\n• 📅 **Agendar cita** - escribe 'quiero una cita'\n• 📋 **Ver mis citas** - escribe 'mis citas'\n• ❓ **Preguntas** - horarios, precios, especialidades\n\n¿Qué deseas hacer?"
-            }
-
-    # === ESTADO: ESPERANDO ESPECIALIDAD ===
-    if state == "awaiting_specialty":
-        # Validar que sea una especialidad válida (no keywords de reserva)
-        if any(k in text for k in BOOK_KEYWORDS) and not any(spec.lower() in text for spec in SPECIALTIES.values()):
-            specialties_list = _format_specialties_list()
-            prompts = [
-                "😊 Ya estamos en el proceso de agendar. **¿Qué especialidad necesitas?**",
-                "👍 ¡Ya estamos agendando! Solo dime **¿qué especialidad buscas?**",
-                "😄 Perfecto, estamos en eso. **¿Qué tipo de consulta necesitas?**",
-            ]
-            return {"reply": f"{random.choice(prompts)}\n\n{specialties_list}\n\n_Escribe 'cancelar' para salir._"}
-        
-        specialty = _normalize_specialty(message)
-        pending["specialty"] = specialty
-        database.set_user_state(user_id, "awaiting_date", pending)
-        
-        today = datetime.now()
-        dates_example = f"• Hoy: {today.strftime('%Y-%m-%d')}\n• Mañana: {(today + timedelta(days=1)).strftime('%Y-%m-%d')}"
-        
-        msg = _get_message("specialty_confirmed", specialty=specialty)
-        return {
-            "reply": f"{msg}\n\nPuedes escribir:\n{dates_example}\n• O cualquier fecha en formato DD/MM/YYYY\n\n_Escribe 'cancelar' para salir._"
-        }
-
-    # === ESTADO: ESPERANDO FECHA ===
-    if state == "awaiting_date":
-        parsed_date = _parse_date(message)
-        
-        if not parsed_date:
-            msg = _get_message("date_error")
-            return {
-                "reply": f"{msg}\n• 'hoy' o 'mañana'\n• DD/MM/YYYY (ej: 15/01/2026)\n\n_Escribe 'cancelar' para salir._"
-            }
-        
-        if not _is_valid_date(parsed_date):
-            errors = [
-                "⚠️ La fecha debe ser hoy o una fecha futura.",
-                "🤔 Esa fecha ya pasó, elige una fecha futura.",
-                "⚠️ Solo puedo agendar para hoy o días posteriores.",
-            ]
-            return {
-                "reply": f"{random.choice(errors)}\n\nPor favor, elige otra fecha.\n\n_Escribe 'cancelar' para salir._"
-            }
-        
-        pending["date"] = parsed_date
-        database.set_user_state(user_id, "awaiting_time", pending)
-        hours_list = _format_hours_list()
-        
-        msg = _get_message("date_confirmed", date=parsed_date)
-        return {
-            "reply": f"{msg}\n\nHorarios disponibles:\n{hours_list}\n\n_Escribe la hora (ej: 09:00, 14:30) o 'cancelar' para salir._"
-        }
-
-    # === ESTADO: ESPERANDO HORA ===
-    if state == "awaiting_time":
-        parsed_time = _parse_time(message)
-        
-        if not parsed_time:
-            msg = _get_message("time_error")
-            return {
-                "reply": f"{msg}\n\n_Escribe 'cancelar' para salir._"
-            }
-        
-        if parsed_time not in AVAILABLE_HOURS:
-            hours_list = _format_hours_list()
-            msg = _get_message("time_unavailable")
-            return {
-                "reply": f"{msg}\n\nHorarios disponibles:\n{hours_list}\n\n_Escribe 'cancelar' para salir._"
-            }
-        
-        pending["time"] = parsed_time
-        database.set_user_state(user_id, "confirm", pending)
-        
-        specialty = pending.get("specialty", "N/A")
-        date = pending.get("date", "N/A")
-        
-        summaries = [
-            "📋 **Resumen de tu cita:**",
-            "📋 **Vamos a confirmar los datos:**",
-            "📋 **Tu cita quedaría así:**",
-        ]
-        return {
-            "reply": f"{random.choice(summaries)}\n\n👨‍⚕️ Especialidad: **{specialty}**\n📅 Fecha: **{date}**\n🕐 Hora: **{parsed_time}**\n👤 Paciente: **{user.get('name', 'N/A')}**\n\n✅ Escribe **'sí'** o **'confirmar'** para reservar\n❌ Escribe **'cancelar'** para cancelar"
-        }
-
-    # === ESTADO: CONFIRMAR ===
-    if state == "confirm":
-        if any(word in text for word in ["si", "sí", "s", "ok", "confirmar", "confirmo", "dale", "listo"]):
-            appt = {
-                "user_id": user_id,
-                "patient_name": user.get("name", ""),
-                "specialty": pending.get("specialty"),
-                "date": pending.get("date"),
-                "time": pending.get("time"),
-                "status": "confirmada",
-            }
-            appt_id = database.save_appointment(appt)
-            database.set_user_state(user_id, "idle", {})
-            
-            msg = _get_message("confirm_success")
-            reminders = [
-                "📍 Recuerda:\n• Llegar 15 minutos antes\n• Traer tu DNI y carnet de seguro\n• Resultados de exámenes previos (si los tienes)\n\n¡Te esperamos! 🏥",
-                "📍 No olvides:\n• Llegar con tiempo\n• Traer documentos de identidad\n• Tu carnet de seguro si tienes\n\n¡Nos vemos! 🏥",
-                "📍 Tips para tu cita:\n• Llega 15 min antes\n• Trae tu DNI\n• Si tienes exámenes previos, tráelos\n\n¡Te esperamos con gusto! 🏥",
-            ]
-            return {
-                "reply": f"{msg}\n\n📋 ID de cita: **{appt_id}**\n👨‍⚕️ {pending.get('specialty')}\n📅 {pending.get('date')} a las {pending.get('time')}\n\n{random.choice(reminders)}"
-            }
-        
-        if any(word in text for word in ["no", "cambiar", "modificar", "editar"]):
-            database.set_user_state(user_id, "awaiting_specialty", {})
-            restart_msgs = [
-                "🔄 Sin problema, empecemos de nuevo.\n\n**¿Qué especialidad necesitas?**",
-                "🔄 Listo, vamos desde el inicio.\n\n**¿Qué especialidad buscas?**",
-                "🔄 Ok, reiniciemos.\n\n**¿En qué especialidad te gustaría atenderte?**",
-            ]
-            return {
-                "reply": f"{random.choice(restart_msgs)}\n\n_Escribe 'cancelar' para salir._"
-            }
-        
-        not_understood = [
-            "🤔 No entendí tu respuesta.",
-            "🤔 Mmm, no capté eso.",
-            "🤔 No estoy seguro de qué quieres hacer.",
-        ]
-        return {
-            "reply": f"{random.choice(not_understood)}\n\n✅ Escribe **'sí'** para confirmar la cita\n❌ Escribe **'cancelar'** para cancelar\n🔄 Escribe **'cambiar'** para modificar"
-        }
-
-    # === FALLBACK ===
+        holds.end_session(ctx.user_id)
+    else:
+        holds.touch_session(ctx.user_id)
+
+
+def _slot_taken(user_id: str, specialty: str, date: str, time: str) -> bool:
+    """Horario con cita confirmada o retenido por otro paciente."""
+    return (not database.is_slot_free(specialty, date, time)
+            or holds.held_by_other(user_id, specialty, date, time))
+
+
+def _idle_seconds(user: Dict) -> Optional[float]:
+    try:
+        return (datetime.now() - datetime.fromisoformat(user["updated_at"])).total_seconds()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _expire_session(user_id: str):
+    """Vencimiento de la rueda: el flujo a medias vuelve a idle."""
+    user = database.get_user(user_id)
+    if not user or user.get("state", "idle") == "idle":
+        return
+    idle = _idle_seconds(user)
+    if idle is not None and idle < holds.session_idle_seconds:
+        # Otro proceso lo tocó después de programarse: se reprograma
+        holds.touch_session(user_id, idle)
+        return
     database.set_user_state(user_id, "idle", {})
+    holds.release(user_id)
+
+
+def schedule_idle_sessions(users: Dict[str, Dict]) -> int:
+    """Programa el vencimiento de los flujos a medias (al arrancar, tras un reinicio)."""
+    count = 0
+    for user_id, user in users.items():
+        if user.get("state", "idle") != "idle":
+            holds.touch_session(user_id, _idle_seconds(user) or 0.0)
+            count += 1
+    return count
+
+
+holds.on_session_expired(_expire_session)
+
+
+# === ACCIONES ===
+# Cada acción devuelve la respuesta; el estado destino lo aplica el motor (reservas_fsm).
+
+def _cancel(ctx: FlowContext) -> Dict:
+    ctx.pending = {}
+    return {"reply": _get_message("cancelled") + "\n\nEscribe 'cita' para agendar una nueva consulta."}
+
+
+def _list_appointments(ctx: FlowContext) -> Dict:
+    appointments = database.get_user_appointments(ctx.user_id)
+    if not appointments:
+        return {"reply": _get_message("no_appointments")}
+    headers = [
+        "📋 **Tus citas programadas:**\n\n",
+        "📋 **Aquí están tus citas:**\n\n",
+        "📋 **Estas son tus reservas:**\n\n",
+    ]
+    reply = random.choice(headers)
+    for i, apt in enumerate(appointments, 1):
+        reply += f"{i}. **{apt.get('specialty', 'N/A')}**\n"
+        reply += f"   📅 {apt.get('date', 'N/A')} a las {apt.get('time', 'N/A')}\n"
+        reply += f"   Estado: {apt.get('status', 'N/A')} · ID: {apt.get('appointment_id')}\n\n"
+    reply += "_Escribe 'cancelar cita' o 'reprogramar cita' para modificar una._"
+    return {"reply": reply}
+
+
+def _ask_specialty() -> Dict:
+    specialties_list = _format_specialties_list()
+    msg = _get_message("ask_specialty")
+    return {
+        "reply": f"{msg}\n\n{specialties_list}\n\n_Escribe el nombre de la especialidad o 'cancelar' para salir._"
+    }
+
+
+def _ask_date(specialty: str) -> Dict:
+    today = datetime.now()
+    dates_example = f"• Hoy: {today.strftime('%Y-%m-%d')}\n• Mañana: {(today + timedelta(days=1)).strftime('%Y-%m-%d')}"
+
+    msg = _get_message("specialty_confirmed", specialty=specialty)
+    return {
+        "reply": f"{msg}\n\nPuedes escribir:\n{dates_example}\n• O cualquier fecha en formato DD/MM/YYYY\n\n_Escribe 'cancelar' para salir._"
+    }
+
+
+def _ask_time(date: str) -> Dict:
+    hours_list = _format_hours_list()
+
+    msg = _get_message("date_confirmed", date=date)
+    return {
+        "reply": f"{msg}\n\nHorarios disponibles:\n{hours_list}\n\n_Escribe la hora (ej: 09:00, 14:30) o 'cancelar' para salir._"
+    }
+
+
+def _summary(ctx: FlowContext) -> Dict:
+    specialty = ctx.pending.get("specialty", "N/A")
+    date = ctx.pending.get("date", "N/A")
+
+    summaries = [
+        "📋 **Resumen de tu cita:**",
+        "📋 **Vamos a confirmar los datos:**",
+        "📋 **Tu cita quedaría así:**",
+    ]
+    return {
+        "reply": f"{random.choice(summaries)}\n\n👨‍⚕️ Especialidad: **{specialty}**\n📅 Fecha: **{date}**\n🕐 Hora: **{ctx.pending.get('time')}**\n👤 Paciente: **{ctx.user.get('name', 'N/A')}**\n\n✅ Escribe **'sí'** o **'confirmar'** para reservar\n❌ Escribe **'cancelar'** para cancelar"
+    }
+
+
+WAITLIST_HINT = "_¿Ningún horario te sirve? Escribe 'lista de espera' y te avisamos si se libera uno ese día._"
+
+
+def _slot_unavailable(date: str) -> Dict:
+    return {"reply": f"{_get_message('time_unavailable')}\n\n{_ask_time(date)['reply']}\n\n{WAITLIST_HINT}"}
+
+
+def _advance(ctx: FlowContext) -> Dict:
+    """Pasa al primer dato que falta, o a confirmar si ya están todos."""
+    pending = ctx.pending
+    if not pending.get("specialty"):
+        ctx.next_state = "awaiting_specialty"
+        return _ask_specialty()
+    if not pending.get("date"):
+        ctx.next_state = "awaiting_date"
+        return _ask_date(pending["specialty"])
+    if not pending.get("time"):
+        ctx.next_state = "awaiting_time"
+        return _ask_time(pending["date"])
+    if (not database.is_slot_free(pending["specialty"], pending["date"], pending["time"])
+            or not holds.place(ctx.user_id, pending["specialty"], pending["date"], pending["time"])):
+        pending.pop("time")
+        ctx.next_state = "awaiting_time"
+        return _slot_unavailable(pending["date"])
+    ctx.next_state = "confirm"
+    return _summary(ctx)
+
+
+def _start_booking(ctx: FlowContext) -> Dict:
+    ctx.pending = extract_slots(ctx.text)
+    if len(ctx.pending) == len(SLOT_NAMES):
+        metrics.inc("flow.one_shot_booking")
+    return _advance(ctx)
+
+
+def _has_booking_slots(ctx: FlowContext) -> bool:
+    return bool(booking_slots(ctx.text))
+
+
+def _greet(ctx: FlowContext) -> Dict:
+    greetings = [
+        "🏥 ¡Hola! Soy tu asistente de reservas médicas.",
+        "🏥 ¡Bienvenido! Estoy aquí para ayudarte.",
+        "🏥 ¡Hola! ¿En qué puedo ayudarte hoy?",
+    ]
+    return {
+        "reply": f"{random.choice(greetings)}\n\nPuedo ayudarte a:\n• 📅 **Agendar cita** - escribe 'quiero una cita'\n• 📋 **Ver mis citas** - escribe 'mis citas'\n• ❓ **Preguntas** - horarios, precios, especialidades\n\n¿Qué deseas hacer?"
+    }
+
+
+def _reprompt_specialty(ctx: FlowContext) -> Dict:
+    specialties_list = _format_specialties_list()
+    prompts = [
+        "😊 Ya estamos en el proceso de agendar. **¿Qué especialidad necesitas?**",
+        "👍 ¡Ya estamos agendando! Solo dime **¿qué especialidad buscas?**",
+        "😄 Perfecto, estamos en eso. **¿Qué tipo de consulta necesitas?**",
+    ]
+    return {"reply": f"{random.choice(prompts)}\n\n{specialties_list}\n\n_Escribe 'cancelar' para salir._"}
+
+
+def _resolved_specialty(ctx: FlowContext) -> Optional[str]:
+    return _find_specialty(ctx.text)
+
+
+def _set_specialty(ctx: FlowContext) -> Dict:
+    # "cardiología mañana a las 10" llena también fecha y hora
+    ctx.pending.update(extract_slots(ctx.text))
+    ctx.pending["specialty"] = ctx.match
+    return _advance(ctx)
+
+
+def _suggest_specialty(ctx: FlowContext) -> Dict:
+    _, suggestions = specialties.resolver.resolve(ctx.text)
+    if suggestions:
+        options = "\n".join(f"• {name}" for name in suggestions)
+        return {"reply": f"🤔 No reconocí esa especialidad. **¿Quisiste decir?**\n\n{options}\n\n_Escribe el nombre de la especialidad o 'cancelar' para salir._"}
+    return {"reply": f"🤔 No reconocí esa especialidad.\n\n**Estas son las que atendemos:**\n\n{_format_specialties_list()}\n\n_Escribe el nombre de la especialidad o 'cancelar' para salir._"}
+
+
+def _valid_date(ctx: FlowContext) -> str:
+    parsed_date = _parse_date(ctx.message) or _find_date(ctx.text)
+    return parsed_date if parsed_date and _is_valid_date(parsed_date) else None
+
+
+def _parsed_date(ctx: FlowContext) -> str:
+    return _parse_date(ctx.message) or _find_date(ctx.text)
+
+
+def _set_date(ctx: FlowContext) -> Dict:
+    ctx.pending.update(extract_slots(ctx.text))
+    ctx.pending["date"] = ctx.match
+    return _advance(ctx)
+
+
+def _past_date(ctx: FlowContext) -> Dict:
+    errors = [
+        "⚠️ La fecha debe ser hoy o una fecha futura.",
+        "🤔 Esa fecha ya pasó, elige una fecha futura.",
+        "⚠️ Solo puedo agendar para hoy o días posteriores.",
+    ]
+    return {
+        "reply": f"{random.choice(errors)}\n\nPor favor, elige otra fecha.\n\n_Escribe 'cancelar' para salir._"
+    }
+
+
+def _date_error(ctx: FlowContext) -> Dict:
+    msg = _get_message("date_error")
+    return {
+        "reply": f"{msg}\n• 'hoy' o 'mañana'\n• DD/MM/YYYY (ej: 15/01/2026)\n\n_Escribe 'cancelar' para salir._"
+    }
+
+
+def _available_time(ctx: FlowContext) -> str:
+    parsed_time = _parse_time(ctx.message) or _find_time(ctx.text)
+    if parsed_time not in AVAILABLE_HOURS:
+        return None
+    specialty, date = ctx.pending.get("specialty"), ctx.pending.get("date")
+    if specialty and date and _slot_taken(ctx.user_id, specialty, date, parsed_time):
+        return None
+    return parsed_time
+
+
+def _parsed_time(ctx: FlowContext) -> str:
+    return _parse_time(ctx.message) or _find_time(ctx.text)
+
+
+def _set_time(ctx: FlowContext) -> Dict:
+    ctx.pending["time"] = ctx.match
+    return _advance(ctx)
+
+
+def _time_unavailable(ctx: FlowContext) -> Dict:
+    hours_list = _format_hours_list()
+    msg = _get_message("time_unavailable")
+    hint = f"\n\n{WAITLIST_HINT}" if ctx.state == "awaiting_time" else ""
+    return {
+        "reply": f"{msg}\n\nHorarios disponibles:\n{hours_list}\n\n_Escribe 'cancelar' para salir._{hint}"
+    }
+
+
+def _join_waitlist(ctx: FlowContext) -> Dict:
+    specialty, date = ctx.pending.get("specialty"), ctx.pending.get("date")
+    ctx.pending = {}
+    entry = waitlist.join(ctx.user_id, ctx.user.get("name", ""), specialty, date)
+    return {
+        "reply": f"📝 Te anoté en la lista de espera de **{specialty}** para el **{date}** (posición {entry['position']}).\n\nSi se libera un horario ese día te lo ofrecemos y lo guardamos a tu nombre unos minutos."
+    }
+
+
+def _open_offer(ctx: FlowContext) -> Optional[Tuple[int, Tuple[str, str, str]]]:
+    """Acepta el horario que le ofreció la lista de espera (si sigue vigente)."""
+    if not ACCEPT_OFFER_KEYWORDS(ctx):
+        return None
+    return holds.offer_of(ctx.user_id)
+
+
+def _accept_offer(ctx: FlowContext) -> Dict:
+    _, (specialty, date, time) = ctx.match
+    appt = {
+        "user_id": ctx.user_id,
+        "patient_name": ctx.user.get("name", ""),
+        "specialty": specialty,
+        "date": date,
+        "time": time,
+        "status": "confirmada",
+    }
+    try:
+        appt_id = waitlist.book(appt)
+    except database.SlotTakenError:
+        # Se queda donde estaba, con la reserva en curso intacta
+        ctx.next_state = ctx.state
+        return {"reply": "😕 Ese horario ya no está disponible. Seguimos atentos por si se libera otro."}
+    # La reserva que tuviera a medias queda sin efecto (el motor vuelve a idle)
+    note = "\n\n_La reserva que tenías en curso quedó sin efecto._" if ctx.state != "idle" else ""
+    ctx.pending = {}
+    return {
+        "reply": f"✅ ¡Listo! Reservé el horario que se liberó.\n\n📋 ID de cita: **{appt_id}**\n👨‍⚕️ {specialty}\n📅 {date} a las {time}{note}"
+    }
+
+
+def _time_error(ctx: FlowContext) -> Dict:
+    msg = _get_message("time_error")
+    return {
+        "reply": f"{msg}\n\n_Escribe 'cancelar' para salir._"
+    }
+
+
+def _confirm(ctx: FlowContext) -> Dict:
+    pending = ctx.pending
+    appt = {
+        "user_id": ctx.user_id,
+        "patient_name": ctx.user.get("name", ""),
+        "specialty": pending.get("specialty"),
+        "date": pending.get("date"),
+        "time": pending.get("time"),
+        "status": "confirmada",
+    }
+    try:
+        # Si la retención venció, otro paciente pudo retener el horario mientras tanto
+        if holds.held_by_other(ctx.user_id, appt["specialty"], appt["date"], appt["time"]):
+            raise database.SlotTakenError("slot held")
+        appt_id = waitlist.book(appt)
+    except database.SlotTakenError:
+        # Otro paciente confirmó ese horario mientras tanto
+        pending.pop("time", None)
+        ctx.next_state = "awaiting_time"
+        return _slot_unavailable(pending["date"])
+    ctx.pending = {}
+
+    msg = _get_message("confirm_success")
+    reminders = [
+        "📍 Recuerda:\n• Llegar 15 minutos antes\n• Traer tu DNI y carnet de seguro\n• Resultados de exámenes previos (si los tienes)\n\n¡Te esperamos! 🏥",
+        "📍 No olvides:\n• Llegar con tiempo\n• Traer documentos de identidad\n• Tu carnet de seguro si tienes\n\n¡Nos vemos! 🏥",
+        "📍 Tips para tu cita:\n• Llega 15 min antes\n• Trae tu DNI\n• Si tienes exámenes previos, tráelos\n\n¡Te esperamos con gusto! 🏥",
+    ]
+    return {
+        "reply": f"{msg}\n\n📋 ID de cita: **{appt_id}**\n👨‍⚕️ {pending.get('specialty')}\n📅 {pending.get('date')} a las {pending.get('time')}\n\n{random.choice(reminders)}"
+    }
+
+
+def _restart(ctx: FlowContext) -> Dict:
+    ctx.pending = {}
+    restart_msgs = [
+        "🔄 Sin problema, empecemos de nuevo.\n\n**¿Qué especialidad necesitas?**",
+        "🔄 Listo, vamos desde el inicio.\n\n**¿Qué especialidad buscas?**",
+        "🔄 Ok, reiniciemos.\n\n**¿En qué especialidad te gustaría atenderte?**",
+    ]
+    return {
+        "reply": f"{random.choice(restart_msgs)}\n\n_Escribe 'cancelar' para salir._"
+    }
+
+
+def _confirm_not_understood(ctx: FlowContext) -> Dict:
+    not_understood = [
+        "🤔 No entendí tu respuesta.",
+        "🤔 Mmm, no capté eso.",
+        "🤔 No estoy seguro de qué quieres hacer.",
+    ]
+    return {
+        "reply": f"{random.choice(not_understood)}\n\n✅ Escribe **'sí'** para confirmar la cita\n❌ Escribe **'cancelar'** para cancelar\n🔄 Escribe **'cambiar'** para modificar"
+    }
+
+
+def _fallback(ctx: FlowContext) -> Dict:
+    ctx.pending = {}
     fallbacks = [
         "🤔 No entendí tu mensaje.",
         "🤔 Mmm, no estoy seguro de qué necesitas.",
@@ -388,3 +615,264 @@ def process_message(user_id: str, message: str) -> Dict:
     return {
         "reply": f"{random.choice(fallbacks)}\n\nPuedo ayudarte a:\n• 📅 **Agendar cita** - escribe 'quiero una cita'\n• 📋 **Ver mis citas** - escribe 'mis citas'\n• ❓ **Preguntas** - sobre horarios, precios, etc.\n\n¿Qué deseas hacer?"
     }
+
+
+# === CANCELAR / REPROGRAMAR CITAS EXISTENTES ===
+_APPT_ID = re.compile(r"\bappt-\d{14}(?:-[0-9a-f]{6,10})?\b")
+
+
+def _appointment_ref(ctx: FlowContext) -> Optional[str]:
+    match = _APPT_ID.search(ctx.text)
+    return match.group(0).upper() if match else None
+
+
+def _active_appointments(user_id: str) -> List[Dict]:
+    return [a for a in database.get_user_appointments(user_id) if a.get("status") == database.STATUS_CONFIRMED]
+
+
+def _format_choices(appointments: List[Dict]) -> str:
+    return "\n".join(
+        f"{i}. **{a['specialty']}** · 📅 {a['date']} a las {a['time']} · ID: {a['appointment_id']}"
+        for i, a in enumerate(appointments, 1)
+    )
+
+
+def _start_manage(ctx: FlowContext, op: str) -> Dict:
+    ctx.pending = {"op": op}
+    active = _active_appointments(ctx.user_id)
+    ref = _appointment_ref(ctx)
+    if ref:
+        chosen = next((a for a in active if a["appointment_id"] == ref), None)
+        if chosen is None:
+            ctx.pending = {}
+            return {"reply": f"⚠️ No encontré una cita confirmada con el ID **{ref}**.\n\nEscribe 'mis citas' para ver tus reservas."}
+        return _manage_chosen(ctx, chosen)
+    if not active:
+        ctx.pending = {}
+        return {"reply": _get_message("no_appointments")}
+    if len(active) == 1:
+        return _manage_chosen(ctx, active[0])
+    ctx.pending["choices"] = [a["appointment_id"] for a in active]
+    ctx.next_state = "choose_appointment"
+    verb = "cancelar" if op == "cancel" else "reprogramar"
+    return {"reply": f"📋 **¿Qué cita quieres {verb}?**\n\n{_format_choices(active)}\n\n_Escribe el número o el ID, o 'cancelar' para salir._"}
+
+
+def _start_cancel_appointment(ctx: FlowContext) -> Dict:
+    return _start_manage(ctx, "cancel")
+
+
+def _start_reschedule(ctx: FlowContext) -> Dict:
+    return _start_manage(ctx, "reschedule")
+
+
+def _manage_chosen(ctx: FlowContext, appt: Dict) -> Dict:
+    ctx.pending.pop("choices", None)
+    ctx.pending.update(appointment_id=appt["appointment_id"], specialty=appt["specialty"])
+    if ctx.pending["op"] == "cancel":
+        ctx.next_state = "confirm_cancel"
+        return {"reply": f"❓ ¿Confirmas que quieres cancelar tu cita de **{appt['specialty']}** del **{appt['date']}** a las **{appt['time']}**?\n\n✅ Escribe **'sí'** para cancelarla\n↩️ Escribe **'no'** para conservarla"}
+    # "reprogramar mi cita para mañana a las 10" trae ya fecha y hora
+    slots = extract_slots(ctx.text)
+    ctx.pending.update({k: v for k, v in slots.items() if k in ("date", "time")})
+    return _advance_reschedule(ctx)
+
+
+def _chosen_appointment(ctx: FlowContext) -> Optional[str]:
+    choices = ctx.pending.get("choices", [])
+    ref = _appointment_ref(ctx)
+    if ref in choices:
+        return ref
+    if ctx.text.isdigit() and 1 <= int(ctx.text) <= len(choices):
+        return choices[int(ctx.text) - 1]
+    return None
+
+
+def _choose_appointment(ctx: FlowContext) -> Dict:
+    appt = database.get_appointment(ctx.match)
+    if appt is None or appt["status"] != database.STATUS_CONFIRMED:
+        ctx.pending = {}
+        ctx.next_state = "idle"
+        return {"reply": "⚠️ Esa cita ya no está vigente. Escribe 'mis citas' para ver tus reservas."}
+    return _manage_chosen(ctx, appt)
+
+
+def _choose_again(ctx: FlowContext) -> Dict:
+    return {"reply": f"🤔 No identifiqué la cita. Escribe el número de la lista (1 a {len(ctx.pending.get('choices', []))}) o su ID.\n\n_Escribe 'cancelar' para salir._"}
+
+
+def _confirm_cancel_appointment(ctx: FlowContext) -> Dict:
+    appt_id = ctx.pending.get("appointment_id")
+    ctx.pending = {}
+    try:
+        appt = database.cancel_appointment(appt_id, ctx.user_id, note="chat")
+    except ValueError:
+        return {"reply": "⚠️ Esa cita ya no está vigente. Escribe 'mis citas' para ver tus reservas."}
+    return {"reply": f"✅ Cita **{appt_id}** cancelada. El horario de **{appt['specialty']}** del {appt['date']} a las {appt['time']} quedó libre.\n\n¿Quieres agendar otra? Escribe 'quiero una cita'."}
+
+
+def _keep_appointment(ctx: FlowContext) -> Dict:
+    ctx.pending = {}
+    return {"reply": "👍 Perfecto, tu cita se mantiene. ¿En qué más puedo ayudarte?"}
+
+
+def _confirm_cancel_not_understood(ctx: FlowContext) -> Dict:
+    return {"reply": "🤔 No entendí tu respuesta.\n\n✅ Escribe **'sí'** para cancelar la cita\n↩️ Escribe **'no'** para conservarla"}
+
+
+def _advance_reschedule(ctx: FlowContext) -> Dict:
+    pending = ctx.pending
+    if not pending.get("date"):
+        ctx.next_state = "reschedule_date"
+        return {"reply": f"📅 **¿Para qué fecha quieres mover tu cita de {pending['specialty']}?**\n\nPuedes escribir 'mañana' o una fecha DD/MM/YYYY.\n\n_Escribe 'cancelar' para salir._"}
+    if not pending.get("time"):
+        ctx.next_state = "reschedule_time"
+        return _ask_time(pending["date"])
+    try:
+        if holds.held_by_other(ctx.user_id, pending["specialty"], pending["date"], pending["time"]):
+            raise database.SlotTakenError("slot held")
+        database.reschedule_appointment(pending["appointment_id"], pending["date"], pending["time"], ctx.user_id, note="chat")
+    except database.SlotTakenError:
+        pending.pop("time")
+        ctx.next_state = "reschedule_time"
+        return {"reply": f"{_get_message('time_unavailable')}\n\n{_ask_time(pending['date'])['reply']}"}
+    except ValueError:
+        ctx.pending = {}
+        ctx.next_state = "idle"
+        return {"reply": "⚠️ Esa cita ya no está vigente. Escribe 'mis citas' para ver tus reservas."}
+    ctx.pending = {}
+    ctx.next_state = "idle"
+    return {"reply": f"🔄 **¡Cita reprogramada!**\n\n📋 ID de cita: **{pending['appointment_id']}**\n👨‍⚕️ {pending['specialty']}\n📅 {pending['date']} a las {pending['time']}"}
+
+
+def _set_reschedule_date(ctx: FlowContext) -> Dict:
+    slots = extract_slots(ctx.text)
+    if "time" in slots:
+        ctx.pending["time"] = slots["time"]
+    ctx.pending["date"] = ctx.match
+    return _advance_reschedule(ctx)
+
+
+def _set_reschedule_time(ctx: FlowContext) -> Dict:
+    ctx.pending["time"] = ctx.match
+    return _advance_reschedule(ctx)
+
+
+def parse_slot(date_text: str, time_text: str) -> Tuple[str, str]:
+    """Valida fecha y hora para reservar o reprogramar; ValueError con el motivo."""
+    date = _parse_date(date_text)
+    if not date or not _is_valid_date(date):
+        raise ValueError("Fecha inválida o pasada")
+    time = _parse_time(time_text)
+    if time not in AVAILABLE_HOURS:
+        raise ValueError("Horario no disponible")
+    return date, time
+
+
+def _timing_hook(machine: str, state: str, rule: str, target: str, seconds: float):
+    metrics.inc(f"flow.{rule}")
+    metrics.inc(f"flow.{rule}.ms", round(seconds * 1000, 3))
+
+
+# === TABLA DE TRANSICIONES ===
+CANCEL_KEYWORDS = Keywords("cancelar", "cancel", "salir", "terminar", "no quiero")
+LIST_KEYWORDS = Keywords("mis citas", "ver citas", "consultar citas", "tengo citas")
+ACCEPT_OFFER_KEYWORDS = Keywords("acepto", "aceptar", "la quiero", "lo quiero", "lo tomo", "la tomo")
+
+BOOKING_FLOW = (
+    Flow("booking")
+    # Globales: en cualquier estado, antes que las del estado
+    .on_any("accept_offer", _open_offer, _accept_offer, "idle")
+    .on_any("cancel", CANCEL_KEYWORDS, _cancel, "idle")
+    .on_any("list_appointments", LIST_KEYWORDS, _list_appointments)
+    .on("idle", "start_booking", Keywords(*BOOK_KEYWORDS), _start_booking, "awaiting_specialty")
+    .on("idle", "start_booking_slots", _has_booking_slots, _start_booking, "awaiting_specialty")
+    .on("idle", "greet", always, _greet)
+    .on("awaiting_specialty", "set_specialty", _resolved_specialty, _set_specialty, "awaiting_date")
+    .on("awaiting_specialty", "reprompt_specialty", Keywords(*BOOK_KEYWORDS), _reprompt_specialty)
+    .on("awaiting_specialty", "suggest_specialty", always, _suggest_specialty)
+    .on("awaiting_date", "set_date", _valid_date, _set_date, "awaiting_time")
+    .on("awaiting_date", "past_date", _parsed_date, _past_date)
+    .on("awaiting_date", "date_error", always, _date_error)
+    .on("awaiting_time", "join_waitlist", Keywords("lista de espera", "avísame", "avisame", "anótame", "anotame"),
+        _join_waitlist, "idle")
+    .on("awaiting_time", "set_time", _available_time, _set_time, "confirm")
+    .on("awaiting_time", "time_unavailable", _parsed_time, _time_unavailable)
+    .on("awaiting_time", "time_error", always, _time_error)
+    .on("confirm", "confirm", Keywords("si", "sí", "s", "ok", "confirmar", "confirmo", "dale", "listo"), _confirm, "idle")
+    .on("confirm", "change", Keywords("no", "cambiar", "modificar", "editar"), _restart, "awaiting_specialty")
+    .on("confirm", "confirm_not_understood", always, _confirm_not_understood)
+)
+
+# Respuesta a "¿Confirmas que quieres cancelar tu cita?": "sí, cancelar" confirma
+# y no debe caer en la regla global que aborta el flujo
+YES_WORDS = Words("si", "sí", "confirmo", "dale", "ok", "claro", "adelante")
+NO_WORDS = Words("no", "conservar", "conservarla", "mantener", "mantenerla")
+
+
+def _confirms(ctx: FlowContext) -> bool:
+    return YES_WORDS(ctx) and not NO_WORDS(ctx)
+
+
+def _declines(ctx: FlowContext) -> bool:
+    return NO_WORDS(ctx) and not YES_WORDS(ctx)
+
+
+MANAGE_FLOW = (
+    Flow("manage")
+    # Entrada desde idle: antes que la regla global "cancelar" (abortar el flujo)
+    .on_entry("cancel_appointment", Keywords("cancelar mi cita", "cancelar la cita", "cancelar cita",
+                                             "cancelar una cita", "cancelar appt-", "anular"),
+              _start_cancel_appointment)
+    .on_entry("reschedule_appointment", Keywords("reprogramar", "reagendar", "cambiar mi cita",
+                                                 "cambiar la cita", "mover mi cita"),
+              _start_reschedule)
+    .on("choose_appointment", "choose_appointment", _chosen_appointment, _choose_appointment)
+    .on("choose_appointment", "choose_again", always, _choose_again)
+    .on_first("confirm_cancel", "confirm_cancel_appointment", _confirms, _confirm_cancel_appointment, "idle")
+    .on_first("confirm_cancel", "keep_appointment", _declines, _keep_appointment, "idle")
+    # "cancelar" a secas (o "sí... no") es ambiguo aquí: se vuelve a preguntar
+    .on_first("confirm_cancel", "confirm_cancel_ambiguous", Keywords("cancel"), _confirm_cancel_not_understood)
+    .on("confirm_cancel", "confirm_cancel_not_understood", always, _confirm_cancel_not_understood)
+    .on("reschedule_date", "set_reschedule_date", _valid_date, _set_reschedule_date)
+    .on("reschedule_date", "past_date", _parsed_date, _past_date)
+    .on("reschedule_date", "date_error", always, _date_error)
+    .on("reschedule_time", "set_reschedule_time", _available_time, _set_reschedule_time)
+    .on("reschedule_time", "time_unavailable", _parsed_time, _time_unavailable)
+    .on("reschedule_time", "time_error", always, _time_error)
+)
+
+machine = StateMachine("reservas", "idle", _persist, _fallback)
+machine.register(BOOKING_FLOW)
+machine.register(MANAGE_FLOW)
+machine.add_hook(_timing_hook)
+
+
+def register_flow(flow: Flow):
+    """Agrega (o reemplaza) un flujo conversacional, p. ej. reprogramar o cancelar por ID."""
+    machine.register(flow)
+
+
+def process_message(user_id: str, message: str, user: Dict = None) -> Dict:
+    """Procesa mensajes del usuario y maneja el flujo de reserva.
+
+    Si se pasa `user` (ya cargado por el llamador) se evita releer users.json;
+    el dict se actualiza en sitio con cada cambio de estado.
+    """
+    if user is None:
+        user = database.get_user(user_id)
+    if not user:
+        return {"reply": "⚠️ Usuario no encontrado. Por favor, regístrate primero."}
+
+    # Flujo a medias abandonado (p. ej. antes de un reinicio): se retoma desde idle
+    idle = _idle_seconds(user) if user.get("state", "idle") != "idle" else None
+    if idle is not None and idle >= holds.session_idle_seconds:
+        _set_state(user_id, user, "idle", {})
+        holds.release(user_id)
+        holds.end_session(user_id)
+        metrics.inc("sessions.expired")
+        result = machine.dispatch(FlowContext(user_id, user, message))
+        result["reply"] = f"⌛ Tu reserva en curso expiró por inactividad.\n\n{result['reply']}"
+        return result
+
+    return machine.dispatch(FlowContext(user_id, user, message))
@@ -0,0 +1,201 @@
+"""
+Motor de máquinas de estados declarativas para los flujos conversacionales.
+
+Un Flow declara reglas (guarda, acción y estado destino) por estado, reglas
+globales (cualquier estado) y reglas de entrada (estado inicial, evaluadas
+antes que las globales: ahí no hay un flujo en curso que abortar). Un
+estado puede declarar reglas prioritarias, evaluadas antes que las
+globales, cuando sus respuestas válidas contienen palabras de abortar
+("sí, cancelar" al confirmar una cancelación).
+StateMachine.register() compila todos los flujos en una tabla estado ->
+reglas ordenadas; dispatch() hace una búsqueda en la tabla y evalúa solo las
+reglas de ese estado. Las reglas consecutivas por palabras clave se agrupan
+en un único regex de prefiltro, así un mensaje sin ninguna de ellas (lo
+habitual) las descarta con una sola búsqueda.
+
+Registrar un flujo nuevo recompila la tabla y la reemplaza de una vez; el
+dispatch en curso sigue con la tabla anterior.
+"""
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+Guard = Callable[["FlowContext"], Any]
+Action = Callable[["FlowContext"], Dict]
+Hook = Callable[[str, str, str, Optional[str], float], None]
+
+
+class FlowContext:
+    """Datos de un mensaje durante el dispatch.
+
+    `match` guarda lo que devolvió la guarda de la regla elegida (por
+    ejemplo la fecha ya parseada) para que la acción no repita el trabajo.
+    Una acción puede fijar `next_state` para ir a otro estado que el
+    destino de la regla (p. ej. saltar pasos ya respondidos).
+    """
+
+    def __init__(self, user_id: str, user: Dict, message: str):
+        self.user_id = user_id
+        self.user = user
+        self.message = message
+        self.text = message.lower().strip()
+        self.state = user.get("state", "idle")
+        self.pending = dict(user.get("pending", {}) or {})
+        self.match = None
+        self.next_state = None
+
+
+class Keywords:
+    """Guarda: el texto contiene alguna de las palabras (subcadena)."""
+
+    def __init__(self, *words: str):
+        self.words = words
+        self.pattern = "|".join(re.escape(w) for w in words)
+        self._regex = re.compile(self.pattern)
+
+    def __call__(self, ctx: FlowContext) -> bool:
+        return self._regex.search(ctx.text) is not None
+
+
+class Words(Keywords):
+    """Guarda: el texto contiene alguna de las palabras completas ('si' no coincide en 'así')."""
+
+    def __init__(self, *words: str):
+        super().__init__(*words)
+        self.pattern = r"\b(?:" + self.pattern + r")\b"
+        self._regex = re.compile(self.pattern)
+
+
+def always(ctx: FlowContext) -> bool:
+    return True
+
+
+class Rule:
+    __slots__ = ("name", "guard", "action", "target")
+
+    def __init__(self, name: str, guard: Guard, action: Action, target: str = None):
+        self.name = name
+        self.guard = guard
+        self.action = action
+        self.target = target
+
+
+class Flow:
+    def __init__(self, name: str):
+        self.name = name
+        self.states: Dict[str, List[Rule]] = {}
+        self.global_rules: List[Rule] = []
+        self.entry_rules: List[Rule] = []
+        self.first_rules: Dict[str, List[Rule]] = {}
+
+    def on(self, state: str, name: str, guard: Guard, action: Action, target: str = None) -> "Flow":
+        self.states.setdefault(state, []).append(Rule(name, guard, action, target))
+        return self
+
+    def on_first(self, state: str, name: str, guard: Guard, action: Action, target: str = None) -> "Flow":
+        """Regla del estado evaluada antes que las globales."""
+        self.first_rules.setdefault(state, []).append(Rule(name, guard, action, target))
+        return self
+
+    def on_any(self, name: str, guard: Guard, action: Action, target: str = None) -> "Flow":
+        """Regla evaluada en cualquier estado, antes que las del estado."""
+        self.global_rules.append(Rule(name, guard, action, target))
+        return self
+
+    def on_entry(self, name: str, guard: Guard, action: Action, target: str = None) -> "Flow":
+        """Regla del estado inicial que abre este flujo."""
+        self.entry_rules.append(Rule(name, guard, action, target))
+        return self
+
+
+# (prefiltro o None, reglas)
+Segment = Tuple[Optional["re.Pattern"], Tuple[Rule, ...]]
+
+
+def _segments(rules: List[Rule]) -> Tuple[Segment, ...]:
+    segments = []
+    run: List[Rule] = []
+
+    def close_run():
+        if run:
+            prefilter = re.compile("|".join(r.guard.pattern for r in run))
+            segments.append((prefilter, tuple(run)))
+            run.clear()
+
+    for rule in rules:
+        if isinstance(rule.guard, Keywords):
+            run.append(rule)
+            continue
+        close_run()
+        segments.append((None, (rule,)))
+    close_run()
+    return tuple(segments)
+
+
+class StateMachine:
+    def __init__(self, name: str, initial: str, persist: Callable[[FlowContext, str], None],
+                 fallback: Action):
+        """`persist(ctx, estado)` guarda el estado y ctx.pending; `fallback` responde
+        cuando ninguna regla aplica (estado desconocido)."""
+        self.name = name
+        self.initial = initial
+        self.persist = persist
+        self.fallback = Rule("fallback", always, fallback, initial)
+        self.flows: List[Flow] = []
+        self.hooks: List[Hook] = []
+        self._table: Dict[str, Tuple[Segment, ...]] = {}
+        self._any: Tuple[Segment, ...] = ()  # solo globales: estados que ningún flujo declara
+        self._lock = threading.Lock()
+
+    def register(self, flow: Flow):
+        with self._lock:
+            self.flows = [f for f in self.flows if f.name != flow.name] + [flow]
+            self._table, self._any = self._compile()
+
+    def add_hook(self, hook: Hook):
+        """hook(máquina, estado, regla, estado destino, segundos) tras cada transición."""
+        self.hooks.append(hook)
+
+    def states(self) -> List[str]:
+        return list(self._table)
+
+    def _compile(self) -> Tuple[Dict[str, Tuple[Segment, ...]], Tuple[Segment, ...]]:
+        global_rules = [r for f in self.flows for r in f.global_rules]
+        entry_rules = [r for f in self.flows for r in f.entry_rules]
+        per_state: Dict[str, List[Rule]] = {self.initial: []}
+        first: Dict[str, List[Rule]] = {}
+        for flow in self.flows:
+            for state, rules in flow.states.items():
+                per_state.setdefault(state, []).extend(rules)
+            for state, rules in flow.first_rules.items():
+                per_state.setdefault(state, [])
+                first.setdefault(state, []).extend(rules)
+        table = {}
+        for state, rules in per_state.items():
+            entries = entry_rules if state == self.initial else []
+            table[state] = _segments(entries + first.get(state, []) + global_rules + rules)
+        return table, _segments(global_rules)
+
+    def _select(self, ctx: FlowContext) -> Rule:
+        for prefilter, rules in self._table.get(ctx.state, self._any):
+            if prefilter is not None and prefilter.search(ctx.text) is None:
+                continue
+            for rule in rules:
+                match = rule.guard(ctx)
+                if match:
+                    ctx.match = match
+                    return rule
+        return self.fallback
+
+    def dispatch(self, ctx: FlowContext) -> Dict:
+        start = time.perf_counter()
+        rule = self._select(ctx)
+        result = rule.action(ctx)
+        target = ctx.next_state or rule.target
+        if target is not None:
+            self.persist(ctx, target)
+        elapsed = time.perf_counter() - start
+        for hook in self.hooks:
+            hook(self.name, ctx.state, rule.name, target, elapsed)
+        return result
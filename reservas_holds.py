@@ -0,0 +1,304 @@
+"""
+Reservas temporales de horarios y expiración de sesiones inactivas.
+
+Cuando el paciente elige la hora, el horario (especialidad, fecha, hora)
+queda retenido a su nombre durante SLOT_HOLD_SECONDS: otros pacientes lo
+ven ocupado hasta que confirme, cancele o venza la retención. Las ofertas
+de la lista de espera retienen el horario ofrecido aparte (una por
+paciente), sin tocar la retención de la reserva que tenga en curso. Las sesiones
+con un flujo a medias vencen tras SESSION_IDLE_SECONDS sin avanzar y su
+estado vuelve a "idle".
+
+Los vencimientos los lleva una rueda de tiempo jerárquica: programar,
+reprogramar o anular un vencimiento es O(1) y cada tick solo mira el
+casillero que vence, sin recorrer las retenciones ni los usuarios. Un hilo
+en segundo plano avanza la rueda y duerme mientras está vacía.
+"""
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import reservas_config as config
+import reservas_metrics as metrics
+
+Slot = Tuple[str, str, str]  # (especialidad, fecha, hora)
+
+
+class TimingWheel:
+    """Rueda de tiempo jerárquica (niveles de `slots` casilleros).
+
+    El nivel 0 avanza un casillero por tick; cada casillero del nivel N
+    cubre slots**N ticks y, al llegar su turno, sus entradas se reparten en
+    los niveles inferiores. Con 64 casilleros y 4 niveles de 1 s el
+    horizonte es de ~194 días; lo que queda más lejos espera en el último
+    nivel y se reubica al pasar.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 4, now: float = None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._wheels: List[List[Dict]] = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._where: Dict[Hashable, Dict] = {}  # clave -> casillero donde está
+        self._current = self._to_tick(time.monotonic() if now is None else now)
+
+    def _to_tick(self, t: float) -> int:
+        return int(t / self.tick)
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def _place(self, key: Hashable, expires: int, payload):
+        # Nivel más bajo cuyo casillero no haya pasado todavía
+        for level in range(self.levels):
+            span = self.slots ** level
+            position = expires // span
+            if position - self._current // span < self.slots:
+                break
+        else:
+            # Más allá del horizonte: último casillero del nivel superior
+            position = self._current // span + self.slots - 1
+        bucket = self._wheels[level][position % self.slots]
+        bucket[key] = (expires, payload)
+        self._where[key] = bucket
+
+    def schedule(self, key: Hashable, deadline: float, payload=None, now: float = None):
+        """Programa (o reprograma) `key` para vencer en el instante monotonic `deadline`."""
+        self.cancel(key)
+        if not self._where:
+            # Vacía, nadie la avanzó: se alinea con el reloj antes de ubicar
+            self._current = max(self._current, self._to_tick(time.monotonic() if now is None else now))
+        expires = max(-(-deadline // self.tick), self._current + 1)
+        self._place(key, int(expires), payload)
+
+    def cancel(self, key: Hashable) -> bool:
+        bucket = self._where.pop(key, None)
+        if bucket is None:
+            return False
+        del bucket[key]
+        return True
+
+    def advance(self, now: float) -> List[Tuple[Hashable, object]]:
+        """Avanza hasta `now` y devuelve las entradas vencidas (clave, payload)."""
+        target = self._to_tick(now)
+        expired = []
+        while self._current < target and self._where:
+            self._current += 1
+            # Primero se reparten los niveles superiores que cambian de casillero
+            for level in range(self.levels - 1, 0, -1):
+                span = self.slots ** level
+                if self._current % span:
+                    continue
+                bucket = self._wheels[level][(self._current // span) % self.slots]
+                entries = list(bucket.items())
+                bucket.clear()
+                for key, (expires, payload) in entries:
+                    self._place(key, expires, payload)
+            bucket = self._wheels[0][self._current % self.slots]
+            for key, (_, payload) in bucket.items():
+                del self._where[key]
+                expired.append((key, payload))
+            bucket.clear()
+        # Rueda vacía: se salta directo al instante actual
+        self._current = max(self._current, target)
+        return expired
+
+
+class SlotHolds:
+    """Retenciones de horarios (una por usuario), ofertas de la lista de espera y vencimiento de sesiones."""
+
+    def __init__(self, hold_seconds: float, session_idle_seconds: float, tick: float = 1.0):
+        self.hold_seconds = hold_seconds
+        self.session_idle_seconds = session_idle_seconds
+        self._wheel = TimingWheel(tick)
+        self._holds: Dict[Slot, Tuple[str, float]] = {}  # horario -> (usuario, vence)
+        self._by_user: Dict[str, Slot] = {}
+        self._offers: Dict[Slot, Tuple[str, float]] = {}  # horario ofrecido -> (usuario, vence)
+        self._offer_by_user: Dict[str, Tuple[int, Slot]] = {}  # usuario -> (entrada de la lista, horario)
+        self._on_session_expired: Optional[Callable[[str], None]] = None
+        self._on_offer_expired: Optional[Callable[[int, str, Slot], None]] = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def on_session_expired(self, callback: Callable[[str], None]):
+        """callback(user_id) al vencer una sesión inactiva (desde el hilo de la rueda)."""
+        self._on_session_expired = callback
+
+    def on_offer_expired(self, callback: Callable[[int, str, Slot], None]):
+        """callback(entrada, user_id, horario) al vencer una oferta sin respuesta (desde el hilo de la rueda)."""
+        self._on_offer_expired = callback
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="reservas-holds", daemon=True)
+            self._thread.start()
+
+    def _schedule(self, key: Tuple[str, str], deadline: float):
+        with self._lock:
+            self._wheel.schedule(key, deadline)
+            self._ensure_thread()
+        self._wake.set()
+
+    # --- Retenciones ---
+
+    def _holder(self, slot: Slot, now: float) -> Optional[str]:
+        for hold in (self._holds.get(slot), self._offers.get(slot)):
+            if hold and hold[1] > now:
+                return hold[0]
+        return None
+
+    def place(self, user_id: str, specialty: str, date: str, time_: str) -> bool:
+        """Retiene el horario para `user_id`; False si otro paciente ya lo tiene retenido."""
+        slot = (specialty, date, time_)
+        now = time.monotonic()
+        with self._lock:
+            holder = self._holder(slot, now)
+            if holder is not None and holder != user_id:
+                metrics.inc("holds.conflict")
+                return False
+            self._release_locked(user_id)
+            deadline = now + self.hold_seconds
+            self._holds[slot] = (user_id, deadline)
+            self._by_user[user_id] = slot
+        self._schedule(("hold", user_id), deadline)
+        metrics.inc("holds.placed")
+        return True
+
+    def held_by_other(self, user_id: str, specialty: str, date: str, time_: str) -> bool:
+        with self._lock:
+            holder = self._holder((specialty, date, time_), time.monotonic())
+        return holder is not None and holder != user_id
+
+    def _release_locked(self, user_id: str) -> bool:
+        slot = self._by_user.pop(user_id, None)
+        if slot is None:
+            return False
+        if self._holds.get(slot, ("",))[0] == user_id:
+            del self._holds[slot]
+        self._wheel.cancel(("hold", user_id))
+        return True
+
+    def release(self, user_id: str):
+        """Libera la retención del usuario (confirmó, canceló o cambió de horario)."""
+        with self._lock:
+            released = self._release_locked(user_id)
+        if released:
+            metrics.inc("holds.released")
+
+    # --- Ofertas de la lista de espera ---
+
+    def offer(self, entry_id: int, user_id: str, specialty: str, date: str, time_: str,
+              seconds: float = None) -> bool:
+        """Retiene el horario ofrecido a la entrada `entry_id` (hold_seconds, o lo que le quede: `seconds`).
+
+        False si está retenido por otro o el paciente ya tiene una oferta.
+        """
+        slot = (specialty, date, time_)
+        now = time.monotonic()
+        with self._lock:
+            holder = self._holder(slot, now)
+            if (holder is not None and holder != user_id) or user_id in self._offer_by_user:
+                metrics.inc("holds.conflict")
+                return False
+            deadline = now + (self.hold_seconds if seconds is None else seconds)
+            self._offers[slot] = (user_id, deadline)
+            self._offer_by_user[user_id] = (entry_id, slot)
+        self._schedule(("offer", user_id), deadline)
+        metrics.inc("holds.offered")
+        return True
+
+    def offer_of(self, user_id: str) -> Optional[Tuple[int, Slot]]:
+        """(entrada, horario) de la oferta vigente del usuario, si tiene una."""
+        with self._lock:
+            offer = self._offer_by_user.get(user_id)
+            if offer is None or self._offers.get(offer[1], ("", 0.0))[1] <= time.monotonic():
+                return None
+            return offer
+
+    def offered_users(self) -> List[str]:
+        with self._lock:
+            return list(self._offer_by_user)
+
+    def _release_offer_locked(self, user_id: str) -> Optional[Tuple[int, Slot]]:
+        offer = self._offer_by_user.pop(user_id, None)
+        if offer is None:
+            return None
+        if self._offers.get(offer[1], ("",))[0] == user_id:
+            del self._offers[offer[1]]
+        self._wheel.cancel(("offer", user_id))
+        return offer
+
+    def release_offer(self, user_id: str):
+        """Libera la oferta del usuario (la aceptó o ya no aplica)."""
+        with self._lock:
+            released = self._release_offer_locked(user_id)
+        if released:
+            metrics.inc("holds.offer_released")
+
+    # --- Sesiones ---
+
+    def touch_session(self, user_id: str, idle_for: float = 0.0):
+        """El usuario avanzó en un flujo: vence tras session_idle_seconds sin otro cambio de estado."""
+        self._schedule(("session", user_id), time.monotonic() + self.session_idle_seconds - idle_for)
+
+    def end_session(self, user_id: str):
+        with self._lock:
+            self._wheel.cancel(("session", user_id))
+
+    # --- Rueda ---
+
+    def advance(self, now: float = None) -> int:
+        """Procesa los vencimientos hasta `now`; devuelve cuántos hubo."""
+        with self._lock:
+            expired = self._wheel.advance(time.monotonic() if now is None else now)
+            sessions = []
+            offers = []
+            for (kind, user_id), _ in expired:
+                if kind == "hold":
+                    self._release_locked(user_id)
+                    metrics.inc("holds.expired")
+                elif kind == "offer":
+                    offer = self._release_offer_locked(user_id)
+                    if offer is not None:
+                        offers.append((offer[0], user_id, offer[1]))
+                else:
+                    sessions.append(user_id)
+        for entry_id, user_id, slot in offers:
+            metrics.inc("holds.offer_expired")
+            if self._on_offer_expired is None:
+                continue
+            try:
+                self._on_offer_expired(entry_id, user_id, slot)
+            except Exception as e:
+                print(f"No se pudo cerrar la oferta {entry_id} de {user_id}: {e}")
+        callback = self._on_session_expired
+        for user_id in sessions:
+            metrics.inc("sessions.expired")
+            if callback is None:
+                continue
+            try:
+                callback(user_id)
+            except Exception as e:
+                print(f"No se pudo expirar la sesión de {user_id}: {e}")
+        return len(expired)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                empty = not len(self._wheel)
+                if empty:
+                    self._wake.clear()
+            if empty:
+                self._wake.wait()
+                continue
+            time.sleep(self._wheel.tick)
+            self.advance()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"holds": len(self._holds), "offers": len(self._offers), "scheduled": len(self._wheel)}
+
+
+holds = SlotHolds(config.SLOT_HOLD_SECONDS, config.SESSION_IDLE_SECONDS, config.HOLD_WHEEL_TICK_SECONDS)
+metrics.register_collector("holds", holds.snapshot)
@@ -1,22 +1,171 @@
 """Adaptador LLM/FAQ/flow para reservas médicas.
 
-Flujo: seguridad -> FAQ -> Google AI Studio (Gemini) -> flow de reserva.
+La ruta de cada mensaje (seguridad, flow de reserva, FAQ o LLM) la decide
+reservas_router, común a /chat y /chat/stream. Las llamadas al LLM van al
+proveedor más rápido disponible de reservas_providers (Gemini, API
+compatible con OpenAI u offline).
 """
-import os
-from typing import Dict, Generator
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Generator, Iterable, Optional
 from dotenv import load_dotenv
-import requests
-import json
 import reservas_flow as appointment_flow
 import reservas_sequrity as sequrity
 import reservas_database as database
-from reservas_faq import FAQMatcher
-from reservas_memory import MemoryManager
+from reservas_faq import get_faq_matcher
+from reservas_memory import MemoryManager, estimate_tokens
+from reservas_tracing import span
+from reservas_breaker import CircuitOpenError
+from reservas_admission import AdmissionController, LoadShedError, PRIORITY_HIGH, PRIORITY_NORMAL
+import reservas_config as config
+import reservas_metrics as metrics
+from reservas_router import router as ROUTER
+from reservas_cancel import CancelToken
+from reservas_providers import LLMPrompt, selector as provider_selector
 
 load_dotenv()
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-GOOGLE_MODEL = os.getenv("GOOGLE_MODEL", "gemini-1.5-flash")
+# Compartido entre requests: ChatbotService se instancia en cada /chat
+PROVIDERS = provider_selector
+
+# Cupos para llamadas al LLM: protege el threadpool de las rutas baratas
+LLM_ADMISSION = AdmissionController(
+    "llm",
+    max_concurrent=config.LLM_MAX_CONCURRENCY,
+    max_queue=config.LLM_MAX_QUEUE,
+    queue_timeout=config.LLM_QUEUE_TIMEOUT,
+)
+
+
+class StreamAccounting:
+    """Contabiliza streams completos y cancelados, y estima los tokens ahorrados.
+
+    El ahorro de un stream cancelado se estima como la longitud media de las
+    respuestas completas menos lo que ya se había generado.
+    """
+
+    def __init__(self, alpha: float = 0.1, initial_avg: float = 250):
+        self.alpha = alpha
+        self.avg_tokens = initial_avg
+        self._lock = threading.Lock()
+
+    def completed(self, tokens: int):
+        with self._lock:
+            self.avg_tokens += self.alpha * (tokens - self.avg_tokens)
+        metrics.inc("llm.stream_completed")
+        metrics.inc("llm.stream_tokens", tokens)
+
+    def cancelled(self, tokens: int):
+        with self._lock:
+            saved = max(0.0, self.avg_tokens - tokens)
+        metrics.inc("llm.stream_cancelled")
+        metrics.inc("llm.stream_tokens", tokens)
+        metrics.inc("llm.tokens_saved_estimate", round(saved))
+
+
+STREAM_ACCOUNTING = StreamAccounting()
+
+# Hilos para llamadas especulativas; el cupo real lo pone LLM_ADMISSION. Un hilo
+# por cupo de admisión (activos + cola): si no hay uno libre no se especula, así
+# nada espera en la cola sin límite del executor, fuera de LLM_MAX_QUEUE.
+_SPECULATIVE_WORKERS = config.LLM_MAX_CONCURRENCY + config.LLM_MAX_QUEUE
+_SPECULATIVE_POOL = ThreadPoolExecutor(max_workers=_SPECULATIVE_WORKERS, thread_name_prefix="llm-speculative")
+_SPECULATIVE_SLOTS = threading.BoundedSemaphore(_SPECULATIVE_WORKERS)
+
+
+class SpeculativeLLM:
+    """Llamada al LLM (streaming) lanzada en paralelo con la búsqueda en FAQ.
+
+    Los fragmentos se acumulan en una cola; el handler decide después si los
+    usa o cancela la llamada (FAQ con alta confianza o presupuesto agotado).
+    """
+
+    @classmethod
+    def start(cls, start_stream: Callable[[CancelToken], Iterable[str]],
+              parent: CancelToken = None) -> Optional["SpeculativeLLM"]:
+        """Lanza la llamada, o devuelve None si todos los hilos especulativos están ocupados."""
+        if not _SPECULATIVE_SLOTS.acquire(blocking=False):
+            metrics.inc("llm.speculative.skipped")
+            return None
+        try:
+            return cls(start_stream, parent)
+        except BaseException:
+            _SPECULATIVE_SLOTS.release()
+            raise
+
+    def __init__(self, start_stream: Callable[[CancelToken], Iterable[str]], parent: CancelToken = None):
+        """Usar SpeculativeLLM.start(): ocupa uno de los hilos reservados con _SPECULATIVE_SLOTS."""
+        self.cancel = CancelToken()
+        self.finished = False
+        self._items: queue.Queue = queue.Queue()
+        self._head = None
+        if parent is not None:
+            # Si se cancela el turno (cliente desconectado) se cancela también la especulación
+            parent.add_callback(lambda: self.abandon(parent.reason or "turno cancelado"))
+        ctx = contextvars.copy_context()
+        _SPECULATIVE_POOL.submit(ctx.run, self._run, start_stream)
+        metrics.inc("llm.speculative.started")
+
+    def _run(self, start_stream):
+        try:
+            for chunk in start_stream(self.cancel):
+                self._items.put(("chunk", chunk))
+            self._items.put(("done", None))
+        except Exception as e:
+            self._items.put(("error", e))
+        finally:
+            self.finished = True
+            _SPECULATIVE_SLOTS.release()
+
+    def _next(self, deadline: Optional[float]):
+        if self._head is not None:
+            item, self._head = self._head, None
+            return item
+        if deadline is None:
+            return self._items.get()
+        try:
+            return self._items.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            return None
+
+    def text(self, deadline: Optional[float] = None) -> Optional[str]:
+        """Respuesta completa, o None si no terminó antes de `deadline` (monotonic)."""
+        parts = []
+        while True:
+            item = self._next(deadline)
+            if item is None:
+                return None
+            kind, value = item
+            if kind == "done":
+                return "".join(parts)
+            if kind == "error":
+                raise value
+            parts.append(value)
+
+    def wait_first(self, deadline: Optional[float] = None) -> bool:
+        """Espera el primer fragmento (o el final de la llamada) hasta `deadline`."""
+        if self._head is None:
+            self._head = self._next(deadline)
+        return self._head is not None
+
+    def chunks(self) -> Generator[str, None, None]:
+        while True:
+            kind, value = self._next(None)
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value
+
+    def abandon(self, reason: str):
+        """Cancela la llamada si todavía está en curso."""
+        if self.finished or self.cancel.is_set():
+            return
+        metrics.inc("llm.speculative.cancelled")
+        self.cancel.cancel(reason)
 
 # Contexto del sistema para el LLM
 SYSTEM_CONTEXT = """Eres "MediBot", el asistente virtual de la Clínica San Rafael. Tu personalidad es cálida, empática y profesional.
@@ -62,12 +211,42 @@ SYSTEM_CONTEXT = """Eres "MediBot", el asistente virtual de la Clínica San Rafa
 
 
 class ChatbotService:
-    def __init__(self):
-        self.faq = FAQMatcher(threshold=0.65)
+    def __init__(self, session=None):
+        self.faq = get_faq_matcher()
         self.memory = MemoryManager(k=8)
+        # ChatSession opcional (WebSocket): usuario ya cargado
+        self.session = session
+
+    def _get_user(self, user_id: str) -> Dict:
+        if self.session is not None:
+            return self.session.user
+        return database.get_user(user_id)
+
+    def _recent_context(self, user_id: str) -> str:
+        return self.memory.build_context(user_id)
+
+    def _llm_available(self) -> bool:
+        """Algún proveedor configurado tiene el circuit breaker cerrado."""
+        return PROVIDERS.pick() is not None
 
-    def _build_prompt(self, user_message: str, context: str = "", user_name: str = "") -> str:
-        """Construye el prompt completo para Gemini."""
+    @staticmethod
+    def _llm_priority(user: Dict) -> int:
+        """Los pacientes a mitad de una reserva pasan primero en la cola del LLM."""
+        if user and (user.get("state", "idle") != "idle" or user.get("pending")):
+            return PRIORITY_HIGH
+        return PRIORITY_NORMAL
+
+    def _shed_reply(self, user_id: str, message: str):
+        """Respuesta degradada desde FAQ (umbral relajado) cuando el LLM está saturado."""
+        with span("chat.faq_shed"):
+            answer, sim = self.faq.find_answer(message, threshold=config.LLM_SHED_FAQ_THRESHOLD)
+        if not answer:
+            return None, sim
+        self._save_turn(user_id, message, answer)
+        return answer, sim
+
+    def _build_prompt(self, user_message: str, context: str = "", user_name: str = "") -> LLMPrompt:
+        """Construye el prompt para el proveedor de LLM."""
         import random
         
         # Variaciones para hacer el prompt más dinámico
@@ -77,177 +256,264 @@ class ChatbotService:
             "Responde como un asistente empático:",
             "Contesta de forma profesional pero cercana:",
         ]
-        
-        full_prompt = f"{SYSTEM_CONTEXT}\n\n"
-        
-        if user_name:
-            full_prompt += f"El paciente se llama: {user_name}\n\n"
-        
-        if context:
-            full_prompt += f"📝 Historial reciente de la conversación:\n{context}\n\n"
-        
-        full_prompt += f"💬 Mensaje del paciente: {user_message}\n\n"
-        full_prompt += random.choice(response_styles)
-        
-        return full_prompt
+        return LLMPrompt(SYSTEM_CONTEXT, user_message, context, user_name, random.choice(response_styles))
 
-    def _call_gemini(self, user_message: str, context: str = "", user_name: str = "") -> str:
-        """Llama a Google AI Studio (Gemini) API."""
-        if not GOOGLE_API_KEY:
-            raise RuntimeError("GOOGLE_API_KEY no configurada")
+    @staticmethod
+    def _pick_provider(kind: str):
+        provider = PROVIDERS.pick(kind)
+        if provider is None:
+            raise CircuitOpenError("Ningún proveedor de LLM disponible")
+        if not provider.breaker.allow_request():
+            raise CircuitOpenError(f"Circuit breaker de {provider.name} abierto")
+        return provider
 
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{GOOGLE_MODEL}:generateContent?key={GOOGLE_API_KEY}"
-        full_prompt = self._build_prompt(user_message, context, user_name)
-        
-        payload = {
-            "contents": [{"parts": [{"text": full_prompt}]}],
-            "generationConfig": {
-                "temperature": 0.85,  # Más variedad en respuestas
-                "maxOutputTokens": 1024,
-                "topP": 0.92,
-                "topK": 50  # Más opciones de tokens
-            }
-        }
+    def _call_llm(self, user_message: str, context: str = "", user_name: str = "",
+                  priority: int = PRIORITY_NORMAL, meta: Dict = None) -> str:
+        """Llama al proveedor de LLM más rápido disponible.
 
-        try:
-            resp = requests.post(url, json=payload, timeout=120)
-            resp.raise_for_status()
-            data = resp.json()
-            
-            if "candidates" in data and data["candidates"]:
-                candidate = data["candidates"][0]
-                if "content" in candidate and "parts" in candidate["content"]:
-                    parts = candidate["content"]["parts"]
-                    if parts and "text" in parts[0]:
-                        return parts[0]["text"]
-            
-            return "Lo siento, no pude generar una respuesta. ¿Puedo ayudarte con algo más?"
-        except Exception as e:
-            print(f"Error llamando a Gemini: {e}")
-            raise
+        `meta` (opcional) recibe el nombre del proveedor usado.
+        """
+        prompt = self._build_prompt(user_message, context, user_name)
 
-    def _call_gemini_stream(self, user_message: str, context: str = "", user_name: str = "") -> Generator[str, None, None]:
-        """Llama a Google AI Studio (Gemini) API con streaming."""
-        if not GOOGLE_API_KEY:
-            raise RuntimeError("GOOGLE_API_KEY no configurada")
+        with LLM_ADMISSION.slot(priority):
+            provider = self._pick_provider("generate")
+            if meta is not None:
+                meta["provider"] = provider.name
 
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{GOOGLE_MODEL}:streamGenerateContent?alt=sse&key={GOOGLE_API_KEY}"
-        full_prompt = self._build_prompt(user_message, context, user_name)
-        
-        payload = {
-            "contents": [{"parts": [{"text": full_prompt}]}],
-            "generationConfig": {
-                "temperature": 0.85,
-                "maxOutputTokens": 1024,
-                "topP": 0.92,
-                "topK": 50
-            }
-        }
+            start = time.monotonic()
+            try:
+                with span(f"llm.{provider.name}"):
+                    text = provider.generate(prompt)
+                latency = time.monotonic() - start
+                provider.breaker.record_success(latency)
+                provider.observe_latency("generate", latency)
+                metrics.inc(f"llm.{provider.name}.calls")
+                return text
+            except Exception as e:
+                provider.breaker.record_failure(time.monotonic() - start)
+                metrics.inc(f"llm.{provider.name}.failures")
+                print(f"Error llamando a {provider.name}: {e}")
+                raise
+
+    def _call_llm_stream(self, user_message: str, context: str = "", user_name: str = "",
+                         priority: int = PRIORITY_NORMAL, cancel=None,
+                         raise_errors: bool = False, meta: Dict = None) -> Generator[str, None, None]:
+        """Llama al proveedor de LLM más rápido disponible con streaming.
+
+        `cancel` (CancelToken) permite abortar la petición en curso, por ejemplo
+        cuando el cliente se desconecta. Con `raise_errors` los fallos se
+        propagan en lugar de emitir un mensaje de disculpa.
+        """
+        prompt = self._build_prompt(user_message, context, user_name)
+
+        with LLM_ADMISSION.slot(priority):
+            provider = self._pick_provider("stream")
+            if meta is not None:
+                meta["provider"] = provider.name
+            breaker = provider.breaker
+            if cancel is not None and cancel.is_set():
+                # Cancelado mientras esperaba cupo: no se llega a llamar al proveedor
+                breaker.record_cancelled()
+                return
+
+            # La latencia del stream se mide hasta el primer fragmento (el timeout
+            # de lectura aplica a cada espera entre fragmentos).
+            start = time.monotonic()
+            first_chunk_latency = None
+            generated_chars = 0
+            usage = {}
+            try:
+                with span(f"llm.{provider.name}_stream"):
+                    for chunk in provider.stream(prompt, cancel, usage):
+                        if first_chunk_latency is None:
+                            first_chunk_latency = time.monotonic() - start
+                        generated_chars += len(chunk)
+                        yield chunk
+                tokens = usage.get("output_tokens") or estimate_tokens(generated_chars)
+                if cancel is not None and cancel.is_set():
+                    breaker.record_cancelled()
+                    STREAM_ACCOUNTING.cancelled(tokens)
+                    return
+                latency = first_chunk_latency or time.monotonic() - start
+                breaker.record_success(latency)
+                provider.observe_latency("stream", latency)
+                STREAM_ACCOUNTING.completed(tokens)
+                metrics.inc(f"llm.{provider.name}.calls")
+            except GeneratorExit:
+                # El consumidor dejó de leer: no es un fallo del proveedor
+                breaker.record_cancelled()
+                STREAM_ACCOUNTING.cancelled(usage.get("output_tokens") or estimate_tokens(generated_chars))
+                raise
+            except Exception as e:
+                if cancel is not None and cancel.is_set():
+                    # La lectura falló porque cerramos la conexión a propósito
+                    breaker.record_cancelled()
+                    STREAM_ACCOUNTING.cancelled(usage.get("output_tokens") or estimate_tokens(generated_chars))
+                    return
+                breaker.record_failure(time.monotonic() - start)
+                metrics.inc(f"llm.{provider.name}.failures")
+                print(f"Error en streaming de {provider.name}: {e}")
+                if raise_errors:
+                    raise
+                yield "Lo siento, hubo un error. ¿Puedo ayudarte con algo más?"
 
+    def _run_flow(self, user_id: str, message: str, user: Dict = None) -> str:
+        with span("chat.flow"):
+            result = appointment_flow.process_message(user_id, message, user)
+        return result.get("reply", "")
+
+    def _save_turn(self, user_id: str, message: str, reply: str):
+        """Persiste el mensaje del usuario y la respuesta del asistente."""
+        with span("chat.persist"):
+            self.memory.add_turn(user_id, message, reply)
+
+    def _route(self, endpoint: str, user_id: str, message: str, user: Dict, cancel=None) -> Dict:
+        def faq_lookup():
+            with span("chat.faq"):
+                return self.faq.find_answer(message)
+
+        def speculate():
+            with span("chat.context"):
+                context = self._recent_context(user_id)
+            user_name = user.get("name", "") if user else ""
+            priority = self._llm_priority(user)
+            # En /chat un fallo del LLM pasa a la siguiente ruta; en streaming se disculpa
+            raise_errors = endpoint == "chat"
+            return SpeculativeLLM.start(
+                lambda token: self._call_llm_stream(message, context, user_name, priority, token, raise_errors, llm_meta),
+                parent=cancel,
+            )
+
+        llm_meta = {}
+        with span("chat.route"):
+            decision = ROUTER.decide(endpoint, message, user, faq_lookup, self._llm_available(), speculate)
+        decision["llm"] = llm_meta
+        return decision
+
+    @staticmethod
+    def _speculation_deadline(decision: Dict) -> Optional[float]:
+        """Con una respuesta FAQ de respaldo, el LLM solo gana dentro del presupuesto del turno."""
+        return ROUTER.budget_deadline(decision) if decision["faq"][0] else None
+
+    @staticmethod
+    def _speculation_lost(decision: Dict):
+        decision["speculative"].abandon("presupuesto del turno agotado")
+        metrics.inc("llm.speculative.budget_expired")
+        ROUTER.failed(decision, "llm")
+
+    @staticmethod
+    def _abandon_speculation(decision: Dict, reason: str):
+        if decision["speculative"] is not None:
+            decision["speculative"].abandon(reason)
+
+    @staticmethod
+    def _flow_reasoning(route: str, decision: Dict) -> str:
+        if route == "flow":
+            return f"Flujo de reserva activo (estado: {decision['features']['state']})"
+        if route == "booking":
+            return "Intención de reserva detectada"
+        return "Respuesta del flow de reserva"
+
+    def handle_chat_stream(self, user_id: str, message: str, cancel=None) -> Generator[Dict, None, None]:
+        """Maneja el chat con streaming para respuestas en tiempo real.
+
+        La ruta la decide el router (igual que en handle_chat). Si `cancel` se
+        activa durante la respuesta del LLM, se aborta la petición y se emite
+        {"type": "cancelled"} sin guardar el turno.
+        """
+        with span("chat.user"):
+            user = self._get_user(user_id)
+        decision = self._route("stream", user_id, message, user, cancel)
         try:
-            with requests.post(url, json=payload, timeout=120, stream=True) as resp:
-                resp.raise_for_status()
-                for line in resp.iter_lines():
-                    if line:
-                        line_text = line.decode('utf-8')
-                        if line_text.startswith('data: '):
-                            json_str = line_text[6:]
-                            try:
-                                data = json.loads(json_str)
-                                if "candidates" in data and data["candidates"]:
-                                    candidate = data["candidates"][0]
-                                    if "content" in candidate and "parts" in candidate["content"]:
-                                        parts = candidate["content"]["parts"]
-                                        if parts and "text" in parts[0]:
-                                            yield parts[0]["text"]
-                            except json.JSONDecodeError:
-                                continue
-        except Exception as e:
-            print(f"Error en streaming de Gemini: {e}")
-            yield "Lo siento, hubo un error. ¿Puedo ayudarte con algo más?"
+            yield from self._stream_plan(user_id, message, user, decision, cancel)
+        finally:
+            self._abandon_speculation(decision, "turno terminado")
 
-    def handle_chat_stream(self, user_id: str, message: str) -> Generator[Dict, None, None]:
-        """Maneja el chat con streaming para respuestas en tiempo real."""
-        
-        # 1. Verificación de seguridad
-        for pal in sequrity.palabras_in:
-            if pal in message.lower():
+    def _stream_plan(self, user_id: str, message: str, user: Dict, decision: Dict,
+                     cancel=None) -> Generator[Dict, None, None]:
+        for route in decision["plan"]:
+            if route == "security":
+                ROUTER.observe(decision, route)
                 yield {"type": "complete", "text": sequrity.responses[0], "reasoning": "Seguridad"}
                 return
 
-        # 2. Buscar en FAQ
-        faq_answer, sim = self.faq.find_answer(message)
-        if faq_answer:
-            self.memory.add_user_message(user_id, message)
-            self.memory.add_ai_message(user_id, faq_answer)
-            database.add_message_to_chat(user_id, "user", message)
-            database.add_message_to_chat(user_id, "assistant", faq_answer)
-            yield {"type": "complete", "text": faq_answer, "reasoning": f"FAQ ({sim:.2f})"}
-            return
+            if route == "faq":
+                faq_answer, sim = decision["faq"]
+                self._abandon_speculation(decision, "respuesta FAQ")
+                self._save_turn(user_id, message, faq_answer)
+                ROUTER.observe(decision, route)
+                yield {"type": "complete", "text": faq_answer, "reasoning": f"FAQ ({sim:.2f})"}
+                return
 
-        # 3. Verificar si el usuario está en un flujo de reserva
-        user = database.get_user(user_id)
-        user_state = user.get("state", "idle") if user else "idle"
-        
-        if user_state != "idle":
-            result = appointment_flow.process_message(user_id, message)
-            reply = result.get("reply", "")
-            self.memory.add_user_message(user_id, message)
-            self.memory.add_ai_message(user_id, reply)
-            database.add_message_to_chat(user_id, "user", message)
-            database.add_message_to_chat(user_id, "assistant", reply)
-            yield {"type": "complete", "text": reply, "reasoning": f"Flow ({user_state})"}
-            return
+            if route == "llm":
+                try:
+                    spec = decision["speculative"]
+                    if spec is not None:
+                        if not spec.wait_first(self._speculation_deadline(decision)):
+                            self._speculation_lost(decision)
+                            continue
+                        chunks = spec.chunks()
+                    else:
+                        with span("chat.context"):
+                            context = self._recent_context(user_id)
+                        user_name = user.get("name", "") if user else ""
+                        chunks = self._call_llm_stream(message, context, user_name, self._llm_priority(user), cancel,
+                                                       meta=decision["llm"])
 
-        # 4. Detectar intención de reservar
-        booking_keywords = ["cita", "reserv", "agend", "turno", "consulta", "doctor", "médico"]
-        if any(kw in message.lower() for kw in booking_keywords):
-            result = appointment_flow.process_message(user_id, message)
-            reply = result.get("reply", "")
-            self.memory.add_user_message(user_id, message)
-            self.memory.add_ai_message(user_id, reply)
-            database.add_message_to_chat(user_id, "user", message)
-            database.add_message_to_chat(user_id, "assistant", reply)
-            yield {"type": "complete", "text": reply, "reasoning": "Intención reserva"}
-            return
+                    parts = []
+                    first_chunk_latency = None
+                    for chunk in chunks:
+                        if first_chunk_latency is None:
+                            first_chunk_latency = time.monotonic() - decision["started"]
+                        parts.append(chunk)
+                        yield {"type": "chunk", "text": chunk}
+                    full_text = "".join(parts)
 
-        # 5. Usar Gemini con streaming
-        if GOOGLE_API_KEY:
-            try:
-                recent = self.memory.get_recent_messages(user_id, k=4)
-                context = "\n".join([f"{m['role']}: {m['content']}" for m in recent])
-                user_name = user.get("name", "") if user else ""
-                
-                full_text = ""
-                for chunk in self._call_gemini_stream(message, context, user_name):
-                    full_text += chunk
-                    yield {"type": "chunk", "text": chunk}
-                
-                # Guardar mensaje completo
-                self.memory.add_user_message(user_id, message)
-                self.memory.add_ai_message(user_id, full_text)
-                database.add_message_to_chat(user_id, "user", message)
-                database.add_message_to_chat(user_id, "assistant", full_text)
-                yield {"type": "done", "reasoning": "Gemini"}
-                return
-            except Exception as e:
-                print(f"Gemini streaming falló: {e}")
+                    if cancel is not None and cancel.is_set():
+                        yield {"type": "cancelled", "reasoning": cancel.reason or "Cliente desconectado"}
+                        return
 
-        # 6. Fallback
-        result = appointment_flow.process_message(user_id, message)
-        reply = result.get("reply", "")
-        self.memory.add_user_message(user_id, message)
-        self.memory.add_ai_message(user_id, reply)
-        database.add_message_to_chat(user_id, "user", message)
-        database.add_message_to_chat(user_id, "assistant", reply)
-        yield {"type": "complete", "text": reply, "reasoning": "Fallback"}
+                    # Guardar mensaje completo
+                    self._save_turn(user_id, message, full_text)
+                    # En streaming lo que percibe el usuario es el primer fragmento
+                    ROUTER.observe(decision, route, first_chunk_latency)
+                    yield {"type": "done", "reasoning": f"LLM ({decision['llm'].get('provider')})"}
+                    return
+                except LoadShedError as e:
+                    print(f"LLM saturado, degradando a FAQ: {e}")
+                    ROUTER.failed(decision, route)
+                    shed_answer, shed_sim = self._shed_reply(user_id, message)
+                    if shed_answer:
+                        ROUTER.observe(decision, "faq_shed")
+                        yield {"type": "complete", "text": shed_answer, "reasoning": f"LLM saturado → FAQ ({shed_sim:.2f})"}
+                        return
+                except Exception as e:
+                    print(f"LLM streaming falló: {e}")
+                    ROUTER.failed(decision, route)
+                continue
+
+            # flow, booking o fallback
+            reply = self._run_flow(user_id, message, user)
+            self._save_turn(user_id, message, reply)
+            ROUTER.observe(decision, route)
+            yield {"type": "complete", "text": reply, "reasoning": self._flow_reasoning(route, decision)}
+            return
 
     def handle_chat(self, user_id: str, message: str) -> Dict:
-        # 1. Verificación de seguridad
-        for pal in sequrity.palabras_in:
-            if pal in message.lower():
+        with span("chat.user"):
+            user = self._get_user(user_id)
+        decision = self._route("chat", user_id, message, user)
+        try:
+            return self._chat_plan(user_id, message, user, decision)
+        finally:
+            self._abandon_speculation(decision, "turno terminado")
+
+    def _chat_plan(self, user_id: str, message: str, user: Dict, decision: Dict) -> Dict:
+        for route in decision["plan"]:
+            if route == "security":
+                ROUTER.observe(decision, route)
                 return {
-                    "reasoning": f"Palabra prohibida detectada: {pal}",
+                    "reasoning": f"Palabra prohibida detectada: {decision['features']['security_word']}",
                     "to_user": sequrity.responses[0],
                     "data": None,
                     "action": None,
@@ -255,117 +521,69 @@ class ChatbotService:
                     "faq_similarity": 0.0,
                 }
 
-        # 2. Verificar si el usuario está en un flujo de reserva activo
-        user = database.get_user(user_id)
-        user_state = user.get("state", "idle") if user else "idle"
-        
-        if user_state != "idle":
-            result = appointment_flow.process_message(user_id, message)
-            reply = result.get("reply", "")
-            self.memory.add_user_message(user_id, message)
-            self.memory.add_ai_message(user_id, reply)
-            database.add_message_to_chat(user_id, "user", message)
-            database.add_message_to_chat(user_id, "assistant", reply)
-            return {
-                "reasoning": f"Flujo de reserva activo (estado: {user_state})",
-                "to_user": reply,
-                "data": None,
-                "action": None,
-                "is_faq_response": False,
-            }
-
-        # 3. Detectar intención de reservar (ANTES del FAQ y Gemini)
-        booking_keywords = ["cita", "reserv", "agend", "turno", "agendar", "reservar", "necesito ver"]
-        if any(kw in message.lower() for kw in booking_keywords):
-            result = appointment_flow.process_message(user_id, message)
-            reply = result.get("reply", "")
-            self.memory.add_user_message(user_id, message)
-            self.memory.add_ai_message(user_id, reply)
-            database.add_message_to_chat(user_id, "user", message)
-            database.add_message_to_chat(user_id, "assistant", reply)
-            return {
-                "reasoning": "Intención de reserva detectada",
-                "to_user": reply,
-                "data": None,
-                "action": None,
-                "is_faq_response": False,
-            }
-
-        # 4. Preguntas informativas → LLM genera respuesta variada
-        info_keywords = ["horario", "hora", "precio", "costo", "cuanto", "cuánto", "pago", "tarjeta", 
-                        "efectivo", "seguro", "especialidad", "doctor", "médico", "yape", "plin",
-                        "abren", "cierran", "atienden", "cobran", "tarifa"]
-        is_info_question = any(kw in message.lower() for kw in info_keywords)
-        
-        if is_info_question and GOOGLE_API_KEY:
-            try:
-                user_name = user.get("name", "") if user else ""
-                text = self._call_gemini(message, "", user_name)
-                self.memory.add_user_message(user_id, message)
-                self.memory.add_ai_message(user_id, text)
-                database.add_message_to_chat(user_id, "user", message)
-                database.add_message_to_chat(user_id, "assistant", text)
+            if route == "faq":
+                faq_answer, sim = decision["faq"]
+                self._abandon_speculation(decision, "respuesta FAQ")
+                self._save_turn(user_id, message, faq_answer)
+                ROUTER.observe(decision, route)
                 return {
-                    "reasoning": "Pregunta informativa → Gemini",
-                    "to_user": text,
+                    "reasoning": f"Respuesta desde FAQ (similitud: {sim:.2f})",
+                    "to_user": faq_answer,
                     "data": None,
                     "action": None,
-                    "is_faq_response": False,
+                    "is_faq_response": True,
+                    "faq_similarity": sim,
                 }
-            except Exception as e:
-                print(f"Gemini falló para pregunta informativa: {e}")
-                # Si falla, usar FAQ como fallback
-
-        # 5. Buscar en FAQ (fallback si LLM no está disponible)
-        faq_answer, sim = self.faq.find_answer(message)
-        if faq_answer:
-            self.memory.add_user_message(user_id, message)
-            self.memory.add_ai_message(user_id, faq_answer)
-            database.add_message_to_chat(user_id, "user", message)
-            database.add_message_to_chat(user_id, "assistant", faq_answer)
+
+            if route == "llm":
+                try:
+                    if decision["speculative"] is not None:
+                        text = decision["speculative"].text(self._speculation_deadline(decision))
+                        if text is None:
+                            self._speculation_lost(decision)
+                            continue
+                    else:
+                        with span("chat.context"):
+                            context = self._recent_context(user_id)
+                        user_name = user.get("name", "") if user else ""
+                        text = self._call_llm(message, context, user_name, self._llm_priority(user), decision["llm"])
+                    self._save_turn(user_id, message, text)
+                    ROUTER.observe(decision, route)
+                    return {
+                        "reasoning": f"Respuesta generada por LLM ({decision['llm'].get('provider')})",
+                        "to_user": text,
+                        "data": None,
+                        "action": None,
+                        "is_faq_response": False,
+                    }
+                except LoadShedError as e:
+                    # Sobrecarga del LLM → FAQ con umbral relajado en lugar de esperar
+                    print(f"LLM saturado, degradando a FAQ: {e}")
+                    ROUTER.failed(decision, route)
+                    shed_answer, shed_sim = self._shed_reply(user_id, message)
+                    if shed_answer:
+                        ROUTER.observe(decision, "faq_shed")
+                        return {
+                            "reasoning": f"LLM saturado → FAQ (similitud: {shed_sim:.2f})",
+                            "to_user": shed_answer,
+                            "data": None,
+                            "action": None,
+                            "is_faq_response": True,
+                            "faq_similarity": shed_sim,
+                        }
+                except Exception as e:
+                    print(f"LLM falló, siguiente ruta: {e}")
+                    ROUTER.failed(decision, route)
+                continue
+
+            # flow, booking o fallback
+            reply = self._run_flow(user_id, message, user)
+            self._save_turn(user_id, message, reply)
+            ROUTER.observe(decision, route)
             return {
-                "reasoning": f"Respuesta desde FAQ (similitud: {sim:.2f})",
-                "to_user": faq_answer,
+                "reasoning": self._flow_reasoning(route, decision),
+                "to_user": reply,
                 "data": None,
                 "action": None,
-                "is_faq_response": True,
-                "faq_similarity": sim,
+                "is_faq_response": False,
             }
-
-        # 6. Usar Gemini para respuestas generales
-        if GOOGLE_API_KEY:
-            try:
-                # Obtener contexto de conversación y nombre del usuario
-                recent = self.memory.get_recent_messages(user_id, k=4)
-                context = "\n".join([f"{m['role']}: {m['content']}" for m in recent])
-                user_name = user.get("name", "") if user else ""
-                
-                text = self._call_gemini(message, context, user_name)
-                self.memory.add_user_message(user_id, message)
-                self.memory.add_ai_message(user_id, text)
-                database.add_message_to_chat(user_id, "user", message)
-                database.add_message_to_chat(user_id, "assistant", text)
-                return {
-                    "reasoning": "Respuesta generada por Gemini",
-                    "to_user": text,
-                    "data": None,
-                    "action": None,
-                    "is_faq_response": False,
-                }
-            except Exception as e:
-                print(f"Gemini falló, usando flow: {e}")
-
-        # 7. Fallback al flujo de reserva
-        result = appointment_flow.process_message(user_id, message)
-        reply = result.get("reply", "")
-        self.memory.add_user_message(user_id, message)
-        self.memory.add_ai_message(user_id, reply)
-        database.add_message_to_chat(user_id, "user", message)
-        database.add_message_to_chat(user_id, "assistant", reply)
-        return {
-            "reasoning": "Respuesta del flow de reserva",
-            "to_user": reply,
-            "data": None,
-            "action": None,
-            "is_faq_response": False,
-        }
@@ -1,21 +1,131 @@
 """
 Simple memory manager for conversational context (reservas).
+
+El contexto para el LLM sale de una caché en memoria por usuario: un buffer
+circular con los mensajes recientes ya formateados ("role: content") y su
+tamaño aproximado en tokens. Se carga de disco la primera vez y después se
+actualiza en cada append, sin volver a leer chats.json.
+
+La caché es por proceso: con varios workers cada uno ve sus propias
+escrituras, como el rate limiter en memoria.
 """
+import threading
+from collections import OrderedDict, deque
 from typing import List, Dict
+
+import reservas_config as config
 import reservas_database as database
+import reservas_metrics as metrics
 
 DEFAULT_K = 8
 
 
+def estimate_tokens(chars: int) -> int:
+    """Aproximación de tokens (~4 caracteres por token)."""
+    return (chars + 3) // 4
+
+
+class _UserContext:
+    def __init__(self, window: int):
+        self.lines = deque(maxlen=window)  # (línea formateada, tokens)
+        self.version = 0
+        self.built: Dict[int, tuple] = {}  # max_tokens -> (version, texto)
+
+
+class ContextCache:
+    def __init__(self, window: int, max_users: int):
+        self.window = window
+        self.max_users = max_users
+        self._users: "OrderedDict[str, _UserContext]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _format(message: Dict) -> tuple:
+        line = f"{message['role']}: {message['content']}"
+        # +1 por el salto de línea que las separa
+        return line, estimate_tokens(len(line) + 1)
+
+    def _get(self, user_id: str) -> _UserContext:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                self._users.move_to_end(user_id)
+                metrics.inc("context.cache_hits")
+                return entry
+        # Primera consulta del usuario: se lee el historial una sola vez
+        messages = database.get_chat_messages(user_id)[-self.window:]
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = _UserContext(self.window)
+                entry.lines.extend(self._format(m) for m in messages)
+                self._users[user_id] = entry
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+                metrics.inc("context.cache_misses")
+            return entry
+
+    def warm(self, user_id: str):
+        self._get(user_id)
+
+    def append(self, user_id: str, messages: List[Dict]):
+        """Agrega mensajes ya persistidos; si el usuario no está en caché no hace nada."""
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return
+            entry.lines.extend(self._format(m) for m in messages)
+            entry.version += 1
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def build(self, user_id: str, max_tokens: int) -> str:
+        """Mensajes más recientes que caben en max_tokens, del más antiguo al más nuevo."""
+        entry = self._get(user_id)
+        with self._lock:
+            cached = entry.built.get(max_tokens)
+            if cached is not None and cached[0] == entry.version:
+                return cached[1]
+            selected = []
+            used = 0
+            for line, tokens in reversed(entry.lines):
+                if used + tokens > max_tokens:
+                    break
+                selected.append(line)
+                used += tokens
+            text = "\n".join(reversed(selected))
+            entry.built[max_tokens] = (entry.version, text)
+            return text
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+
+context_cache = ContextCache(config.CONTEXT_WINDOW_MESSAGES, config.CONTEXT_CACHE_USERS)
+metrics.register_collector("context", lambda: {"users": len(context_cache)})
+
+
 class MemoryManager:
     def __init__(self, k: int = DEFAULT_K):
         self.k = k
 
     def add_user_message(self, user_id: str, message: str):
         database.add_message_to_chat(user_id, "user", message)
+        context_cache.append(user_id, [{"role": "user", "content": message}])
 
     def add_ai_message(self, user_id: str, message: str):
         database.add_message_to_chat(user_id, "assistant", message)
+        context_cache.append(user_id, [{"role": "assistant", "content": message}])
+
+    def add_turn(self, user_id: str, user_message: str, ai_message: str):
+        messages = [
+            {"role": "user", "content": user_message},
+            {"role": "assistant", "content": ai_message},
+        ]
+        database.add_messages_to_chat(user_id, messages)
+        context_cache.append(user_id, messages)
 
     def get_recent_messages(self, user_id: str, k: int = None) -> List[Dict]:
         if k is None:
@@ -23,11 +133,18 @@ class MemoryManager:
         messages = database.get_chat_messages(user_id)
         return messages[-k:] if len(messages) > k else messages
 
+    def build_context(self, user_id: str, max_tokens: int = None) -> str:
+        """Historial reciente formateado para el prompt, recortado por tokens."""
+        if max_tokens is None:
+            max_tokens = config.CONTEXT_MAX_TOKENS
+        return context_cache.build(user_id, max_tokens)
+
     def clear_memory(self, user_id: str):
         chats = database.load_json(database.CHATS_FILE)
         if user_id in chats:
             chats[user_id]["messages"] = []
             database.save_json(database.CHATS_FILE, chats)
+        context_cache.invalidate(user_id)
 
     def get_summary(self, user_id: str) -> str:
         messages = database.get_chat_messages(user_id)
@@ -0,0 +1,40 @@
+"""
+Métricas en memoria del proceso: contadores, gauges y colectores.
+
+Los colectores son funciones que devuelven un dict y se evalúan al pedir el
+snapshot, útil para componentes que ya guardan su propio estado.
+"""
+import threading
+from typing import Callable, Dict
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_collectors: Dict[str, Callable[[], Dict]] = {}
+
+
+def inc(name: str, value: float = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float):
+    with _lock:
+        _gauges[name] = value
+
+
+def register_collector(name: str, fn: Callable[[], Dict]):
+    with _lock:
+        _collectors[name] = fn
+
+
+def snapshot() -> Dict:
+    with _lock:
+        data = {"counters": dict(_counters), "gauges": dict(_gauges)}
+        collectors = dict(_collectors)
+    for name, fn in collectors.items():
+        try:
+            data[name] = fn()
+        except Exception as e:
+            data[name] = {"error": str(e)}
+    return data
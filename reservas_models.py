@@ -39,3 +39,14 @@ class Appointment(BaseModel):
 class AppointmentResponse(BaseModel):
     appointment_id: str
     message: str
+
+
+class AppointmentCancelRequest(BaseModel):
+    user_id: str
+    reason: Optional[str] = None
+
+
+class AppointmentRescheduleRequest(BaseModel):
+    user_id: str
+    date: str  # YYYY-MM-DD o DD/MM/YYYY
+    time: str  # HH:MM
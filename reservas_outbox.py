@@ -0,0 +1,187 @@
+"""
+Envío asíncrono de avisos a pacientes desde el outbox de appointments.db.
+
+Confirmar, cancelar o reprogramar una cita encola el aviso en la tabla
+outbox dentro de la misma transacción (reservas_database), así no se pierde
+un aviso de una cita guardada ni se avisa de una que no se guardó. Un pool
+de OUTBOX_WORKERS hilos toma los avisos vencidos en lotes, los entrega con
+el sender configurado y reintenta los fallidos con backoff exponencial
+hasta OUTBOX_MAX_ATTEMPTS. Cada aviso lleva su clave de idempotencia para
+que el proveedor (SMS, correo, WhatsApp) descarte los reenvíos.
+
+OUTBOX_SENDER=actions entrega con reservas_actions.execute_action;
+OUTBOX_SENDER=fake usa FakeSender, que solo registra lo enviado (pruebas
+locales, con fallos simulados opcionales).
+"""
+import abc
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+import reservas_config as config
+import reservas_database as database
+import reservas_metrics as metrics
+from reservas_actions import execute_action
+
+
+class Sender(abc.ABC):
+    """Entrega un lote de avisos; devuelve {id del aviso: error o None}."""
+
+    def send_batch(self, jobs: List[Dict]) -> Dict[int, Optional[str]]:
+        results = {}
+        for job in jobs:
+            try:
+                results[job["id"]] = self.send(job)
+            except Exception as e:
+                results[job["id"]] = str(e) or type(e).__name__
+        return results
+
+    @abc.abstractmethod
+    def send(self, job: Dict) -> Optional[str]:
+        """Entrega un aviso; devuelve el error o None si se entregó."""
+
+
+class ActionSender(Sender):
+    def send(self, job: Dict) -> Optional[str]:
+        data = dict(job["payload"], idempotency_key=job["idempotency_key"])
+        command = {"recordatorio": "remind", "oferta": "offer_slot"}.get(job["event"], "notify")
+        result = execute_action({"command": command, "data": data})
+        return None if result.get("success") else result.get("message", "envío fallido")
+
+
+class FakeSender(Sender):
+    """Sender local: guarda los avisos entregados por clave de idempotencia."""
+
+    def __init__(self, fail_rate: float = 0.0, latency: float = 0.0):
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.delivered: Dict[str, Dict] = {}
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    def send(self, job: Dict) -> Optional[str]:
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_rate and random.random() < self.fail_rate:
+            return "fallo simulado"
+        with self._lock:
+            if job["idempotency_key"] in self.delivered:
+                self.duplicates += 1
+            self.delivered[job["idempotency_key"]] = job["payload"]
+        return None
+
+
+def build_sender(name: str) -> Sender:
+    if name == "fake":
+        return FakeSender(config.OUTBOX_FAKE_FAIL_RATE)
+    return ActionSender()
+
+
+class OutboxDispatcher:
+    def __init__(self, sender: Sender, workers: int, batch_size: int, poll_seconds: float,
+                 lease_seconds: float, max_attempts: int, backoff_base: float, backoff_max: float):
+        self.sender = sender
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._stopping.clear()
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._run, name=f"reservas-outbox-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, timeout: float = 5.0):
+        """Deja de tomar avisos; los workers terminan el lote en curso (apagado)."""
+        self._stopping.set()
+        self._wake.set()
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                processed = self.drain_once()
+            except Exception as e:
+                print(f"Error enviando avisos del outbox: {e}")
+                metrics.inc("outbox.errors")
+                processed = 0
+            if not processed:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempts))
+        return delay * (0.5 + random.random() / 2)
+
+    def drain_once(self) -> int:
+        """Envía un lote de avisos vencidos; devuelve cuántos tomó."""
+        jobs = database.claim_notifications(self.batch_size, self.lease_seconds)
+        if not jobs:
+            return 0
+        start = time.monotonic()
+        try:
+            results = self.sender.send_batch(jobs)
+        except Exception as e:
+            results = {job["id"]: str(e) or type(e).__name__ for job in jobs}
+        now = time.time()
+        sent, retries, failed = [], [], []
+        for job in jobs:
+            error = results.get(job["id"], "sin respuesta del sender")
+            if error is None:
+                sent.append(job["id"])
+            elif job["attempts"] + 1 >= self.max_attempts:
+                failed.append({"id": job["id"], "error": error})
+            else:
+                retries.append({"id": job["id"], "error": error,
+                                "next_attempt_at": now + self._backoff(job["attempts"])})
+        database.finish_notifications(sent, retries, failed)
+
+        metrics.inc("outbox.sent", len(sent))
+        metrics.inc("outbox.retried", len(retries))
+        metrics.inc("outbox.failed", len(failed))
+        metrics.set_gauge("outbox.last_batch", len(jobs))
+        metrics.set_gauge("outbox.last_batch_ms", round((time.monotonic() - start) * 1000, 1))
+        if sent:
+            sent_ids = set(sent)
+            oldest = min(job["created_at"] for job in jobs if job["id"] in sent_ids)
+            metrics.set_gauge("outbox.delivery_lag_ms", round((now - oldest) * 1000, 1))
+        return len(jobs)
+
+    def snapshot(self) -> Dict:
+        stats = database.outbox_stats()
+        with self._lock:
+            stats["workers"] = sum(t.is_alive() for t in self._threads)
+        return stats
+
+
+dispatcher = OutboxDispatcher(
+    build_sender(config.OUTBOX_SENDER),
+    workers=config.OUTBOX_WORKERS,
+    batch_size=config.OUTBOX_BATCH_SIZE,
+    poll_seconds=config.OUTBOX_POLL_SECONDS,
+    lease_seconds=config.OUTBOX_LEASE_SECONDS,
+    max_attempts=config.OUTBOX_MAX_ATTEMPTS,
+    backoff_base=config.OUTBOX_BACKOFF_BASE_SECONDS,
+    backoff_max=config.OUTBOX_BACKOFF_MAX_SECONDS,
+)
+database.on_outbox_enqueued(dispatcher.wake)
+metrics.register_collector("outbox", dispatcher.snapshot)
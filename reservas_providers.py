@@ -0,0 +1,379 @@
+"""
+Proveedores de LLM intercambiables.
+
+Cada proveedor implementa generate (sync), agenerate (async) y stream
+(fragmentos de texto) y tiene su propio circuit breaker. ProviderSelector
+elige, entre los listados en LLM_PROVIDERS, el más rápido de los
+disponibles según la latencia medida. offline no compite por latencia
+(siempre ganaría): solo responde si ningún proveedor de red está
+disponible.
+
+- gemini: Google AI Studio (REST).
+- openai: cualquier API compatible con /chat/completions (OpenAI, vLLM,
+  Ollama, LM Studio...).
+- offline: respuestas deterministas locales desde el FAQ, sin red; sirve
+  para correr el bot y los benchmarks sin conexión.
+
+requests se importa en la primera llamada (o en el warm-up).
+"""
+import abc
+import asyncio
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Generator, List, Optional
+
+import reservas_config as config
+import reservas_metrics as metrics
+from reservas_breaker import CircuitBreaker
+
+_http = None
+_http_lock = threading.Lock()
+
+
+def http_session():
+    """Session de requests compartida: pool de conexiones keep-alive hacia los proveedores."""
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=config.LLM_MAX_CONCURRENCY)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http = session
+    return _http
+
+
+class LLMPrompt:
+    """Prompt estructurado; cada proveedor lo serializa a su formato."""
+
+    def __init__(self, system: str, user_message: str, context: str = "", user_name: str = "", style: str = ""):
+        self.system = system
+        self.user_message = user_message
+        self.context = context
+        self.user_name = user_name
+        self.style = style
+
+    def body(self) -> str:
+        text = ""
+        if self.user_name:
+            text += f"El paciente se llama: {self.user_name}\n\n"
+        if self.context:
+            text += f"📝 Historial reciente de la conversación:\n{self.context}\n\n"
+        text += f"💬 Mensaje del paciente: {self.user_message}\n\n"
+        text += self.style
+        return text
+
+    def text(self) -> str:
+        return f"{self.system}\n\n{self.body()}"
+
+    def messages(self) -> List[Dict]:
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.body()},
+        ]
+
+
+class LLMProvider(abc.ABC):
+    name = ""
+    # Sin red (respuestas locales): solo como último recurso, fuera de la carrera por latencia
+    local = False
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(
+            self.name,
+            window_seconds=config.LLM_BREAKER_WINDOW_SECONDS,
+            min_calls=config.LLM_BREAKER_MIN_CALLS,
+            error_rate=config.LLM_BREAKER_ERROR_RATE,
+            slow_call_seconds=config.LLM_BREAKER_SLOW_SECONDS,
+            open_seconds=config.LLM_BREAKER_OPEN_SECONDS,
+            half_open_probes=config.LLM_BREAKER_HALF_OPEN_PROBES,
+            timeout_default=config.LLM_TIMEOUT_DEFAULT,
+            timeout_min=config.LLM_TIMEOUT_MIN,
+            timeout_max=config.LLM_TIMEOUT_MAX,
+        )
+        # Media móvil de latencia por tipo de llamada ("generate" / "stream": hasta el primer fragmento)
+        self.latency: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def configured(self) -> bool:
+        return True
+
+    def available(self) -> bool:
+        return self.configured() and self.breaker.is_available()
+
+    def observe_latency(self, kind: str, seconds: float, alpha: float = 0.2):
+        with self._lock:
+            previous = self.latency.get(kind)
+            self.latency[kind] = seconds if previous is None else previous + alpha * (seconds - previous)
+
+    def expected_latency(self, kind: str) -> float:
+        # Sin medidas todavía: 0 para que se pruebe al menos una vez
+        return self.latency.get(kind, 0.0)
+
+    def timeout(self):
+        return (config.LLM_CONNECT_TIMEOUT, self.breaker.timeout())
+
+    def warm_up(self):
+        """Prepara lo necesario antes del primer chat (conexiones, índices)."""
+
+    @abc.abstractmethod
+    def generate(self, prompt: LLMPrompt) -> str:
+        """Respuesta completa (sync)."""
+
+    @abc.abstractmethod
+    def stream(self, prompt: LLMPrompt, cancel=None, usage: Dict = None) -> Generator[str, None, None]:
+        """Fragmentos de texto; si el proveedor informa tokens los deja en usage["output_tokens"]."""
+
+    async def agenerate(self, prompt: LLMPrompt) -> str:
+        return await asyncio.to_thread(self.generate, prompt)
+
+    async def astream(self, prompt: LLMPrompt, cancel=None, usage: Dict = None):
+        chunks = iter(self.stream(prompt, cancel, usage))
+        done = object()
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, done)
+            if chunk is done:
+                return
+            yield chunk
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            latency = {k: round(v, 4) for k, v in self.latency.items()}
+        return {"configured": self.configured(), "available": self.available(), "latency": latency}
+
+
+@contextmanager
+def _closing_on_cancel(cancel, resp):
+    """Cerrar la respuesta desbloquea iter_lines y corta la conexión con el proveedor."""
+    if cancel is None:
+        yield
+        return
+    cancel.add_callback(resp.close)
+    try:
+        yield
+    finally:
+        cancel.remove_callback(resp.close)
+
+
+def _sse_data(resp, cancel=None) -> Generator[Dict, None, None]:
+    for line in resp.iter_lines():
+        if cancel is not None and cancel.is_set():
+            return
+        if not line:
+            continue
+        line_text = line.decode("utf-8")
+        if not line_text.startswith("data: "):
+            continue
+        data = line_text[6:]
+        if data.strip() == "[DONE]":
+            return
+        try:
+            yield json.loads(data)
+        except json.JSONDecodeError:
+            continue
+
+
+class GeminiProvider(LLMProvider):
+    name = "gemini"
+
+    def __init__(self):
+        super().__init__()
+        self.api_key = os.getenv("GOOGLE_API_KEY")
+        self.model = os.getenv("GOOGLE_MODEL", "gemini-1.5-flash")
+        # Permite apuntar a un stub local de Gemini en pruebas
+        self.base_url = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com").rstrip("/")
+
+    def configured(self) -> bool:
+        return bool(self.api_key)
+
+    def _payload(self, prompt: LLMPrompt) -> Dict:
+        return {
+            "contents": [{"parts": [{"text": prompt.text()}]}],
+            "generationConfig": {
+                "temperature": 0.85,  # Más variedad en respuestas
+                "maxOutputTokens": 1024,
+                "topP": 0.92,
+                "topK": 50  # Más opciones de tokens
+            }
+        }
+
+    @staticmethod
+    def _text(data: Dict) -> Optional[str]:
+        if "candidates" in data and data["candidates"]:
+            candidate = data["candidates"][0]
+            if "content" in candidate and "parts" in candidate["content"]:
+                parts = candidate["content"]["parts"]
+                if parts and "text" in parts[0]:
+                    return parts[0]["text"]
+        return None
+
+    def warm_up(self):
+        http_session().head(self.base_url, timeout=config.LLM_CONNECT_TIMEOUT)
+
+    def generate(self, prompt: LLMPrompt) -> str:
+        url = f"{self.base_url}/v1beta/models/{self.model}:generateContent?key={self.api_key}"
+        resp = http_session().post(url, json=self._payload(prompt), timeout=self.timeout())
+        resp.raise_for_status()
+        text = self._text(resp.json())
+        return text if text is not None else "Lo siento, no pude generar una respuesta. ¿Puedo ayudarte con algo más?"
+
+    def stream(self, prompt: LLMPrompt, cancel=None, usage: Dict = None) -> Generator[str, None, None]:
+        url = f"{self.base_url}/v1beta/models/{self.model}:streamGenerateContent?alt=sse&key={self.api_key}"
+        with http_session().post(url, json=self._payload(prompt), timeout=self.timeout(), stream=True) as resp:
+            with _closing_on_cancel(cancel, resp):
+                resp.raise_for_status()
+                for data in _sse_data(resp, cancel):
+                    tokens = (data.get("usageMetadata") or {}).get("candidatesTokenCount")
+                    if tokens and usage is not None:
+                        usage["output_tokens"] = tokens
+                    text = self._text(data)
+                    if text:
+                        yield text
+
+
+class OpenAICompatibleProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self):
+        super().__init__()
+        self.api_key = os.getenv("OPENAI_API_KEY", "")
+        self.model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+        self.base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+
+    def configured(self) -> bool:
+        # Los servidores locales (vLLM, Ollama) no piden API key, pero sí una URL propia
+        return bool(self.api_key) or "OPENAI_BASE_URL" in os.environ
+
+    def _headers(self) -> Dict:
+        return {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+
+    def _payload(self, prompt: LLMPrompt, stream: bool) -> Dict:
+        payload = {
+            "model": self.model,
+            "messages": prompt.messages(),
+            "temperature": 0.85,
+            "top_p": 0.92,
+            "max_tokens": 1024,
+        }
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def warm_up(self):
+        http_session().get(f"{self.base_url}/models", headers=self._headers(), timeout=config.LLM_CONNECT_TIMEOUT)
+
+    def generate(self, prompt: LLMPrompt) -> str:
+        resp = http_session().post(f"{self.base_url}/chat/completions", json=self._payload(prompt, False),
+                                   headers=self._headers(), timeout=self.timeout())
+        resp.raise_for_status()
+        choices = resp.json().get("choices") or []
+        if choices and choices[0].get("message", {}).get("content"):
+            return choices[0]["message"]["content"]
+        return "Lo siento, no pude generar una respuesta. ¿Puedo ayudarte con algo más?"
+
+    def stream(self, prompt: LLMPrompt, cancel=None, usage: Dict = None) -> Generator[str, None, None]:
+        with http_session().post(f"{self.base_url}/chat/completions", json=self._payload(prompt, True),
+                                 headers=self._headers(), timeout=self.timeout(), stream=True) as resp:
+            with _closing_on_cancel(cancel, resp):
+                resp.raise_for_status()
+                for data in _sse_data(resp, cancel):
+                    tokens = (data.get("usage") or {}).get("completion_tokens")
+                    if tokens and usage is not None:
+                        usage["output_tokens"] = tokens
+                    choices = data.get("choices") or []
+                    text = choices[0].get("delta", {}).get("content") if choices else None
+                    if text:
+                        yield text
+
+
+class OfflineProvider(LLMProvider):
+    """Respuestas deterministas sin red: la mejor entrada del FAQ con umbral bajo.
+
+    OFFLINE_LLM_TOKEN_DELAY_MS simula la latencia entre fragmentos.
+    """
+
+    name = "offline"
+    local = True
+    FALLBACK = ("Puedo ayudarte con horarios, precios, especialidades y reservas. "
+                "Escribe 'quiero una cita' y te guío paso a paso 😊")
+
+    def __init__(self):
+        super().__init__()
+        self.token_delay = config.OFFLINE_LLM_TOKEN_DELAY_MS / 1000
+
+    def warm_up(self):
+        from reservas_faq import get_faq_matcher
+        get_faq_matcher()
+
+    def _answer(self, prompt: LLMPrompt) -> str:
+        from reservas_faq import get_faq_matcher
+        answer, _ = get_faq_matcher().find_answer(prompt.user_message, threshold=0.2)
+        text = answer or self.FALLBACK
+        return f"{prompt.user_name}, {text}" if prompt.user_name else text
+
+    def generate(self, prompt: LLMPrompt) -> str:
+        text = self._answer(prompt)
+        if self.token_delay:
+            time.sleep(self.token_delay * len(text.split()))
+        return text
+
+    def stream(self, prompt: LLMPrompt, cancel=None, usage: Dict = None) -> Generator[str, None, None]:
+        words = self._answer(prompt).split(" ")
+        for i, word in enumerate(words):
+            if cancel is not None and cancel.is_set():
+                return
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield word if i == len(words) - 1 else word + " "
+        if usage is not None:
+            usage["output_tokens"] = len(words)
+
+
+PROVIDER_CLASSES = {
+    "gemini": GeminiProvider,
+    "openai": OpenAICompatibleProvider,
+    "offline": OfflineProvider,
+}
+
+
+class ProviderSelector:
+    """Elige el proveedor de red disponible con menor latencia medida (a igualdad, el primero de la lista).
+
+    Los locales (offline) solo se usan si no queda ninguno de red disponible.
+    """
+
+    def __init__(self, providers: List[LLMProvider]):
+        self.providers = providers
+
+    def pick(self, kind: str = "generate") -> Optional[LLMProvider]:
+        candidates = [p for p in self.providers if p.available()]
+        remote = [p for p in candidates if not p.local]
+        if remote:
+            return min(remote, key=lambda p: p.expected_latency(kind))
+        return candidates[0] if candidates else None
+
+    def get(self, name: str) -> Optional[LLMProvider]:
+        return next((p for p in self.providers if p.name == name), None)
+
+    def snapshot(self) -> Dict:
+        return {p.name: p.snapshot() for p in self.providers}
+
+
+def build_selector(names: str) -> ProviderSelector:
+    providers = []
+    for name in filter(None, (n.strip() for n in names.split(","))):
+        if name not in PROVIDER_CLASSES:
+            raise ValueError(f"Proveedor de LLM desconocido: {name}")
+        providers.append(PROVIDER_CLASSES[name]())
+    return ProviderSelector(providers)
+
+
+selector = build_selector(config.LLM_PROVIDERS)
+metrics.register_collector("llm.providers", selector.snapshot)
@@ -0,0 +1,171 @@
+"""
+Rate limiting por token bucket (por user_id y por IP).
+
+Dos backends:
+- TokenBucketLimiter: en memoria del proceso, O(1) por clave activa y
+  expulsión de claves inactivas por orden de último acceso.
+- SharedTokenBucketLimiter: tabla de slots de tamaño fijo en un archivo
+  mapeado en memoria (/dev/shm) con flock, compartida entre varios workers
+  de uvicorn en el mismo host.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import reservas_metrics as metrics
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate: float, burst: float, idle_seconds: float = 600, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.idle_seconds = idle_seconds
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # key -> [tokens, last]
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float):
+        # Las claves están ordenadas por último acceso: basta mirar el inicio
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket[1] < self.idle_seconds and len(self._buckets) <= self.max_keys:
+                break
+            self._buckets.popitem(last=False)
+
+    def allow(self, key: str, cost: float = 1) -> Tuple[bool, float]:
+        """Consume `cost` tokens. Devuelve (permitido, segundos hasta poder reintentar)."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets[key] = bucket
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+            self._evict(now)
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return True, 0.0
+            return False, (cost - bucket[0]) / self.rate if self.rate else float("inf")
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class SharedTokenBucketLimiter:
+    """Token buckets en una tabla hash de slots fijos sobre memoria compartida.
+
+    Cada slot guarda (hash de la clave, tokens, último acceso). Las colisiones
+    se resuelven con sondeo lineal acotado; si no hay slot libre se reutiliza
+    el menos reciente de la ventana de sondeo.
+    """
+
+    _SLOT = struct.Struct("<Qdd")
+    _PROBES = 8
+
+    def __init__(self, rate: float, burst: float, path: str, slots: int = 65536, idle_seconds: float = 600):
+        if fcntl is None:
+            raise RuntimeError("El rate limiter compartido requiere fcntl (Linux/macOS)")
+        self.rate = rate
+        self.burst = burst
+        self.slots = slots
+        self.idle_seconds = idle_seconds
+        size = slots * self._SLOT.size
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size != size:
+                    os.ftruncate(self._fd, size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        h = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+        return h or 1  # 0 marca un slot vacío
+
+    def _find_slot(self, h: int, now: float) -> Tuple[int, bool]:
+        start = h % self.slots
+        victim, victim_last = start, float("inf")
+        for i in range(self._PROBES):
+            idx = (start + i) % self.slots
+            slot_hash, _, last = self._SLOT.unpack_from(self._map, idx * self._SLOT.size)
+            if slot_hash == h:
+                return idx, True
+            if slot_hash == 0 or now - last >= self.idle_seconds:
+                return idx, False
+            if last < victim_last:
+                victim, victim_last = idx, last
+        return victim, False
+
+    def allow(self, key: str, cost: float = 1) -> Tuple[bool, float]:
+        h = self._hash(key)
+        now = time.time()  # reloj compartido entre procesos
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                idx, found = self._find_slot(h, now)
+                offset = idx * self._SLOT.size
+                if found:
+                    _, tokens, last = self._SLOT.unpack_from(self._map, offset)
+                    tokens = min(self.burst, tokens + max(0.0, now - last) * self.rate)
+                else:
+                    tokens = self.burst
+                allowed = tokens >= cost
+                if allowed:
+                    tokens -= cost
+                self._SLOT.pack_into(self._map, offset, h, tokens, now)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if allowed:
+            return True, 0.0
+        return False, (cost - tokens) / self.rate if self.rate else float("inf")
+
+
+class RateLimiter:
+    """Aplica un bucket por IP y otro por usuario, en ese orden."""
+
+    def __init__(self, user_limiter, ip_limiter):
+        self.user_limiter = user_limiter
+        self.ip_limiter = ip_limiter
+
+    def check(self, user_id: str, client_ip: str) -> Tuple[bool, float]:
+        if client_ip:
+            ok, retry_after = self.ip_limiter.allow(f"ip:{client_ip}")
+            if not ok:
+                metrics.inc("ratelimit.rejected.ip")
+                return False, retry_after
+        ok, retry_after = self.user_limiter.allow(f"user:{user_id}")
+        if not ok:
+            metrics.inc("ratelimit.rejected.user")
+        return ok, retry_after
+
+
+def build_rate_limiter(backend: str, user_rate: float, user_burst: float, ip_rate: float, ip_burst: float,
+                       idle_seconds: float, shared_path: str, shared_slots: int) -> RateLimiter:
+    if backend == "shared":
+        base, ext = os.path.splitext(shared_path)
+        return RateLimiter(
+            SharedTokenBucketLimiter(user_rate, user_burst, f"{base}-user{ext}", shared_slots, idle_seconds),
+            SharedTokenBucketLimiter(ip_rate, ip_burst, f"{base}-ip{ext}", shared_slots, idle_seconds),
+        )
+    user_limiter = TokenBucketLimiter(user_rate, user_burst, idle_seconds)
+    ip_limiter = TokenBucketLimiter(ip_rate, ip_burst, idle_seconds)
+    metrics.register_collector("ratelimit", lambda: {"user_keys": len(user_limiter), "ip_keys": len(ip_limiter)})
+    return RateLimiter(user_limiter, ip_limiter)
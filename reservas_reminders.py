@@ -0,0 +1,181 @@
+"""
+Recordatorios de citas próximas ("tu cita es mañana").
+
+El scheduler mantiene un heap (vencimiento, cita) solo con los
+recordatorios que vencen en la próxima ventana (REMINDER_WINDOW_HOURS); la
+ventana se rellena con una consulta por rango sobre el índice (date, time)
+de appointments.db, nunca recorriendo todas las citas. Un hilo duerme hasta
+el próximo vencimiento (o hasta rellenar la ventana) y despacha los
+vencidos en lotes: valida contra la base que la cita siga confirmada en el
+mismo horario y encola los recordatorios en el outbox, que los envía con
+reservas_actions.execute_action ("remind").
+
+La clave de idempotencia (cita + horario) hace que reconstruir el heap al
+arrancar no repita recordatorios ya encolados antes del reinicio.
+"""
+import heapq
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import reservas_config as config
+import reservas_database as database
+import reservas_metrics as metrics
+
+Entry = Tuple[float, str, str, str]  # (vence, appointment_id, fecha, hora)
+
+
+class ReminderScheduler:
+    def __init__(self, lead_seconds: float, window_seconds: float, batch_size: int):
+        self.lead_seconds = lead_seconds
+        self.window_seconds = window_seconds
+        self.batch_size = batch_size
+        self._heap: List[Entry] = []
+        self._loaded_until: Optional[float] = None  # vencimientos ya cargados hasta aquí
+        self._refilling = False
+        self._written_during_refill: List[Dict] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"loaded": 0, "dispatched": 0, "skipped": 0, "batches": 0}
+
+    def _due_at(self, appt: Dict) -> Optional[float]:
+        try:
+            starts = datetime.strptime(f"{appt['date']} {appt['time']}", "%Y-%m-%d %H:%M")
+        except (KeyError, ValueError):
+            return None
+        return starts.timestamp() - self.lead_seconds
+
+    def _push_locked(self, appt: Dict) -> bool:
+        due = self._due_at(appt)
+        if due is None:
+            return False
+        heapq.heappush(self._heap, (due, appt["appointment_id"], appt["date"], appt["time"]))
+        return True
+
+    def refill(self, now: float = None) -> int:
+        """Carga los recordatorios que vencen hasta now + ventana; devuelve cuántos."""
+        now = time.time() if now is None else now
+        with self._lock:
+            start = self._loaded_until
+            until = now + self.window_seconds
+            if start is not None and until <= start:
+                return 0
+            self._refilling = True
+        # Primera carga: citas que aún no empiezan, aunque su recordatorio ya haya vencido
+        low = start + self.lead_seconds if start is not None else now
+        high = until + self.lead_seconds
+        appts = database.upcoming_appointments(datetime.fromtimestamp(low).strftime("%Y-%m-%d"),
+                                               datetime.fromtimestamp(high).strftime("%Y-%m-%d"))
+        loaded = 0
+        with self._lock:
+            # Las escritas mientras corría la consulta pueden no estar en `appts`
+            # (un duplicado en el heap es inofensivo: el outbox lo descarta)
+            appts += self._written_during_refill
+            self._written_during_refill = []
+            self._refilling = False
+            for appt in appts:
+                due = self._due_at(appt)
+                if due is None or due > until or due + self.lead_seconds <= now:
+                    continue
+                if start is not None and due <= start:
+                    continue
+                loaded += self._push_locked(appt)
+            self._loaded_until = until
+            self._stats["loaded"] += loaded
+        metrics.set_gauge("reminders.heap", len(self._heap))
+        return loaded
+
+    def appointment_written(self, appt: Dict):
+        """Cita nueva o reprogramada dentro de la ventana ya cargada: entra al heap."""
+        if appt.get("status") != database.STATUS_CONFIRMED:
+            return  # las canceladas se descartan al vencer
+        with self._lock:
+            if self._refilling:
+                self._written_during_refill.append(appt)
+            if self._loaded_until is None:
+                return
+            due = self._due_at(appt)
+            if due is None or due > self._loaded_until:
+                return
+            self._push_locked(appt)
+            earliest = self._heap[0][1] == appt["appointment_id"]
+        if earliest:
+            self._wake.set()
+
+    def _pop_due(self, now: float) -> List[Entry]:
+        with self._lock:
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                batch.append(heapq.heappop(self._heap))
+            return batch
+
+    def dispatch(self, entries: List[Entry]) -> int:
+        """Encola los recordatorios de un lote que sigan vigentes; devuelve cuántos."""
+        current = database.get_appointments([e[1] for e in entries])
+        valid = []
+        for due, appt_id, date, time_ in entries:
+            appt = current.get(appt_id)
+            if (appt is None or appt["status"] != database.STATUS_CONFIRMED
+                    or (appt["date"], appt["time"]) != (date, time_)):
+                continue
+            # Reservada o movida ya dentro del plazo: la confirmación hace de recordatorio
+            if datetime.fromisoformat(appt["updated_at"]).timestamp() >= due:
+                continue
+            valid.append(appt)
+        queued = database.enqueue_reminders(valid) if valid else 0
+        with self._lock:
+            self._stats["dispatched"] += queued
+            self._stats["skipped"] += len(entries) - queued
+            self._stats["batches"] += 1
+        metrics.inc("reminders.queued", queued)
+        return queued
+
+    def _run(self):
+        while not self._stopping.is_set():
+            now = time.time()
+            try:
+                if self._loaded_until is None or now >= self._loaded_until - self.window_seconds / 2:
+                    self.refill(now)
+                batch = self._pop_due(now)
+                if batch:
+                    self.dispatch(batch)
+                    continue
+            except Exception as e:
+                print(f"Error despachando recordatorios: {e}")
+                metrics.inc("reminders.errors")
+            with self._lock:
+                next_due = self._heap[0][0] if self._heap else float("inf")
+                next_refill = self._loaded_until - self.window_seconds / 2 if self._loaded_until else now + 60
+            # Duerme hasta el próximo vencimiento o el próximo relleno de la ventana
+            self._wake.wait(max(0.05, min(next_due, next_refill) - time.time()))
+            self._wake.clear()
+
+    def start(self):
+        """Reconstruye el heap desde la base y arranca el hilo (idempotente)."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="reservas-reminders", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        self._wake.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(self._stats, heap=len(self._heap),
+                        next_due_in=round(self._heap[0][0] - time.time(), 1) if self._heap else None)
+
+
+scheduler = ReminderScheduler(config.REMINDER_LEAD_HOURS * 3600, config.REMINDER_WINDOW_HOURS * 3600,
+                              config.REMINDER_BATCH_SIZE)
+database.on_appointment_written(scheduler.appointment_written)
+metrics.register_collector("reminders", scheduler.snapshot)
@@ -0,0 +1,223 @@
+"""
+Política de enrutamiento de mensajes entre FAQ, flow de reserva y Gemini.
+
+/chat y /chat/stream piden aquí el plan de rutas. Las reglas duras
+(seguridad, flujo activo, intención de reservar) deciden directamente; el
+resto de candidatos se puntúa por confianza, latencia esperada y costo, y
+se elige la ruta adecuada más barata. Las siguientes rutas del plan sirven
+de respaldo si la primera falla.
+
+En modo especulativo la llamada a Gemini arranca antes de puntuar el FAQ:
+solo un FAQ con confianza alta la cancela, y si no, gana la respuesta que
+esté lista dentro del presupuesto de latencia del turno.
+
+Con ROUTER_LOG_ENABLED cada decisión (o una muestra, ROUTER_LOG_SAMPLE_RATE)
+se registra como una línea NDJSON (sin el texto del mensaje) para ajustar
+los parámetros offline. La escribe un hilo en segundo plano, con rotación
+por tamaño: el request solo encola.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueListener, RotatingFileHandler
+from typing import Callable, Dict, Optional, Tuple
+
+import reservas_config as config
+import reservas_flow as appointment_flow
+import reservas_metrics as metrics
+import reservas_sequrity as sequrity
+
+BOOKING_KEYWORDS = ["cita", "reserv", "agend", "turno", "agendar", "reservar", "necesito ver",
+                    "reprogram", "anular", "appt-"]
+INFO_KEYWORDS = ["horario", "hora", "precio", "costo", "cuanto", "cuánto", "pago", "tarjeta",
+                 "efectivo", "seguro", "especialidad", "doctor", "médico", "yape", "plin",
+                 "abren", "cierran", "atienden", "cobran", "tarifa"]
+
+
+class DecisionLog:
+    """Decisiones del router en NDJSON, fuera del camino del request.
+
+    write() solo encola; un QueueListener las escribe con un
+    RotatingFileHandler (max_bytes por archivo, `backups` anteriores). Si la
+    cola se llena (disco lento) la decisión se descarta y se cuenta.
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int, sample_rate: float = 1.0,
+                 max_queue: int = 10000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self._queue: "queue.Queue[logging.LogRecord]" = queue.Queue(max_queue)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._listener = QueueListener(self._queue, handler)
+        self._listener.start()
+
+    def write(self, record: Dict):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        line = json.dumps(record, ensure_ascii=False)
+        try:
+            self._queue.put_nowait(logging.makeLogRecord({"msg": line}))
+        except queue.Full:
+            metrics.inc("router.log_dropped")
+
+    def close(self):
+        """Escribe lo encolado y cierra el archivo (apagado)."""
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+
+
+class RoutingPolicy:
+    """Elige la ruta adecuada más barata para cada mensaje.
+
+    score = costo + latency_weight * latencia esperada (s). Una ruta es
+    adecuada si su confianza llega a min_confidence; si ninguna lo es, se
+    ordenan por confianza. La latencia esperada de cada ruta es una media
+    móvil de lo observado.
+    """
+
+    def __init__(self, min_confidence: float, latency_weight: float, llm_cost: float,
+                 llm_info_confidence: float, llm_general_confidence: float, fallback_confidence: float,
+                 llm_latency_prior: float, alpha: float = 0.2, log: Optional[DecisionLog] = None,
+                 speculative: bool = False, speculative_confident: float = 0.85, turn_budget: float = 2.5):
+        self.min_confidence = min_confidence
+        self.latency_weight = latency_weight
+        self.llm_info_confidence = llm_info_confidence
+        self.llm_general_confidence = llm_general_confidence
+        self.fallback_confidence = fallback_confidence
+        self.alpha = alpha
+        self.log = log
+        self.speculative = speculative
+        self.speculative_confident = speculative_confident
+        self.turn_budget = turn_budget
+        self.cost = {"faq": 0.0, "llm": llm_cost, "fallback": 0.0}
+        self.expected_latency = {"faq": 0.01, "llm": llm_latency_prior, "fallback": 0.05}
+        self._lock = threading.Lock()
+
+    def decide(self, endpoint: str, message: str, user: Optional[Dict],
+               faq_lookup: Callable[[], Tuple[Optional[str], float]], llm_available: bool,
+               speculate: Callable[[], object] = None) -> Dict:
+        """Devuelve la decisión: features, candidatos puntuados y plan ordenado.
+
+        `faq_lookup` solo se evalúa si ninguna regla dura decide; su respuesta
+        queda en decision["faq"] para no recalcularla. `speculate` lanza la
+        llamada al LLM en paralelo y su resultado queda en decision["speculative"].
+        """
+        text = message.lower()
+        state = user.get("state", "idle") if user else "idle"
+        features = {"length": len(message), "state": state, "llm_available": llm_available}
+        decision = {"endpoint": endpoint, "features": features, "candidates": [], "plan": [],
+                    "faq": (None, 0.0), "started": time.monotonic(), "failed": [],
+                    "speculative": None}
+
+        security_word = next((pal for pal in sequrity.palabras_in if pal in text), None)
+        if security_word:
+            features["security_word"] = security_word
+            decision["plan"] = ["security"]
+            return decision
+        if state != "idle":
+            decision["plan"] = ["flow"]
+            return decision
+        # "cardiología mañana a las 10" también es una reserva, aunque no diga "cita"
+        if any(kw in text for kw in BOOKING_KEYWORDS) or appointment_flow.booking_slots(text):
+            decision["plan"] = ["booking"]
+            return decision
+
+        features["info"] = any(kw in text for kw in INFO_KEYWORDS)
+        if speculate is not None and self.speculative and llm_available:
+            # None si no hay hilo libre: la llamada irá por la cola de admisión normal
+            decision["speculative"] = speculate()
+            features["speculative"] = decision["speculative"] is not None
+        faq_answer, faq_sim = faq_lookup()
+        decision["faq"] = (faq_answer, faq_sim)
+        features["faq_sim"] = round(faq_sim, 4)
+
+        confidences = {"fallback": self.fallback_confidence}
+        if faq_answer:
+            confidences["faq"] = faq_sim
+        if llm_available:
+            confidences["llm"] = self.llm_info_confidence if features["info"] else self.llm_general_confidence
+
+        with self._lock:
+            latencies = dict(self.expected_latency)
+        candidates = []
+        for route, confidence in confidences.items():
+            score = self.cost[route] + self.latency_weight * latencies[route]
+            candidates.append({
+                "route": route,
+                "confidence": round(confidence, 4),
+                "latency": round(latencies[route], 4),
+                "cost": self.cost[route],
+                "score": round(score, 4),
+                "adequate": confidence >= self.min_confidence,
+            })
+        adequate = sorted((c for c in candidates if c["adequate"]), key=lambda c: c["score"])
+        rest = sorted((c for c in candidates if not c["adequate"]), key=lambda c: -c["confidence"])
+        plan = [c["route"] for c in adequate + rest if c["route"] != "fallback"]
+        if decision["speculative"] is not None:
+            # La llamada al LLM ya está en curso: solo un FAQ muy seguro la cancela
+            if faq_answer and faq_sim >= self.speculative_confident:
+                plan = ["faq"]
+            else:
+                plan = ["llm"] + (["faq"] if faq_answer else [])
+        decision["candidates"] = candidates
+        decision["plan"] = plan + ["fallback"]
+        return decision
+
+    def budget_deadline(self, decision: Dict) -> float:
+        """Instante (monotonic) en que se agota el presupuesto de latencia del turno."""
+        return decision["started"] + self.turn_budget
+
+    def failed(self, decision: Dict, route: str):
+        """Marca una ruta del plan que falló; el handler sigue con la siguiente."""
+        decision["failed"].append(route)
+        metrics.inc(f"router.failed.{route}")
+
+    def observe(self, decision: Dict, route: str, latency: float = None):
+        """Registra la ruta que respondió y actualiza su latencia esperada."""
+        if latency is None:
+            latency = time.monotonic() - decision["started"]
+        if route in self.expected_latency:
+            with self._lock:
+                self.expected_latency[route] += self.alpha * (latency - self.expected_latency[route])
+        metrics.inc(f"router.route.{route}")
+        if self.log is not None:
+            self.log.write({
+                "ts": datetime.now().isoformat(timespec="milliseconds"),
+                "endpoint": decision["endpoint"],
+                "features": decision["features"],
+                "candidates": decision["candidates"],
+                "plan": decision["plan"],
+                "failed": decision["failed"],
+                "route": route,
+                "provider": (decision.get("llm") or {}).get("provider") if route == "llm" else None,
+                "latency_ms": round(latency * 1000, 1),
+            })
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"expected_latency": {k: round(v, 4) for k, v in self.expected_latency.items()}}
+
+
+router = RoutingPolicy(
+    min_confidence=config.ROUTER_MIN_CONFIDENCE,
+    latency_weight=config.ROUTER_LATENCY_WEIGHT,
+    llm_cost=config.ROUTER_LLM_COST,
+    llm_info_confidence=config.ROUTER_LLM_INFO_CONFIDENCE,
+    llm_general_confidence=config.ROUTER_LLM_GENERAL_CONFIDENCE,
+    fallback_confidence=config.ROUTER_FALLBACK_CONFIDENCE,
+    llm_latency_prior=config.ROUTER_LLM_LATENCY_PRIOR,
+    log=DecisionLog(config.ROUTER_LOG_PATH, config.ROUTER_LOG_MAX_BYTES, config.ROUTER_LOG_BACKUPS,
+                    config.ROUTER_LOG_SAMPLE_RATE) if config.ROUTER_LOG_ENABLED else None,
+    speculative=config.ROUTER_SPECULATIVE,
+    speculative_confident=config.ROUTER_SPECULATIVE_FAQ_CONFIDENT,
+    turn_budget=config.ROUTER_TURN_BUDGET_SECONDS,
+)
+metrics.register_collector("router", router.snapshot)
@@ -0,0 +1,30 @@
+"""
+Estado de conversación por conexión (WebSocket).
+
+Se carga una vez al conectar el registro del usuario (con su estado del
+flow de reserva) y se precarga su historial en la caché de contexto. Cada
+turno se sigue persistiendo en disco, pero las lecturas salen de memoria.
+"""
+from typing import Dict
+
+import reservas_database as database
+from reservas_memory import context_cache
+
+
+class ChatSession:
+    def __init__(self, user_id: str, user: Dict):
+        self.user_id = user_id
+        self.user = user
+
+    @classmethod
+    def load(cls, user_id: str, user: Dict = None) -> "ChatSession":
+        if user is None:
+            user = database.get_user(user_id)
+        if user is None:
+            raise ValueError("user not found")
+        context_cache.warm(user_id)
+        return cls(user_id, user)
+
+    @property
+    def state(self) -> str:
+        return self.user.get("state", "idle")
@@ -0,0 +1,141 @@
+"""
+Apagado ordenado del proceso.
+
+begin() marca el proceso como drenando: /readyz pasa a 503 y /chat,
+/chat/stream y /ws/chat rechazan mensajes nuevos. Además lanza el drenado
+de streams en segundo plano: espera a los activos hasta
+SHUTDOWN_DRAIN_SECONDS y cancela (guardando el turno parcial) los que no
+terminan. Se llama desde SIGTERM/SIGINT porque uvicorn espera a que se
+cierren las conexiones abiertas (incluidas las SSE) antes del lifespan.
+
+run() (al cerrar el lifespan) espera ese drenado, ejecuta los hooks
+registrados (flush de perfiles, colas pendientes) y deja el resumen con
+tiempos en DATA_DIR/last_shutdown.json, que se publica en /metrics al
+volver a arrancar.
+"""
+import json
+import os
+import signal
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+import reservas_config as config
+import reservas_database as database
+import reservas_metrics as metrics
+import reservas_streams as streams
+
+_hooks: List[Tuple[str, Callable[[], None]]] = []
+_lock = threading.Lock()
+_state = {"draining": False, "since": None, "reason": "", "streams": None, "drain_ms": None}
+_drained = threading.Event()
+
+
+def register_hook(name: str, fn: Callable[[], None]):
+    """Registra una función a ejecutar al apagar, después de drenar los streams."""
+    with _lock:
+        _hooks.append((name, fn))
+
+
+def draining() -> bool:
+    return _state["draining"]
+
+
+def begin(reason: str = ""):
+    """Deja de aceptar chats nuevos (idempotente)."""
+    with _lock:
+        if _state["draining"]:
+            return
+        _state.update(draining=True, since=time.monotonic(), reason=reason)
+    metrics.set_gauge("shutdown.draining", 1)
+    print(f"Apagado iniciado ({reason or 'lifespan'}): no se aceptan chats nuevos")
+    threading.Thread(target=_drain_streams, name="reservas-shutdown-drain", daemon=True).start()
+
+
+def _drain_streams():
+    t = time.monotonic()
+    try:
+        _state["streams"] = streams.registry.drain(config.SHUTDOWN_DRAIN_SECONDS, config.SHUTDOWN_CANCEL_GRACE_SECONDS)
+    except Exception as e:
+        print(f"Error drenando streams: {e}")
+        _state["streams"] = {"error": str(e)}
+    _state["drain_ms"] = round((time.monotonic() - t) * 1000, 1)
+    _drained.set()
+
+
+def _last_shutdown_path() -> str:
+    return os.path.join(database.DATA_DIR, "last_shutdown.json")
+
+
+def run() -> Dict:
+    begin("lifespan")
+    start = time.monotonic()
+    summary = {"reason": _state["reason"], "at": datetime.now().isoformat(timespec="seconds")}
+
+    _drained.wait(config.SHUTDOWN_DRAIN_SECONDS + config.SHUTDOWN_CANCEL_GRACE_SECONDS + 1)
+    summary["streams"] = _state["streams"]
+    summary["drain_ms"] = _state["drain_ms"]
+
+    summary["hooks"] = {}
+    with _lock:
+        hooks = list(_hooks)
+    for name, fn in hooks:
+        t = time.monotonic()
+        error = None
+        try:
+            fn()
+        except Exception as e:
+            error = str(e)
+            print(f"Hook de apagado '{name}' falló: {e}")
+        summary["hooks"][name] = {"ms": round((time.monotonic() - t) * 1000, 1), "error": error}
+
+    summary["total_ms"] = round((time.monotonic() - start) * 1000, 1)
+    # Desde la señal: incluye la espera de uvicorn a las conexiones abiertas
+    summary["since_signal_ms"] = round((time.monotonic() - _state["since"]) * 1000, 1)
+    for key in ("drain_ms", "total_ms", "since_signal_ms"):
+        if summary[key] is not None:
+            metrics.set_gauge(f"shutdown.{key}", summary[key])
+
+    try:
+        os.makedirs(database.DATA_DIR, exist_ok=True)
+        tmp = _last_shutdown_path() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, _last_shutdown_path())
+    except OSError as e:
+        print(f"No se pudo guardar el resumen de apagado: {e}")
+    print(f"Apagado completo en {summary['total_ms']} ms: {summary['streams']}")
+    return summary
+
+
+def load_last_shutdown():
+    """Publica en /metrics el resumen del apagado anterior, si existe."""
+    try:
+        with open(_last_shutdown_path(), "r", encoding="utf-8") as f:
+            last = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return
+    metrics.register_collector("last_shutdown", lambda: last)
+
+
+def install_signal_handlers():
+    """Encadena SIGTERM/SIGINT para empezar a drenar apenas llega la señal.
+
+    Se llama desde el lifespan, cuando uvicorn ya instaló sus propios
+    handlers; el handler anterior se sigue ejecutando.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+
+        def handler(signum, frame, previous=previous):
+            begin(signal.Signals(signum).name)
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(sig, handler)
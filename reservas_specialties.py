@@ -0,0 +1,166 @@
+"""
+Resolución de especialidades tolerante a errores de tipeo.
+
+Las especialidades y sus alias se leen de SPECIALTIES_FILE (JSON). Al cargar
+se precalculan:
+- un diccionario término -> especialidad (texto plegado: minúsculas, sin
+  tildes ni signos) para las coincidencias exactas de una o varias palabras;
+- un índice invertido de trigramas de caracteres de los términos de una
+  palabra, para encontrar candidatos ante un typo ("cardiolgia") sin
+  recorrer la lista; los más parecidos se reordenan por distancia de
+  edición. El resultado por palabra se memoriza (caché acotada).
+"""
+import heapq
+import json
+import re
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+import reservas_config as config
+import reservas_metrics as metrics
+
+_NON_ALNUM = re.compile(r"[^a-z0-9ñ]+")
+
+
+def fold(text: str) -> str:
+    """Minúsculas, sin tildes ni signos de puntuación (la ñ se conserva)."""
+    text = text.lower().replace("ñ", "\0")
+    text = "".join(c for c in unicodedata.normalize("NFD", text) if unicodedata.category(c) != "Mn")
+    return _NON_ALNUM.sub(" ", text.replace("\0", "ñ")).strip()
+
+
+def _trigrams(word: str) -> set:
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein; devuelve limit + 1 en cuanto se sabe que lo supera."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def _max_edits(length: int) -> int:
+    if length <= 5:
+        return 1
+    return 2 if length <= 9 else 3
+
+
+class SpecialtyResolver:
+    def __init__(self, entries: List[Dict], min_similarity: float = 0.3, max_suggestions: int = 3,
+                 min_fuzzy_length: int = 4, rerank: int = 6, cache_size: int = 4096):
+        self.names: List[str] = [e["name"] for e in entries]
+        self.min_similarity = min_similarity
+        self.max_suggestions = max_suggestions
+        self.min_fuzzy_length = min_fuzzy_length
+        self.rerank = rerank
+        # Candidatos por palabra: el vocabulario de los pacientes se repite mucho
+        self.cache_size = cache_size
+        self._cache: Dict[str, List[Tuple[int, float, int]]] = {}
+        self._cache_lock = threading.Lock()
+
+        self.terms: Dict[str, int] = {}
+        for idx, entry in enumerate(entries):
+            for term in [entry["name"]] + entry.get("aliases", []):
+                self.terms.setdefault(fold(term), idx)
+        self.max_words = max(len(t.split()) for t in self.terms) if self.terms else 1
+
+        # Trigramas solo de términos de una palabra: el typo se busca palabra por palabra
+        self._words: List[Tuple[str, int, int]] = []  # (término, especialidad, nº de trigramas)
+        self._index: Dict[str, List[int]] = {}
+        for term, idx in self.terms.items():
+            if " " in term:
+                continue
+            grams = _trigrams(term)
+            word_id = len(self._words)
+            self._words.append((term, idx, len(grams)))
+            for gram in grams:
+                self._index.setdefault(gram, []).append(word_id)
+
+    @classmethod
+    def from_file(cls, path: str) -> "SpecialtyResolver":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def _exact(self, tokens: List[str]) -> Optional[int]:
+        for i in range(len(tokens)):
+            for n in range(min(self.max_words, len(tokens) - i), 0, -1):
+                idx = self.terms.get(" ".join(tokens[i:i + n]))
+                if idx is not None:
+                    return idx
+        return None
+
+    def _candidates(self, token: str) -> List[Tuple[int, float, int]]:
+        """(distancia, -similitud, especialidad) de los términos parecidos a `token`."""
+        cached = self._cache.get(token)
+        if cached is not None:
+            return cached
+        grams = _trigrams(token)
+        shared: Dict[int, int] = {}
+        for gram in grams:
+            for word_id in self._index.get(gram, ()):
+                shared[word_id] = shared.get(word_id, 0) + 1
+        scored = []
+        for word_id, count in shared.items():
+            similarity = 2 * count / (len(grams) + self._words[word_id][2])
+            if similarity >= self.min_similarity:
+                scored.append((similarity, word_id))
+        # Solo los más parecidos por trigramas pasan a la distancia de edición
+        limit = _max_edits(len(token)) + 1  # un error más entra como sugerencia
+        ranked = []
+        for similarity, word_id in heapq.nlargest(self.rerank, scored):
+            term, idx, _ = self._words[word_id]
+            distance = _edit_distance(token, term, limit)
+            if distance <= limit:
+                ranked.append((distance, -similarity, idx))
+        with self._cache_lock:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[token] = ranked
+        return ranked
+
+    def resolve(self, text: str) -> Tuple[Optional[str], List[str]]:
+        """(especialidad, sugerencias): especialidad si la coincidencia es segura;
+        si no, hasta max_suggestions especialidades parecidas, de mejor a peor."""
+        tokens = fold(text).split()
+        idx = self._exact(tokens)
+        if idx is not None:
+            metrics.inc("specialty.exact")
+            return self.names[idx], []
+
+        ranked = []
+        for token in tokens:
+            if len(token) >= self.min_fuzzy_length:
+                ranked.extend((d, s, idx, _max_edits(len(token))) for d, s, idx in self._candidates(token))
+        if not ranked:
+            metrics.inc("specialty.miss")
+            return None, []
+        ranked.sort()
+        suggestions = []
+        for _, _, idx, _ in ranked:
+            if self.names[idx] not in suggestions:
+                suggestions.append(self.names[idx])
+        best_distance, _, best_idx, allowed = ranked[0]
+        # Segura: dentro del máximo de errores y sin otra especialidad igual de cerca
+        runner_up = next((d for d, _, idx, _ in ranked if idx != best_idx), None)
+        if best_distance <= allowed and (runner_up is None or runner_up > best_distance):
+            metrics.inc("specialty.fuzzy")
+            return self.names[best_idx], []
+        metrics.inc("specialty.suggested")
+        return None, suggestions[:self.max_suggestions]
+
+    def find(self, text: str) -> Optional[str]:
+        return self.resolve(text)[0]
+
+
+resolver = SpecialtyResolver.from_file(config.SPECIALTIES_FILE)
@@ -0,0 +1,476 @@
+"""
+Streams SSE reanudables para /chat/stream.
+
+Cada respuesta se produce en un hilo propio y sus eventos se numeran y se
+guardan en un buffer circular en memoria. Un cliente que se reconecta con
+`Last-Event-ID` recibe los eventos perdidos sin volver a llamar a Gemini.
+El texto parcial se guarda en disco (checkpoint) mientras se genera, para
+recuperar el turno si el proceso cae antes de terminar.
+
+Varios workers comparten el directorio de checkpoints: cada proceso firma
+los suyos con un dueño y mantiene bloqueado su archivo `<dueño>.lock`
+mientras vive. Al arrancar, un worker solo recupera los checkpoints cuyo
+lock puede tomar, es decir, los de procesos que ya terminaron.
+
+Si el último cliente se desconecta y nadie reanuda el stream dentro de
+STREAM_RESUME_GRACE_SECONDS, se cancela el productor y con él la petición
+a Gemini.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Generator, Iterable, List, Optional, TextIO, Tuple
+
+import reservas_config as config
+import reservas_database as database
+import reservas_metrics as metrics
+import reservas_tracing as tracing
+from reservas_cancel import CancelToken
+from reservas_memory import MemoryManager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+INTERRUPTED_SUFFIX = "\n\n_(respuesta interrumpida)_"
+
+
+def _checkpoint_dir() -> str:
+    return os.path.join(database.DATA_DIR, "stream_checkpoints")
+
+
+def _try_lock(f: TextIO) -> bool:
+    """Bloqueo exclusivo sin espera; el sistema lo libera si el proceso muere."""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+_owner_lock = threading.Lock()
+_owner: Optional[Tuple[int, str, TextIO]] = None  # (pid, dueño, lock abierto)
+
+
+def checkpoint_owner() -> str:
+    """Dueño de los checkpoints de este proceso; toma su lock la primera vez."""
+    global _owner
+    with _owner_lock:
+        # Tras un fork el lock heredado no prueba que el hijo siga vivo: dueño nuevo
+        if _owner is None or _owner[0] != os.getpid():
+            owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            os.makedirs(_checkpoint_dir(), exist_ok=True)
+            f = open(os.path.join(_checkpoint_dir(), f"{owner}.lock"), "a+")
+            if not _try_lock(f):
+                f.close()
+                raise OSError(f"No se pudo bloquear el lock de checkpoints {owner}")
+            _owner = (os.getpid(), owner, f)
+        return _owner[1]
+
+
+_KEEPALIVE_FRAME = b": keepalive\n\n"
+
+
+class ChatStream:
+    def __init__(self, stream_id: str, user_id: str, message: str, max_events: int,
+                 coalesce_chars: int = 0, coalesce_delay: float = 0.0):
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.message = message
+        self.events = deque(maxlen=max_events)  # (seq, frame en bytes)
+        self.last_seq = 0
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self.cond = threading.Condition()
+        self.cancel = CancelToken()
+        self.subscribers = 0
+        self._orphan_timer: Optional[threading.Timer] = None
+        # Agrupación de fragmentos de texto antes de emitirlos como un evento
+        self.coalesce_chars = coalesce_chars
+        self.coalesce_delay = coalesce_delay
+        self._pending_parts = []
+        self._pending_chars = 0
+        self._pending_since: Optional[float] = None
+        self._text_events = 0
+        # Checkpoints
+        self._text_parts = []
+        self._uncheckpointed_chars = 0
+        self._last_checkpoint = 0.0
+
+    # --- productor ---
+    def _append_locked(self, payload: Dict):
+        self.last_seq += 1
+        data = json.dumps(payload, ensure_ascii=False)
+        self.events.append((self.last_seq, f"id: {self.stream_id}:{self.last_seq}\ndata: {data}\n\n".encode("utf-8")))
+        self.cond.notify_all()
+
+    def _flush_pending_locked(self):
+        if not self._pending_parts:
+            return
+        text = "".join(self._pending_parts)
+        self._pending_parts = []
+        self._pending_chars = 0
+        self._pending_since = None
+        self._text_events += 1
+        self._append_locked({"type": "chunk", "text": text})
+
+    def _flush_due_locked(self, now: float):
+        if self._pending_since is not None and now - self._pending_since >= self.coalesce_delay:
+            self._flush_pending_locked()
+
+    def publish_text(self, text: str):
+        """Agrega un fragmento de texto; se emite al superar el tamaño o el retardo máximo.
+
+        El primer fragmento sale de inmediato para no retrasar el time-to-first-token.
+        """
+        now = time.monotonic()
+        with self.cond:
+            self._pending_parts.append(text)
+            self._pending_chars += len(text)
+            if self._pending_since is None:
+                self._pending_since = now
+            if (self._text_events == 0 or self._pending_chars >= self.coalesce_chars
+                    or now - self._pending_since >= self.coalesce_delay):
+                self._flush_pending_locked()
+            else:
+                # Despierta a los consumidores para que programen el flush por tiempo
+                self.cond.notify_all()
+
+    def publish(self, payload: Dict) -> int:
+        with self.cond:
+            self._flush_pending_locked()
+            self._append_locked(payload)
+            return self.last_seq
+
+    def finish(self):
+        with self.cond:
+            self._flush_pending_locked()
+            self.last_seq += 1
+            self.events.append((self.last_seq, f"id: {self.stream_id}:{self.last_seq}\ndata: [DONE]\n\n".encode("utf-8")))
+            self.done = True
+            self.finished_at = time.monotonic()
+            self.cond.notify_all()
+
+    def wait_done(self, deadline: float) -> bool:
+        """Espera a que el productor termine hasta `deadline` (monotonic)."""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.done, max(0.0, deadline - time.monotonic()))
+
+    # --- checkpoints ---
+    @property
+    def checkpoint_path(self) -> str:
+        return os.path.join(_checkpoint_dir(), f"{checkpoint_owner()}.{self.stream_id}.json")
+
+    @property
+    def has_text(self) -> bool:
+        return bool(self._text_parts)
+
+    def add_text(self, text: str):
+        self._text_parts.append(text)
+        self._uncheckpointed_chars += len(text)
+        now = time.monotonic()
+        if (self._uncheckpointed_chars >= config.STREAM_CHECKPOINT_CHARS
+                or now - self._last_checkpoint >= config.STREAM_CHECKPOINT_SECONDS):
+            self.checkpoint()
+
+    def checkpoint(self):
+        os.makedirs(_checkpoint_dir(), exist_ok=True)
+        record = {
+            "stream_id": self.stream_id,
+            "owner": checkpoint_owner(),
+            "user_id": self.user_id,
+            "message": self.message,
+            "partial": "".join(self._text_parts),
+            "updated_at": time.time(),
+        }
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp, self.checkpoint_path)
+        self._uncheckpointed_chars = 0
+        self._last_checkpoint = time.monotonic()
+        metrics.inc("streams.checkpoints")
+
+    def discard_checkpoint(self):
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+    # --- consumidores ---
+    def attach(self) -> threading.Event:
+        """Registra un cliente; el Event devuelto se activa al desconectarlo."""
+        with self.cond:
+            self.subscribers += 1
+            if self._orphan_timer is not None:
+                self._orphan_timer.cancel()
+                self._orphan_timer = None
+        return threading.Event()
+
+    def detach(self, closed: threading.Event):
+        with self.cond:
+            closed.set()
+            self.subscribers -= 1
+            self.cond.notify_all()
+            if self.subscribers > 0 or self.done:
+                return
+            grace = config.STREAM_RESUME_GRACE_SECONDS
+            if grace > 0:
+                self._orphan_timer = threading.Timer(grace, self._cancel_if_orphaned)
+                self._orphan_timer.daemon = True
+                self._orphan_timer.start()
+                return
+        self._cancel_if_orphaned()
+
+    def _cancel_if_orphaned(self):
+        with self.cond:
+            if self.subscribers > 0 or self.done:
+                return
+            self._orphan_timer = None
+        metrics.inc("streams.cancelled")
+        self.cancel.cancel("cliente desconectado")
+
+    def _wait_locked(self, after_seq: int, closed: threading.Event, keepalive: float) -> bool:
+        """Espera nuevos eventos; mientras tanto hace el flush por tiempo del texto pendiente.
+
+        Devuelve False si venció el keepalive sin novedades.
+        """
+        deadline = time.monotonic() + keepalive
+        while True:
+            now = time.monotonic()
+            self._flush_due_locked(now)
+            if self._has_after(after_seq) or self.done or closed.is_set():
+                return True
+            timeout = deadline - now
+            if timeout <= 0:
+                return False
+            if self._pending_since is not None:
+                timeout = min(timeout, max(0.0, self._pending_since + self.coalesce_delay - now))
+            self.cond.wait(timeout)
+
+    def frames_after(self, after_seq: int, closed: threading.Event = None,
+                     keepalive: float = 15.0) -> Generator[bytes, None, None]:
+        """Emite los frames con seq > after_seq y sigue esperando hasta el final del stream."""
+        closed = closed or threading.Event()
+        while True:
+            with self.cond:
+                ready = self._wait_locked(after_seq, closed, keepalive)
+                pending, gap = self._collect(after_seq)
+                done = self.done
+            if closed.is_set():
+                return
+            if not ready:
+                yield _KEEPALIVE_FRAME
+                continue
+            if gap:
+                yield f"data: {json.dumps({'type': 'gap', 'missed': gap})}\n\n".encode("utf-8")
+            if pending:
+                after_seq = pending[-1][0]
+                # Un solo write por lote de eventos listos
+                yield b"".join(frame for _, frame in pending)
+            if done and not self._has_after(after_seq):
+                return
+
+    def _has_after(self, seq: int) -> bool:
+        return self.last_seq > seq
+
+    def _collect(self, after_seq: int) -> Tuple[list, int]:
+        if not self.events:
+            return [], 0
+        first_seq = self.events[0][0]
+        gap = max(0, first_seq - after_seq - 1)
+        start = max(0, after_seq + 1 - first_seq)
+        return [self.events[i] for i in range(start, len(self.events))], gap
+
+
+class StreamRegistry:
+    def __init__(self, max_events: int, ttl_seconds: float, max_producers: int,
+                 coalesce_chars: int = 0, coalesce_delay: float = 0.0):
+        self.max_events = max_events
+        self.ttl_seconds = ttl_seconds
+        self.coalesce_chars = coalesce_chars
+        self.coalesce_delay = coalesce_delay
+        self._streams: Dict[str, ChatStream] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_producers, thread_name_prefix="reservas-stream")
+        metrics.register_collector("streams", self.snapshot)
+
+    def start(self, user_id: str, message: str, produce: Callable[[CancelToken], Iterable[Dict]]) -> ChatStream:
+        """Crea el stream y lanza el productor en segundo plano.
+
+        `produce` recibe el CancelToken del stream y devuelve los eventos.
+        """
+        self._expire()
+        stream = ChatStream(uuid.uuid4().hex, user_id, message, self.max_events,
+                            self.coalesce_chars, self.coalesce_delay)
+        with self._lock:
+            self._streams[stream.stream_id] = stream
+        ctx = contextvars.copy_context()
+        self._executor.submit(ctx.run, self._produce, stream, produce)
+        metrics.inc("streams.started")
+        return stream
+
+    def _produce(self, stream: ChatStream, produce: Callable[[CancelToken], Iterable[Dict]]):
+        chunks = iter(produce(stream.cancel))
+        wrote_text = False
+        try:
+            while True:
+                with tracing.profile_block():
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                if chunk.get("type") == "chunk":
+                    text = chunk.get("text", "")
+                    stream.add_text(text)
+                    stream.publish_text(text)
+                    wrote_text = True
+                    continue
+                if chunk.get("type") == "cancelled" and wrote_text:
+                    # El turno no se guardó: se persiste lo generado hasta ahora
+                    stream.checkpoint()
+                    recover_checkpoint(stream.checkpoint_path)
+                    wrote_text = False
+                stream.publish(chunk)
+            if wrote_text:
+                stream.discard_checkpoint()
+        except Exception as e:
+            print(f"Stream {stream.stream_id} falló: {e}")
+            metrics.inc("streams.failed")
+            if wrote_text:
+                stream.checkpoint()
+                recover_checkpoint(stream.checkpoint_path)
+            stream.publish({"type": "error", "text": "Lo siento, hubo un error. ¿Puedo ayudarte con algo más?"})
+        finally:
+            stream.finish()
+
+    def get(self, stream_id: str) -> Optional[ChatStream]:
+        self._expire()
+        with self._lock:
+            return self._streams.get(stream_id)
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [sid for sid, s in self._streams.items()
+                       if s.done and now - s.finished_at > self.ttl_seconds]
+            for sid in expired:
+                del self._streams[sid]
+
+    def active(self) -> List[ChatStream]:
+        with self._lock:
+            return [s for s in self._streams.values() if not s.done]
+
+    def drain(self, timeout: float, cancel_grace: float) -> Dict:
+        """Espera a que terminen los streams activos (apagado).
+
+        Los que no terminan en `timeout` se cancelan: el productor guarda el
+        turno parcial en el historial. Si tampoco terminan en `cancel_grace`,
+        su texto queda en checkpoint y se recupera en el próximo arranque.
+        """
+        pending = self.active()
+        total = len(pending)
+        deadline = time.monotonic() + timeout
+        pending = [s for s in pending if not s.wait_done(deadline)]
+        for stream in pending:
+            stream.cancel.cancel("apagado del servidor")
+        deadline = time.monotonic() + cancel_grace
+        stuck = [s for s in pending if not s.wait_done(deadline)]
+        for stream in stuck:
+            if stream.has_text:
+                stream.checkpoint()
+        return {
+            "active": total,
+            "completed": total - len(pending),
+            "cancelled": len(pending) - len(stuck),
+            "checkpointed": len(stuck),
+        }
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            active = sum(1 for s in self._streams.values() if not s.done)
+            return {"buffered": len(self._streams), "active": active}
+
+
+def parse_last_event_id(value: str, stream_id: str) -> int:
+    """`<stream_id>:<seq>` -> seq (0 si no corresponde a este stream)."""
+    if not value:
+        return 0
+    sid, _, seq = value.strip().rpartition(":")
+    if sid != stream_id or not seq.isdigit():
+        return 0
+    return int(seq)
+
+
+def recover_checkpoint(path: str) -> bool:
+    """Persiste el turno parcial de un checkpoint en el historial y lo elimina."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            record = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return False
+    partial = record.get("partial", "")
+    if record.get("user_id") and partial:
+        MemoryManager().add_turn(record["user_id"], record.get("message", ""), partial + INTERRUPTED_SUFFIX)
+    os.remove(path)
+    return True
+
+
+def recover_checkpoints() -> int:
+    """Recupera los turnos que quedaron a medias tras una caída (se llama al iniciar).
+
+    Solo toma los checkpoints de procesos muertos: los de otro worker vivo
+    siguen siendo suyos y los guardará él al terminar el stream.
+    """
+    directory = _checkpoint_dir()
+    if not os.path.isdir(directory):
+        return 0
+    mine = checkpoint_owner()
+    by_owner: Dict[str, List[str]] = {}
+    for name in os.listdir(directory):
+        if name.endswith(".json"):
+            owner, _, _ = name[:-len(".json")].rpartition(".")
+            by_owner.setdefault(owner, []).append(name)
+        elif name.endswith(".lock"):
+            by_owner.setdefault(name[:-len(".lock")], [])  # también limpia los locks sin checkpoints
+    recovered = 0
+    for owner, names in by_owner.items():
+        if owner == mine:
+            continue
+        lock_path = os.path.join(directory, f"{owner}.lock")
+        lock = None
+        if owner and os.path.exists(lock_path):  # sin dueño: checkpoint de una versión anterior
+            lock = open(lock_path, "a+")
+            if not _try_lock(lock):
+                lock.close()
+                continue
+        for name in names:
+            recovered += recover_checkpoint(os.path.join(directory, name))
+        if lock is not None:
+            lock.close()
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+    if recovered:
+        print(f"Recuperados {recovered} turnos interrumpidos")
+    return recovered
+
+
+registry = StreamRegistry(
+    max_events=config.STREAM_BUFFER_EVENTS,
+    ttl_seconds=config.STREAM_TTL_SECONDS,
+    max_producers=config.STREAM_MAX_PRODUCERS,
+    coalesce_chars=config.STREAM_COALESCE_CHARS,
+    coalesce_delay=config.STREAM_COALESCE_MAX_DELAY_MS / 1000,
+)
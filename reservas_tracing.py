@@ -0,0 +1,242 @@
+"""
+Trazas opcionales por request y profiler por muestreo.
+
+Las trazas se activan con TRACING_ENABLED y el profiler con PROFILE_SAMPLE_RATE
+(ej: 0.01 = 1% de los requests). Sin una traza activa, span() y traced() no
+hacen nada más que leer una ContextVar.
+"""
+import contextvars
+import functools
+import inspect
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from reservas_config import (
+    TRACING_ENABLED,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_INTERVAL_MS,
+    PROFILE_FLUSH_EVERY,
+    PROFILE_DIR,
+)
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("reservas_trace", default=None)
+
+
+class Trace:
+    def __init__(self, trace_id: str = None, profiled: bool = False):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.profiled = profiled
+        self.spans: List[Dict] = []
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, duration_ms: float):
+        with self._lock:
+            self.spans.append({"name": name, "ms": round(duration_ms, 3)})
+
+    def totals(self) -> Dict[str, float]:
+        """Agrupa la duración total por nombre de span."""
+        result: Dict[str, float] = {}
+        with self._lock:
+            for s in self.spans:
+                result[s["name"]] = result.get(s["name"], 0.0) + s["ms"]
+        return result
+
+    def server_timing(self) -> str:
+        """Formato del header Server-Timing (visible en las devtools del navegador)."""
+        parts = [f"{name.replace(' ', '_')};dur={ms:.1f}" for name, ms in self.totals().items()]
+        return ", ".join(parts)
+
+
+def tracing_active() -> bool:
+    return TRACING_ENABLED or PROFILE_SAMPLE_RATE > 0
+
+
+def start_trace(trace_id: str = None) -> Trace:
+    profiled = PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    trace = Trace(trace_id, profiled=profiled)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def finish_trace(trace: Trace, label: str = ""):
+    total_ms = (time.perf_counter() - trace.started) * 1000
+    if trace.profiled:
+        profiler.request_done()
+    if TRACING_ENABLED:
+        stages = ", ".join(f"{k}={v:.1f}ms" for k, v in trace.totals().items())
+        print(f"[trace {trace.trace_id}] {label} total={total_ms:.1f}ms {stages}")
+
+
+@contextmanager
+def span(name: str):
+    """Mide un bloque dentro de la traza actual."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, (time.perf_counter() - start) * 1000)
+
+
+def traced(name: str):
+    """Decorador: registra cada llamada a la función como un span.
+
+    En un generador el span suma el tiempo pasado dentro de él (cada lote),
+    sin contar lo que tarda el consumidor entre uno y otro.
+    """
+    def decorator(fn):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def gen_wrapper(*args, **kwargs):
+                trace = _current_trace.get()
+                if trace is None:
+                    yield from fn(*args, **kwargs)
+                    return
+                gen = fn(*args, **kwargs)
+                busy = 0.0
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(gen)
+                        except StopIteration:
+                            return
+                        finally:
+                            busy += time.perf_counter() - start
+                        yield item
+                finally:
+                    gen.close()
+                    trace.add_span(name, busy * 1000)
+            return gen_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    """Muestrea la pila de los hilos registrados y acumula stacks plegados.
+
+    El archivo generado usa el formato "folded" (`frame;frame;frame N`), que
+    consumen directamente flamegraph.pl, speedscope o inferno.
+    """
+
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS, out_dir: str = PROFILE_DIR,
+                 flush_every: int = PROFILE_FLUSH_EVERY):
+        self.interval = max(interval_ms, 1.0) / 1000
+        self.out_dir = out_dir
+        self.flush_every = max(flush_every, 1)
+        self._stacks: Counter = Counter()
+        self._targets: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pending_requests = 0
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="reservas-profiler", daemon=True)
+            self._thread.start()
+
+    @contextmanager
+    def sample_current_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._targets[ident] = self._targets.get(ident, 0) + 1
+            self._ensure_thread()
+        self._wake.set()
+        try:
+            yield
+        finally:
+            with self._lock:
+                remaining = self._targets.get(ident, 1) - 1
+                if remaining > 0:
+                    self._targets[ident] = remaining
+                else:
+                    self._targets.pop(ident, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                targets = list(self._targets)
+                if not targets:
+                    self._wake.clear()
+            if not targets:
+                self._wake.wait()
+                continue
+            frames = sys._current_frames()
+            folded = [self._fold(frames[ident]) for ident in targets if ident in frames]
+            with self._lock:
+                self._stacks.update(folded)
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _fold(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def request_done(self):
+        with self._lock:
+            self._pending_requests += 1
+            should_flush = self._pending_requests >= self.flush_every
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> Optional[str]:
+        """Guarda los stacks acumulados en disco y reinicia el acumulador."""
+        with self._lock:
+            stacks, self._stacks = self._stacks, Counter()
+            self._pending_requests = 0
+        if not stacks:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def latest_profile(self) -> Optional[str]:
+        if not os.path.isdir(self.out_dir):
+            return None
+        files = sorted(p for p in os.listdir(self.out_dir) if p.endswith(".folded"))
+        return os.path.join(self.out_dir, files[-1]) if files else None
+
+
+profiler = SamplingProfiler()
+
+
+@contextmanager
+def profile_block():
+    """Muestrea el hilo actual si la traza en curso fue elegida para profiling."""
+    trace = _current_trace.get()
+    if trace is None or not trace.profiled:
+        yield
+        return
+    with profiler.sample_current_thread():
+        yield
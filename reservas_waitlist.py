@@ -0,0 +1,199 @@
+"""
+Lista de espera y reasignación de horarios liberados.
+
+Los pacientes se anotan por (especialidad, fecha) desde el flujo de reserva
+cuando no encuentran horario. Cada vez que una cancelación o
+reprogramación libera un horario, reservas_database avisa aquí
+(on_slot_freed) y el horario entra a una cola. Un hilo la vacía en lotes:
+espera hasta WAITLIST_BATCH_WAIT_MS para juntar una ráfaga de
+cancelaciones, agrupa los horarios por (especialidad, fecha) y, con una
+consulta y una transacción por grupo, los ofrece a los primeros de la
+lista. Cada oferta retiene el horario a nombre del paciente
+(reservas_holds, aparte de la reserva que tenga en curso; una oferta
+abierta por paciente) y el aviso se encola en el outbox en la misma
+transacción que la marca como ofrecida (reservas_outbox lo entrega y
+reintenta). El paciente la acepta desde el chat ("acepto") o reservando
+ese horario; si no responde antes de que venza la retención, la entrada
+queda vencida y el horario vuelve a la cola para el siguiente de la lista.
+"""
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import reservas_config as config
+import reservas_database as database
+import reservas_metrics as metrics
+from reservas_holds import holds
+
+Slot = Tuple[str, str, str]  # (especialidad, fecha, hora)
+
+
+class BackfillMatcher:
+    def __init__(self, batch_size: int, batch_wait: float):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue: "queue.Queue[Slot]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats = {"batches": 0, "freed": 0, "offered": 0, "expired": 0, "last_batch": 0}
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="reservas-waitlist", daemon=True)
+                self._thread.start()
+
+    def slot_freed(self, specialty: str, date: str, time_: str):
+        self._queue.put((specialty, date, time_))
+        self._ensure_thread()
+
+    def _next_batch(self) -> List[Slot]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.match(batch)
+            except Exception as e:
+                print(f"Error reasignando horarios liberados: {e}")
+                metrics.inc("waitlist.errors")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def drain(self, timeout: float) -> bool:
+        """Espera a que se ofrezcan los horarios ya encolados; False si no terminó a tiempo."""
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def match(self, freed: List[Slot]) -> List[Dict]:
+        """Ofrece los horarios liberados a la lista de espera; devuelve las ofertas."""
+        groups: Dict[Tuple[str, str], List[str]] = {}
+        for specialty, date, time_ in freed:
+            times = groups.setdefault((specialty, date), [])
+            if time_ not in times:
+                times.append(time_)
+        offers = []
+        skip_users = holds.offered_users()
+        for (specialty, date), times in groups.items():
+            # Puede haberse vuelto a ocupar o retener antes de llegar aquí
+            times = [t for t in sorted(times)
+                     if database.is_slot_free(specialty, date, t) and not holds.held_by_other("", specialty, date, t)]
+            if not times:
+                continue
+            held = []
+            try:
+                entries = database.offer_waiting(specialty, date, times, skip_users,
+                                                 lambda entry: self._hold(entry, held))
+            except Exception:
+                # No se guardó ninguna oferta del grupo: sus retenciones no aplican
+                for user_id in held:
+                    holds.release_offer(user_id)
+                raise
+            for entry in entries:
+                offers.append(self._offer(entry))
+                skip_users.append(entry["user_id"])
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["freed"] += len(freed)
+            self._stats["offered"] += len(offers)
+            self._stats["last_batch"] = len(freed)
+        return offers
+
+    def _hold(self, entry: Dict, held: List[str]) -> bool:
+        # El paciente tiene SLOT_HOLD_SECONDS para reservarlo antes que nadie
+        if not holds.offer(entry["id"], entry["user_id"], entry["specialty"], entry["date"], entry["offered_time"]):
+            # Lo retuvo otro paciente mientras tanto: la entrada vuelve a la cola
+            metrics.inc("waitlist.offer_failed")
+            return False
+        held.append(entry["user_id"])
+        return True
+
+    def _offer(self, entry: Dict) -> Dict:
+        metrics.inc("waitlist.offered")
+        return {
+            "waitlist_id": entry["id"],
+            "user_id": entry["user_id"],
+            "patient_name": entry["patient_name"],
+            "specialty": entry["specialty"],
+            "date": entry["date"],
+            "time": entry["offered_time"],
+        }
+
+    def offer_expired(self, entry_id: int, user_id: str, slot: Slot):
+        """La oferta venció sin respuesta: se cierra y el horario pasa al siguiente de la lista."""
+        if database.expire_offer(entry_id):
+            metrics.inc("waitlist.offer_expired")
+            with self._lock:
+                self._stats["expired"] += 1
+            self.slot_freed(*slot)
+
+    def recover_offers(self, now: datetime = None) -> Dict[str, int]:
+        """Al arrancar: las retenciones de las ofertas abiertas vivían en memoria.
+
+        Las que ya vencieron (offered_at + SLOT_HOLD_SECONDS) se cierran y su
+        horario pasa al siguiente de la lista; las demás recuperan la
+        retención por el tiempo que les queda.
+        """
+        now = now or datetime.now()
+        counts = {"rearmed": 0, "expired": 0}
+        for entry in database.open_offers():
+            slot = (entry["specialty"], entry["date"], entry["offered_time"])
+            try:
+                age = (now - datetime.fromisoformat(entry["offered_at"])).total_seconds()
+            except ValueError:
+                age = holds.hold_seconds
+            remaining = holds.hold_seconds - age
+            if remaining > 0 and holds.offer(entry["id"], entry["user_id"], *slot, seconds=remaining):
+                counts["rearmed"] += 1
+                continue
+            # Vencida durante el reinicio (o el horario ya lo retuvo otro): pasa al siguiente
+            self.offer_expired(entry["id"], entry["user_id"], slot)
+            counts["expired"] += 1
+        return counts
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(self._stats, queued=self._queue.qsize())
+
+
+def join(user_id: str, patient_name: str, specialty: str, date: str) -> Dict:
+    entry = database.join_waitlist(user_id, patient_name, specialty, date)
+    metrics.inc("waitlist.joined")
+    return entry
+
+
+def book(appt: Dict) -> str:
+    """Guarda la cita; si es el horario que se le ofreció al paciente, cierra la oferta como aceptada."""
+    offer = holds.offer_of(appt["user_id"])
+    entry_id = None
+    if offer is not None and offer[1] == (appt["specialty"], appt["date"], appt["time"]):
+        entry_id = offer[0]
+    appt_id = database.save_appointment(appt, entry_id)
+    if entry_id is not None:
+        holds.release_offer(appt["user_id"])
+        metrics.inc("waitlist.accepted")
+    return appt_id
+
+
+matcher = BackfillMatcher(config.WAITLIST_BATCH_SIZE, config.WAITLIST_BATCH_WAIT_MS / 1000)
+database.on_slot_freed(matcher.slot_freed)
+holds.on_offer_expired(matcher.offer_expired)
+metrics.register_collector("waitlist", matcher.snapshot)
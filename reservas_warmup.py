@@ -0,0 +1,97 @@
+"""
+Calentamiento al arrancar y estado de readiness.
+
+El lifespan de main.py lanza run() en segundo plano: construye el índice
+FAQ, prepara los proveedores de LLM (conexiones abiertas) y lee los archivos de datos. /healthz
+responde en cuanto el proceso acepta conexiones; /readyz solo cuando el
+calentamiento terminó.
+"""
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+import reservas_config as config
+import reservas_database as database
+import reservas_flow as appointment_flow
+import reservas_metrics as metrics
+from reservas_faq import get_faq_matcher
+
+# Referencia para medir el arranque en frío: importación de este módulo
+PROCESS_START = time.monotonic()
+
+
+class Readiness:
+    def __init__(self):
+        self.ready = False
+        self.steps: Dict[str, Dict] = {}
+        self.ready_after_ms = None
+        self._lock = threading.Lock()
+
+    def record(self, name: str, ms: float, error: str = None):
+        with self._lock:
+            self.steps[name] = {"ms": round(ms, 1), "error": error}
+        metrics.set_gauge(f"startup.{name}_ms", round(ms, 1))
+
+    def mark_ready(self):
+        with self._lock:
+            self.ready = True
+            self.ready_after_ms = round((time.monotonic() - PROCESS_START) * 1000, 1)
+        metrics.set_gauge("startup.ready_after_ms", self.ready_after_ms)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "ready_after_ms": self.ready_after_ms,
+                "steps": dict(self.steps),
+            }
+
+
+readiness = Readiness()
+
+
+def _warm_faq():
+    get_faq_matcher().find_answer("horario de atención")
+
+
+def _warm_llm():
+    # Importación diferida: evita cargar requests si el warm-up del LLM está desactivado
+    from reservas_providers import selector
+    for provider in selector.providers:
+        if not provider.configured():
+            continue
+        if config.WARMUP_LLM_CONNECT:
+            provider.warm_up()
+
+
+def _warm_storage():
+    users = database.load_json(database.USERS_FILE)
+    database.load_json(database.CHATS_FILE)
+    # Los vencimientos viven en memoria: se reprograman los flujos que quedaron a medias
+    appointment_flow.schedule_idle_sessions(users)
+    # Abre appointments.db (crea el esquema y migra appointments.json si existe)
+    database.get_appointment("")
+
+
+STEPS: List[Tuple[str, Callable[[], None]]] = [
+    ("faq_index", _warm_faq),
+    ("flow_parsers", appointment_flow.warm_up),
+    ("llm_pool", _warm_llm),
+    ("storage", _warm_storage),
+]
+
+
+def run():
+    """Ejecuta los pasos de calentamiento; un paso fallido no bloquea el readiness."""
+    start = time.monotonic()
+    for name, step in STEPS:
+        t = time.monotonic()
+        error = None
+        try:
+            step()
+        except Exception as e:
+            error = str(e)
+            print(f"Warm-up '{name}' falló: {e}")
+        readiness.record(name, (time.monotonic() - t) * 1000, error)
+    readiness.record("total", (time.monotonic() - start) * 1000)
+    readiness.mark_ready()
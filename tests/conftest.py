@@ -0,0 +1,47 @@
+import os
+import socket
+import sys
+
+import pytest
+
+# Los módulos reservas_* viven en la raíz del repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# La configuración se lee al importar los módulos: el entorno de pruebas va
+# antes de que cualquier test los importe. El stub de Gemini escucha en
+# GEMINI_STUB_PORT (ver test_stream_cancel.py).
+GEMINI_STUB_PORT = _free_port()
+os.environ.update({
+    "GOOGLE_API_KEY": "test",
+    "GEMINI_BASE_URL": f"http://127.0.0.1:{GEMINI_STUB_PORT}",
+    "LLM_PROVIDERS": "gemini",
+    "STREAM_RESUME_GRACE_SECONDS": "0.5",
+    "RATE_LIMIT_ENABLED": "false",
+    "ROUTER_LOG_ENABLED": "false",
+    "OUTBOX_ENABLED": "false",
+    "REMINDERS_ENABLED": "false",
+    "SHUTDOWN_HOOK_SIGNALS": "false",
+})
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Usuarios, chats y appointments.db en un directorio temporal (nunca en data/)."""
+    import reservas_database as database
+
+    monkeypatch.setattr(database, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(database, "USERS_FILE", str(tmp_path / "users.json"))
+    monkeypatch.setattr(database, "APPTS_FILE", str(tmp_path / "appointments.json"))
+    monkeypatch.setattr(database, "CHATS_FILE", str(tmp_path / "chats.json"))
+    database.ensure_data()
+    yield tmp_path
+    # Los horarios liberados por el test se ofrecen en otro hilo: antes de restaurar DATA_DIR
+    import reservas_waitlist as waitlist
+    waitlist.matcher.drain(5)
@@ -0,0 +1,52 @@
+"""Los endpoints que leen o modifican datos de pacientes exigen ADMIN_TOKEN."""
+from datetime import date, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import reservas_database as database
+
+
+@pytest.fixture
+def client(data_dir):
+    # Sin `with`: no corre el lifespan (warm-up, workers)
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("path", ["/admin/appointments", "/admin/appointments/stream"])
+def test_patient_data_needs_a_token_even_in_debug(client, monkeypatch, path):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "")
+    monkeypatch.setattr(main, "DEBUG", True)
+    assert client.get(path).status_code == 403
+    assert client.get(path, headers={"X-Admin-Token": "cualquiera"}).status_code == 403
+
+
+@pytest.mark.parametrize("path", ["/admin/appointments", "/admin/appointments/stream"])
+def test_patient_data_with_the_admin_token(client, monkeypatch, path):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "s3creto")
+    assert client.get(path).status_code == 403
+    assert client.get(path, headers={"X-Admin-Token": "otro"}).status_code == 403
+    assert client.get(path, headers={"X-Admin-Token": "s3creto"}).status_code == 200
+
+
+def test_appointment_changes_by_id_need_the_admin_token(client, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "s3creto")
+    database.create_user("ana", "Ana")
+    day = (date.today() + timedelta(days=4)).isoformat()
+    appt_id = database.save_appointment({"user_id": "ana", "patient_name": "Ana", "specialty": "Cardiología",
+                                         "date": day, "time": "10:00"})
+    calls = [
+        ("get", f"/appointments/{appt_id}/history", {"params": {"user_id": "ana"}}),
+        ("post", f"/appointments/{appt_id}/reschedule", {"json": {"user_id": "ana", "date": day, "time": "11:00"}}),
+        ("post", f"/appointments/{appt_id}/cancel", {"json": {"user_id": "ana"}}),
+    ]
+    # Conocer el user_id del paciente no alcanza
+    for method, path, kwargs in calls:
+        assert getattr(client, method)(path, **kwargs).status_code == 403
+    assert database.get_appointment(appt_id)["status"] == database.STATUS_CONFIRMED
+
+    headers = {"X-Admin-Token": "s3creto"}
+    for method, path, kwargs in calls:
+        assert getattr(client, method)(path, headers=headers, **kwargs).status_code == 200
+    assert database.get_appointment(appt_id)["status"] == database.STATUS_CANCELLED
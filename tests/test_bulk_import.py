@@ -0,0 +1,65 @@
+"""Importación masiva: motivos de rechazo (ID duplicado, horario ocupado, paciente desconocido)."""
+import csv
+import json
+from datetime import date, timedelta
+
+import pytest
+
+import reservas_bulk as bulk
+import reservas_database as database
+
+DAY = (date.today() + timedelta(days=10)).isoformat()
+
+
+@pytest.fixture
+def users(data_dir):
+    database.create_user("ana", "Ana")
+    database.create_user("beto", "Beto")
+
+
+def _write_csv(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["appointment_id", "user_id", "specialty", "date", "time"])
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def _import(path, rejects):
+    stats = bulk.import_file(path, rejects_path=str(rejects), progress=False)
+    with open(rejects, encoding="utf-8") as f:
+        reasons = {r["row"]["appointment_id"]: r["reason"] for r in map(json.loads, f)}
+    return stats, reasons
+
+
+def test_reimport_reports_duplicate_ids_before_busy_slots(users, tmp_path):
+    rows = [
+        {"appointment_id": "APPT-1", "user_id": "ana", "specialty": "Cardiología", "date": DAY, "time": "10:00"},
+        {"appointment_id": "APPT-2", "user_id": "beto", "specialty": "Cardiología", "date": DAY, "time": "11:00"},
+    ]
+    path = _write_csv(tmp_path / "agenda.csv", rows)
+    stats, _ = _import(path, tmp_path / "rechazos1.ndjson")
+    assert stats["imported"] == 2
+
+    stats, reasons = _import(path, tmp_path / "rechazos2.ndjson")
+    assert stats["imported"] == 0
+    assert reasons == {"APPT-1": "ID duplicado", "APPT-2": "ID duplicado"}
+
+
+def test_busy_slot_and_duplicate_id_within_the_file(users, tmp_path):
+    rows = [
+        {"appointment_id": "APPT-1", "user_id": "ana", "specialty": "Cardiología", "date": DAY, "time": "10:00"},
+        {"appointment_id": "APPT-1", "user_id": "beto", "specialty": "Cardiología", "date": DAY, "time": "12:00"},
+        {"appointment_id": "APPT-3", "user_id": "beto", "specialty": "Cardiología", "date": DAY, "time": "10:00"},
+    ]
+    stats, reasons = _import(_write_csv(tmp_path / "agenda.csv", rows), tmp_path / "rechazos.ndjson")
+    assert stats["imported"] == 1
+    assert reasons == {"APPT-1": "ID duplicado", "APPT-3": "horario ocupado"}
+
+
+def test_unknown_patient_is_rejected(users, tmp_path):
+    rows = [{"appointment_id": "APPT-9", "user_id": "nadie", "specialty": "Cardiología", "date": DAY, "time": "10:00"}]
+    stats, reasons = _import(_write_csv(tmp_path / "agenda.csv", rows), tmp_path / "rechazos.ndjson")
+    assert stats["imported"] == 0
+    assert reasons == {"APPT-9": "usuario desconocido: nadie"}
+    assert database.get_appointment("APPT-9") is None
@@ -0,0 +1,20 @@
+"""Consultas de appointments.db por lista de IDs."""
+import sqlite3
+from datetime import date, timedelta
+
+import reservas_database as database
+
+
+def test_get_appointments_splits_long_id_lists(data_dir):
+    day = (date.today() + timedelta(days=5)).isoformat()
+    saved = [database.save_appointment({"user_id": "ana", "patient_name": "Ana", "specialty": "Cardiología",
+                                        "date": day, "time": time}) for time in ("09:00", "10:00")]
+    conn = database._connect()
+    # El límite de parámetros por consulta varía según la compilación de SQLite: se fija el más bajo (999)
+    previous = conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    try:
+        found = database.get_appointments([f"APPT-X{i}" for i in range(5000)] + saved)
+    finally:
+        conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, previous)
+    assert sorted(found) == sorted(saved)
+    assert found[saved[0]]["time"] == "09:00"
@@ -0,0 +1,48 @@
+"""Confirmación al cancelar una cita desde el chat (flujo "manage")."""
+from datetime import date, timedelta
+
+import pytest
+
+import reservas_database as database
+import reservas_flow as flow
+
+
+@pytest.fixture
+def appointment(data_dir):
+    database.create_user("paciente", "Ana")
+    day = (date.today() + timedelta(days=3)).isoformat()
+    appt_id = database.save_appointment({"user_id": "paciente", "patient_name": "Ana",
+                                         "specialty": "Cardiología", "date": day, "time": "10:00"})
+    reply = flow.process_message("paciente", "quiero cancelar mi cita")["reply"]
+    assert "¿Confirmas que quieres cancelar" in reply
+    return appt_id
+
+
+@pytest.mark.parametrize("answer", ["si", "sí, cancélala", "si, cancelar", "Sí, cancelar la cita por favor"])
+def test_yes_with_cancel_words_cancels_the_appointment(appointment, answer):
+    reply = flow.process_message("paciente", answer)["reply"]
+    assert "cancelada" in reply
+    assert database.get_appointment(appointment)["status"] == database.STATUS_CANCELLED
+    assert database.get_user("paciente")["state"] == "idle"
+
+
+@pytest.mark.parametrize("answer", ["no", "no, mejor consérvala", "no quiero cancelarla"])
+def test_no_keeps_the_appointment(appointment, answer):
+    reply = flow.process_message("paciente", answer)["reply"]
+    assert "se mantiene" in reply
+    assert database.get_appointment(appointment)["status"] == database.STATUS_CONFIRMED
+    assert database.get_user("paciente")["state"] == "idle"
+
+
+@pytest.mark.parametrize("answer", ["cancelar", "así está bien", "si... no, cancelar"])
+def test_ambiguous_answer_asks_again(appointment, answer):
+    reply = flow.process_message("paciente", answer)["reply"]
+    assert "No entendí" in reply
+    assert database.get_appointment(appointment)["status"] == database.STATUS_CONFIRMED
+    assert database.get_user("paciente")["state"] == "confirm_cancel"
+
+
+def test_salir_still_aborts_the_flow(appointment):
+    flow.process_message("paciente", "salir")
+    assert database.get_appointment(appointment)["status"] == database.STATUS_CONFIRMED
+    assert database.get_user("paciente")["state"] == "idle"
@@ -0,0 +1,54 @@
+"""ProviderSelector: offline no compite por latencia con los proveedores de red."""
+import pytest
+
+from reservas_providers import (GeminiProvider, LLMProvider, OfflineProvider, OpenAICompatibleProvider,
+                                ProviderSelector)
+
+
+def _measured(provider, seconds):
+    provider.observe_latency("generate", seconds)
+    provider.observe_latency("stream", seconds)
+    return provider
+
+
+def test_offline_never_beats_an_available_network_provider(monkeypatch):
+    monkeypatch.setenv("OPENAI_BASE_URL", "http://127.0.0.1:9/v1")
+    gemini = _measured(GeminiProvider(), 0.8)
+    openai = _measured(OpenAICompatibleProvider(), 0.3)
+    offline = _measured(OfflineProvider(), 0.001)
+    selector = ProviderSelector([gemini, offline, openai])
+    assert selector.pick("generate") is openai
+    assert selector.pick("stream") is openai
+
+    # Entre los de red sigue ganando el más rápido
+    gemini.latency["generate"] = 0.01
+    assert selector.pick("generate") is gemini
+
+
+def test_offline_is_the_last_resort(monkeypatch):
+    gemini = _measured(GeminiProvider(), 0.8)
+    offline = _measured(OfflineProvider(), 0.001)
+    selector = ProviderSelector([gemini, offline])
+    assert selector.pick() is gemini
+
+    # Breaker abierto: responde offline hasta que Gemini vuelva
+    monkeypatch.setattr(gemini.breaker, "is_available", lambda: False)
+    assert selector.pick() is offline
+    monkeypatch.undo()
+    assert selector.pick() is gemini
+
+    # Sin API key tampoco cuenta como disponible
+    gemini.api_key = ""
+    assert selector.pick() is offline
+    assert ProviderSelector([gemini]).pick() is None
+
+
+def test_provider_without_stream_fails_at_construction():
+    class GenerateOnly(LLMProvider):
+        name = "solo_generate"
+
+        def generate(self, prompt):
+            return "hola"
+
+    with pytest.raises(TypeError, match="stream"):
+        GenerateOnly()
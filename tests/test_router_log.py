@@ -0,0 +1,28 @@
+"""DecisionLog: escritura en segundo plano, rotación por tamaño y muestreo."""
+import json
+
+from reservas_router import DecisionLog
+
+
+def test_decisions_are_written_and_rotated(tmp_path):
+    path = tmp_path / "router_decisions.ndjson"
+    log = DecisionLog(str(path), max_bytes=2000, backups=2)
+    for i in range(200):
+        log.write({"endpoint": "/chat", "i": i, "plan": ["faq", "llm"]})
+    log.close()
+
+    files = sorted(tmp_path.glob("router_decisions.ndjson*"))
+    assert [f.name for f in files] == ["router_decisions.ndjson", "router_decisions.ndjson.1",
+                                       "router_decisions.ndjson.2"]
+    assert all(f.stat().st_size <= 2000 for f in files)
+    # El archivo actual tiene las últimas decisiones, completas
+    last = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert last[-1]["i"] == 199
+
+
+def test_sampling_writes_a_fraction(tmp_path):
+    path = tmp_path / "router_decisions.ndjson"
+    log = DecisionLog(str(path), max_bytes=10 ** 7, backups=1, sample_rate=0.0)
+    log.write({"endpoint": "/chat"})
+    log.close()
+    assert not path.exists()
@@ -0,0 +1,153 @@
+"""
+Cancelación del stream de Gemini cuando el cliente de /chat/stream se va.
+
+Levanta un stub local de Gemini (SSE lento) y la app en uvicorn, corta la
+conexión del cliente a mitad de la respuesta y comprueba que, pasado
+STREAM_RESUME_GRACE_SECONDS, se cierra la conexión con el stub y se
+contabilizan el stream cancelado y los tokens ahorrados.
+"""
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import reservas_config as config
+
+GRACE_SECONDS = config.STREAM_RESUME_GRACE_SECONDS
+STUB_CHUNKS = 400
+STUB_INTERVAL = 0.02
+
+
+class GeminiStub(ThreadingHTTPServer):
+    """streamGenerateContent que emite STUB_CHUNKS fragmentos y anota cuándo lo cortan."""
+
+    daemon_threads = True
+
+    def __init__(self, port: int):
+        super().__init__(("127.0.0.1", port), _StubHandler)
+        self.requests = 0
+        self.chunks_sent = 0
+        self.closed = threading.Event()
+        self.closed_at = None
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"  # el body termina al cerrar la conexión
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "streamGenerateContent" not in self.path:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.server.requests += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        try:
+            for i in range(STUB_CHUNKS):
+                data = {"candidates": [{"content": {"parts": [{"text": f"palabra{i} "}]}}]}
+                self.wfile.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                self.server.chunks_sent += 1
+                time.sleep(STUB_INTERVAL)
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.closed_at = time.monotonic()
+            self.server.closed.set()
+
+
+@pytest.fixture(scope="module")
+def stub():
+    # conftest ya apuntó GEMINI_BASE_URL a este puerto antes de importar la app
+    server = GeminiStub(int(os.environ["GEMINI_BASE_URL"].rsplit(":", 1)[1]))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="module")
+def app_url(stub):
+    import uvicorn
+    import reservas_database as database
+    import main
+
+    with tempfile.TemporaryDirectory() as data_dir, pytest.MonkeyPatch.context() as mp:
+        mp.setattr(database, "DATA_DIR", data_dir)
+        mp.setattr(database, "USERS_FILE", os.path.join(data_dir, "users.json"))
+        mp.setattr(database, "APPTS_FILE", os.path.join(data_dir, "appointments.json"))
+        mp.setattr(database, "CHATS_FILE", os.path.join(data_dir, "chats.json"))
+        database.ensure_data()
+        database.create_user("paciente", "Ana")
+
+        server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=0, log_level="warning"))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 10
+        while not server.started and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert server.started, "uvicorn no arrancó"
+        port = server.servers[0].sockets[0].getsockname()[1]
+        yield f"127.0.0.1:{port}"
+        server.should_exit = True
+        thread.join(10)
+
+
+def _counters():
+    import reservas_metrics as metrics
+    return metrics.snapshot()["counters"]
+
+
+def _wait_for(predicate, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+def test_client_disconnect_cancels_upstream_stream(stub, app_url):
+    before = _counters()
+    host, port = app_url.split(":")
+    body = json.dumps({"user_id": "paciente", "message": "qwerty zxcvb asdfg"}).encode("utf-8")
+
+    client = socket.create_connection((host, int(port)), timeout=10)
+    client.sendall(
+        b"POST /chat/stream HTTP/1.1\r\nHost: test\r\nContent-Type: application/json\r\n"
+        + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body
+    )
+    received = b""
+    while b'"type": "chunk"' not in received:
+        data = client.recv(65536)
+        assert data, f"la respuesta terminó sin fragmentos: {received!r}"
+        received += data
+    assert stub.requests == 1
+    # El cliente se va a mitad de la respuesta
+    client.close()
+    disconnected_at = time.monotonic()
+
+    assert stub.closed.wait(GRACE_SECONDS + 5), "la conexión con Gemini siguió abierta"
+    elapsed = stub.closed_at - disconnected_at
+    # Se espera la gracia por si el cliente reanuda; después se corta enseguida
+    assert GRACE_SECONDS * 0.8 <= elapsed < GRACE_SECONDS + 2
+    assert stub.chunks_sent < STUB_CHUNKS
+
+    assert _wait_for(lambda: _counters().get("llm.stream_cancelled", 0) > before.get("llm.stream_cancelled", 0), 5)
+    after = _counters()
+    assert after.get("streams.cancelled", 0) == before.get("streams.cancelled", 0) + 1
+    assert after.get("llm.tokens_saved_estimate", 0) > before.get("llm.tokens_saved_estimate", 0)
+    assert after.get("llm.stream_completed", 0) == before.get("llm.stream_completed", 0)
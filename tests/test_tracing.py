@@ -0,0 +1,50 @@
+"""Spans de las funciones de base de datos (paginación, export, lista de espera, outbox)."""
+import contextvars
+import time
+from datetime import date, timedelta
+
+import reservas_database as database
+import reservas_tracing as tracing
+
+
+def _traced_run(fn):
+    """Ejecuta fn dentro de una traza propia (sin tocar el contexto del test) y devuelve sus spans."""
+    def run():
+        trace = tracing.start_trace()
+        fn()
+        return trace.totals()
+    return contextvars.copy_context().run(run)
+
+
+def test_database_calls_add_spans(data_dir):
+    day = (date.today() + timedelta(days=6)).isoformat()
+    for hour in ("09:00", "10:00", "11:00"):
+        database.save_appointment({"user_id": "ana", "patient_name": "Ana", "specialty": "Cardiología",
+                                   "date": day, "time": hour})
+
+    def calls():
+        database.appointments_page(limit=2)
+        assert sum(len(batch) for batch in database.iter_appointments(batch_size=2)) == 3
+        with database.appointments_tx() as conn:
+            database.take_waiting(conn, "Cardiología", day, ["12:00"])
+        database.outbox_stats()
+
+    spans = _traced_run(calls)
+    for name in ("db.appointments_page", "db.iter_appointments", "db.take_waiting", "db.outbox_stats"):
+        assert name in spans, name
+
+
+def test_generator_span_counts_its_own_time_only():
+    @tracing.traced("lotes")
+    def batches():
+        for i in range(2):
+            time.sleep(0.02)
+            yield i
+
+    def consume():
+        for _ in batches():
+            time.sleep(0.05)
+
+    spans = _traced_run(consume)
+    # Los dos lotes (~40 ms), no la creación del generador ni el consumidor (~100 ms)
+    assert 35 <= spans["lotes"] < 90
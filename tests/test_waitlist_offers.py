@@ -0,0 +1,145 @@
+"""Ofertas de la lista de espera: retención aparte de la reserva en curso, aceptación y vencimiento."""
+import json
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import reservas_database as database
+import reservas_flow as flow
+import reservas_waitlist as waitlist
+from reservas_holds import holds
+
+
+def _wait_for(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.02)
+    return predicate()
+
+
+def _waitlist_status(entry_id: int) -> str:
+    return database._connect().execute("SELECT status FROM waitlist WHERE id = ?", (entry_id,)).fetchone()[0]
+
+
+@pytest.fixture
+def day(data_dir):
+    day = date.today() + timedelta(days=3)
+    for user_id, name in (("ana", "Ana"), ("beto", "Beto"), ("caro", "Caro")):
+        database.create_user(user_id, name)
+    yield day
+    for user_id in ("ana", "beto", "caro"):
+        holds.release(user_id)
+        holds.release_offer(user_id)
+        holds.end_session(user_id)
+
+
+def test_offer_keeps_the_booking_hold_and_can_be_accepted(day):
+    iso = day.isoformat()
+    appt_id = database.save_appointment({"user_id": "ana", "patient_name": "Ana",
+                                         "specialty": "Cardiología", "date": iso, "time": "10:00"})
+    entry = waitlist.join("beto", "Beto", "Cardiología", iso)
+    flow.process_message("beto", f"quiero una cita de cardiología el {day.strftime('%d/%m/%Y')} a las 11:00")
+    assert database.get_user("beto")["state"] == "confirm"
+
+    database.cancel_appointment(appt_id)
+    assert _wait_for(lambda: holds.offer_of("beto")) == (entry["id"], ("Cardiología", iso, "10:00"))
+    assert waitlist.matcher.drain(5)
+    # El aviso de la oferta sale por el outbox (con reintentos), no desde el hilo del matcher
+    notice = database._connect().execute(
+        "SELECT payload, status FROM outbox WHERE event = 'oferta' AND idempotency_key LIKE ?", (f"oferta:{entry['id']}:%",)
+    ).fetchone()
+    assert notice["status"] == database.OUTBOX_PENDING
+    assert json.loads(notice["payload"])["time"] == "10:00"
+
+    # La oferta no le quita a Beto las 11:00 que está confirmando
+    assert holds.held_by_other("caro", "Cardiología", iso, "11:00")
+    assert holds.held_by_other("caro", "Cardiología", iso, "10:00")
+    reply = flow.process_message("beto", "si")["reply"]
+    assert "ID de cita" in reply
+    # Responder en el flujo no suelta la oferta
+    assert holds.offer_of("beto") is not None
+
+    reply = flow.process_message("beto", "acepto")["reply"]
+    assert "Reservé el horario que se liberó" in reply
+    times = sorted(a["time"] for a in database.get_user_appointments("beto") if a["status"] == "confirmada")
+    assert times == ["10:00", "11:00"]
+    assert _waitlist_status(entry["id"]) == database.WAITLIST_ACCEPTED
+    assert holds.offer_of("beto") is None
+
+
+def test_expired_offer_moves_to_the_next_entry(day):
+    iso = day.isoformat()
+    appt_id = database.save_appointment({"user_id": "ana", "patient_name": "Ana",
+                                         "specialty": "Cardiología", "date": iso, "time": "10:00"})
+    first = waitlist.join("beto", "Beto", "Cardiología", iso)
+    second = waitlist.join("caro", "Caro", "Cardiología", iso)
+
+    database.cancel_appointment(appt_id)
+    assert _wait_for(lambda: holds.offer_of("beto"))
+
+    # Beto no responde: vence la retención y el horario pasa a Caro
+    holds.advance(time.monotonic() + holds.hold_seconds + 2 * holds._wheel.tick)
+    assert _wait_for(lambda: holds.offer_of("caro")) == (second["id"], ("Cardiología", iso, "10:00"))
+    assert waitlist.matcher.drain(5)
+    assert holds.offer_of("beto") is None
+    assert _waitlist_status(first["id"]) == database.WAITLIST_EXPIRED
+    assert _waitlist_status(second["id"]) == database.WAITLIST_OFFERED
+
+    reply = flow.process_message("beto", "acepto")["reply"]
+    assert "Reservé" not in reply
+    assert not database.get_user_appointments("beto")
+
+
+def _restart():
+    """Simula un reinicio: las retenciones en memoria se pierden, la base queda."""
+    for user_id in ("ana", "beto", "caro"):
+        holds.release_offer(user_id)
+
+
+def _backdate_offer(entry_id: int, seconds: float):
+    offered_at = (datetime.now() - timedelta(seconds=seconds)).isoformat()
+    with database.appointments_tx() as conn:
+        conn.execute("UPDATE waitlist SET offered_at = ? WHERE id = ?", (offered_at, entry_id))
+
+
+def test_restart_rearms_open_offers(day):
+    iso = day.isoformat()
+    appt_id = database.save_appointment({"user_id": "ana", "patient_name": "Ana",
+                                         "specialty": "Cardiología", "date": iso, "time": "10:00"})
+    entry = waitlist.join("beto", "Beto", "Cardiología", iso)
+    database.cancel_appointment(appt_id)
+    assert _wait_for(lambda: holds.offer_of("beto"))
+    assert waitlist.matcher.drain(5)
+
+    _restart()
+    _backdate_offer(entry["id"], holds.hold_seconds / 2)
+    assert holds.offer_of("beto") is None
+    assert waitlist.matcher.recover_offers() == {"rearmed": 1, "expired": 0}
+
+    assert holds.offer_of("beto") == (entry["id"], ("Cardiología", iso, "10:00"))
+    assert "Reservé el horario que se liberó" in flow.process_message("beto", "acepto")["reply"]
+    assert _waitlist_status(entry["id"]) == database.WAITLIST_ACCEPTED
+
+
+def test_restart_expires_stale_offers_and_moves_on(day):
+    iso = day.isoformat()
+    appt_id = database.save_appointment({"user_id": "ana", "patient_name": "Ana",
+                                         "specialty": "Cardiología", "date": iso, "time": "10:00"})
+    first = waitlist.join("beto", "Beto", "Cardiología", iso)
+    second = waitlist.join("caro", "Caro", "Cardiología", iso)
+    database.cancel_appointment(appt_id)
+    assert _wait_for(lambda: holds.offer_of("beto"))
+    assert waitlist.matcher.drain(5)
+
+    _restart()
+    _backdate_offer(first["id"], holds.hold_seconds + 1)
+    assert waitlist.matcher.recover_offers() == {"rearmed": 0, "expired": 1}
+
+    assert _wait_for(lambda: holds.offer_of("caro")) == (second["id"], ("Cardiología", iso, "10:00"))
+    assert waitlist.matcher.drain(5)
+    assert _waitlist_status(first["id"]) == database.WAITLIST_EXPIRED
+    assert _waitlist_status(second["id"]) == database.WAITLIST_OFFERED